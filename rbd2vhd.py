@@ -18,12 +18,24 @@
 from __future__ import print_function
 from struct import *
 import uuid
+import io
+import os
+import mmap
+import stat
+import ctypes, ctypes.util
 import sys, getopt
 import re
 import time
 import socket
 import select
+import errno
+import array
+import tempfile
+import shutil
 import threading
+import Queue
+import bisect
+import collections
 
 verbose = False
 debug = False
@@ -35,6 +47,7 @@ VHD_DIFF_HARDDISK_TYPE = 0x00000004# Differencing hard disk
 
 VDI_PREFIX = "VHD-"
 SNAPSHOT_PREFIX = "SNAP-"
+SNAPSHOT_PREFIX_RE = re.compile(SNAPSHOT_PREFIX)
 
 #-- VHD FOOTTER FIELDs --#
 _vhd_footter_cookie_                 = 0
@@ -127,6 +140,9 @@ VHD_PARENT_LOCATOR_ENTRY_RECORD_SIZE = 24
 VHD_PARENT_LOCATORS_COUNT = 9
 VHD_BATMAP_HEADER_FORMAT = "!8sQIIIB483s"
 VHD_BATMAP_HEADER_SIZE = 512
+VHD_BAT_UNUSED_ENTRY = 0xffffffff
+VHD_BAT_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+VHD_BAT_ENTRIES_PER_SECTOR = 512/4
 
 #-- RBD DIFF v1 META AND DATA FIELDs --#
 RBD_HEADER = "rbd diff v1\n"
@@ -141,22 +157,103 @@ RBD_DIFF_DATA = "QQ"
 RBD_DIFF_DATA_SIZE = 16
 #-- RBD DIFF v1 META AND DATA FIELDs --#
 
+#-- RBD DIFF v1 RECORD TAGs --#
+RBD_DIFF_RECORD_FROM_SNAP = "f"
+RBD_DIFF_RECORD_TO_SNAP   = "t"
+RBD_DIFF_RECORD_SIZE      = "s"
+RBD_DIFF_RECORD_DATA      = "w"
+RBD_DIFF_RECORD_ZERO      = "z"
+RBD_DIFF_RECORD_END       = "e"
+#-- RBD DIFF v1 RECORD TAGs --#
+
+#-- RBD DIFF v1 RECORD FIELDs --#
+_rbd_record_tag_      = 0
+_rbd_record_offset_   = 1
+_rbd_record_length_   = 2
+_rbd_record_data_     = 3
+_rbd_record_position_ = 4
+#-- RBD DIFF v1 RECORD FIELDs --#
+
+RBD_DIFF_SNAP_STRUCT = Struct(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_SNAP)
+RBD_DIFF_SIZE_STRUCT = Struct(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_SIZE)
+RBD_DIFF_DATA_STRUCT = Struct(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_DATA)
+
+RBD_DIFF_DATA_RECORD_STRUCT = Struct(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_DATA)
+
+# Sidecar index: magic, header, snap names, then one column each of record tags, offsets, lengths and payload positions
+RBD_DIFF_INDEX_MAGIC = "rbd diff index v1\n"
+RBD_DIFF_INDEX_HEADER_STRUCT = Struct("<QQdQII") # record count, diff size, diff mtime, image size, from/to snap name lengths
+RBD_DIFF_INDEX_SUFFIX = ".idx"
+RBD_DIFF_INDEX_TYPECODE = 'L' if array.array('L').itemsize == 8 else None
+RBD_DIFF_RANGE_END = 1 << 64
+RBD_DIFF_CHECKPOINT_MAGIC = "rbd diff checkpoint v1\n"
+RBD_DIFF_CHECKPOINT_STRUCT = Struct("<QdQQQQ") # diff size, diff mtime, range start, range length (0 - whole image), input position, output offset
+RBD_DIFF_CHECKPOINT_INTERVAL = 30.0
+
+RBD_DIFF_READ_BUFFER_SIZE = 4*1024*1024
+RBD_DIFF_SCAN_BUFFER_SIZE = 64*1024
+RBD_DIFF_MAX_RECORD_SIZE = 16*VHD_DEFAULT_BLOCK_SIZE
+VHD_STREAM_SPOOL_MEMORY_SIZE = 64*1024*1024
+VHD_PARALLEL_CHUNK_BLOCKS = 16
+VHD_PROGRESS_INTERVAL = 0.5
+VHD_DEFAULT_READ_AHEAD = 16
+VHD_CHAIN_MAX_DEPTH = 256
+VHD_CHAIN_OWNERS_CACHE_BLOCKS = 1024
+RAW_PARALLEL_PARTITIONS_PER_JOB = 4
+
+ZERO_CHUNK_SIZE = 1024*1024
+ZERO_CHUNK = '\x00' * ZERO_CHUNK_SIZE
+ZERO_DETECT_SIZE = 4096
+
+FALLOC_FL_KEEP_SIZE  = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
 NBD_INIT_PASSWD = 'NBDMAGIC'
 NBD_INIT_PASSWD_HEX = 0x4e42444d41474943
 NBD_CLISERVER_MAGIC = 0x00420281861253 #cliserv_magic
+NBD_OPTS_MAGIC = 0x49484156454F5054 #IHAVEOPT
+NBD_REP_MAGIC = 0x0003e889045565a9
 NBD_REQUEST_MAGIC = 0x25609513 #NBD_REQUEST_MAGIC
 NBD_REPLY_MAGIC = 0x67446698 #NBD_REPLY_MAGIC
+NBD_STRUCTURED_REPLY_MAGIC = 0x668e33ef
 
 NBD_NEGOTIATION_FORMAT = "!8sQQHH124s"
 NBD_NEGOTIATION_SIZE = 152
+NBD_NEGOTIATION_MAGIC_FORMAT = "!8sQ"
+NBD_NEGOTIATION_MAGIC_SIZE = 16
+
+NBD_OPTION_HEADER_FORMAT = "!QLL"
+NBD_OPTION_REPLY_HEADER_FORMAT = "!QLLL"
+NBD_OPTION_REPLY_HEADER_SIZE = 20
+NBD_EXPORT_NAME_REPLY_FORMAT = "!QH"
+NBD_EXPORT_NAME_REPLY_SIZE = 10
+
+NBD_STRUCTURED_REPLY_HEADER_FORMAT = "!LHHQL"
+NBD_STRUCTURED_REPLY_HEADER_STRUCT = Struct(NBD_STRUCTURED_REPLY_HEADER_FORMAT)
+NBD_STRUCTURED_REPLY_HEADER_SIZE = 20
 
 NBD_REQUEST_HEADER_FORMAT = "!LHHQQL"
+NBD_REQUEST_HEADER_STRUCT = Struct(NBD_REQUEST_HEADER_FORMAT)
 NBD_REQUEST_HEADER_SIZE = 28
 
 NBD_REPLY_HEADER_FORMAT = "!LLQ"
+NBD_REPLY_HEADER_STRUCT = Struct(NBD_REPLY_HEADER_FORMAT)
 NBD_REPLY_HEADER_SIZE = 16
 
 NBD_CHUNK_SIZE = SECTOR_SIZE*1024
+NBD_MAX_ZEROES_REQUEST_SIZE = 1024*1024*1024
+NBD_DEFAULT_INFLIGHT = 64
+NBD_DEFAULT_RETRIES = 0
+NBD_HTTP_REPLY_MAX_SIZE = 4096
+NBD_MIN_REQUEST_SIZE = 64*1024
+NBD_DEFAULT_MAX_REQUEST_SIZE = 4*1024*1024
+NBD_COALESCE_ZERO_GAP = 64*1024
+NBD_ADAPT_INTERVAL = 0.25
+NBD_RECEIVE_SIZE = 256*1024
+NBD_JOIN_PAYLOAD_SIZE = 16*1024
+NBD_EXPORT_BATCH_SIZE = 32*1024*1024
+NBD_META_CONTEXT_BASE_ALLOCATION = "base:allocation"
 
 _nbd_negotiation_init_passwd_        = 0
 _nbd_negotiation_cliserver_magic_    = 1
@@ -197,6 +294,31 @@ NBD_CMD_WRITE_ZEROES    = 6
 NBD_CMD_BLOCK_STATUS    = 7 # Defined by the experimental BLOCK_STATUS extension.
 NBD_CMD_RESIZE          = 8 # Defined by the experimental RESIZEextension.
 
+#NBD Options
+NBD_OPT_EXPORT_NAME         = 1
+NBD_OPT_GO                  = 7
+NBD_OPT_STRUCTURED_REPLY    = 8
+NBD_OPT_SET_META_CONTEXT    = 10
+
+#NBD Option reply types
+NBD_REP_ACK             = 1
+NBD_REP_INFO            = 3
+NBD_REP_META_CONTEXT    = 4
+NBD_REP_FLAG_ERROR      = 1 << 31
+NBD_INFO_EXPORT         = 0
+
+#NBD Structured reply chunk types and flags
+NBD_REPLY_FLAG_DONE         = 1
+NBD_REPLY_TYPE_NONE         = 0
+NBD_REPLY_TYPE_OFFSET_DATA  = 1
+NBD_REPLY_TYPE_OFFSET_HOLE  = 2
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR_BIT    = 1 << 15
+
+#NBD base:allocation block status flags
+NBD_STATE_HOLE  = 1
+NBD_STATE_ZERO  = 2
+
 #NBD Error values
 EPERM       = 1   # Operation not permitted.
 EIO         = 5   # Input/output error.
@@ -217,6 +339,27 @@ _nbd_reply_magic_  = 0
 _nbd_reply_error_  = 1
 _nbd_reply_handle_ = 2
 
+_nbd_structured_reply_magic_  = 0
+_nbd_structured_reply_flags_  = 1
+_nbd_structured_reply_type_   = 2
+_nbd_structured_reply_handle_ = 3
+_nbd_structured_reply_length_ = 4
+
+_nbd_option_reply_magic_  = 0
+_nbd_option_reply_option_ = 1
+_nbd_option_reply_type_   = 2
+_nbd_option_reply_length_ = 3
+
+#-- NBD TRACKED REQUEST FIELDs --#
+_nbd_tracked_sock_      = 0
+_nbd_tracked_type_      = 1
+_nbd_tracked_offset_    = 2
+_nbd_tracked_length_    = 3
+_nbd_tracked_data_      = 4
+_nbd_tracked_attempts_  = 5
+_nbd_tracked_sent_      = 6
+#-- NBD TRACKED REQUEST FIELDs --#
+
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
 def hexdump(s):
     return "".join("{:02x}".format(ord(c)) for c in s)
@@ -260,11 +403,7 @@ def modTupleByIndex(tup, index, ins):
     return tuple(tup[0:index]) + (ins,) + tuple(tup[index+1:])
 
 def checksum(vhd_record):
-    checksum = 0
-    b = bytearray()
-    b.extend(vhd_record)
-    for index in range(len(vhd_record)):
-        checksum += b[index]
+    checksum = sum(bytearray(vhd_record))
     checksum = ~checksum + 2**32
     return checksum
 
@@ -281,68 +420,144 @@ def get_bitmap_size(dynamic_disk_header):
     return get_size_aligned_to_sector_boundary(bitmap_size)
 
 def gen_empty_bitarray_for_bitmap(bitmap_size):
-    bitarray = []
-    for bitmap_index in range(bitmap_size):
-        for bit_index in range(8):
-            bitarray.append(0)
-    return bitarray
+    # Sector bitmaps are kept packed, in the on-disk VHD layout (sector 0 is the MSB of byte 0)
+    return bytearray(bitmap_size)
 
 def gen_bitmap_from_bitarray(bitarray):
-    _bytearray_ = {}
-    bitmap = ''
-    for bitarray_index in range(len(bitarray)):
-        bit = 0
-        byte_index = bitarray_index//8
-        bit_in_byte = bitarray_index%8
-        if bitarray[bitarray_index] == 1:
-            bit = 128 >> bit_in_byte
-        if _bytearray_.has_key(byte_index):
-            _bytearray_[byte_index] = _bytearray_[byte_index] | bit
-        else:
-            _bytearray_[byte_index] = bit
-    for byte_index in range(len(_bytearray_)):
-        bitmap = bitmap + pack('!c', chr(_bytearray_[byte_index]))
-    return bitmap
+    return str(bitarray)
 
 def get_bitarray_from_bitmap(bitmap, bitmap_size):
-    bitarray = []
-    _bitmap_ = bytearray()
-    _bitmap_.extend(bitmap)
-    for bitmap_index in range(bitmap_size):
-        for bit_index in range(8):
-            offset = 128 >> bit_index
-            if (_bitmap_[bitmap_index] & offset) > 0:
-                bitarray.append(1)
-            else:
-                bitarray.append(0)
-    return bitarray
+    return bytearray(bitmap[0:bitmap_size])
+
+def bitmap_range_masks(first, count):
+    last = first + count - 1
+    return (first >> 3, last >> 3, 0xff >> (first & 7), (0xff << (7 - (last & 7))) & 0xff)
+
+def bitmap_set_range(bitarray, first, count):
+    if count <= 0:
+        return
+    (first_byte, last_byte, head_mask, tail_mask) = bitmap_range_masks(first, count)
+    if first_byte == last_byte:
+        bitarray[first_byte] |= head_mask & tail_mask
+    else:
+        bitarray[first_byte] |= head_mask
+        if last_byte - first_byte > 1:
+            bitarray[first_byte+1:last_byte] = '\xff' * (last_byte - first_byte - 1)
+        bitarray[last_byte] |= tail_mask
+
+def bitmap_test_range(bitarray, first, count):
+    # True if every sector of the range is marked in the bitmap
+    if count <= 0:
+        return True
+    (first_byte, last_byte, head_mask, tail_mask) = bitmap_range_masks(first, count)
+    if first_byte == last_byte:
+        return (bitarray[first_byte] & head_mask & tail_mask) == (head_mask & tail_mask)
+    if (bitarray[first_byte] & head_mask) != head_mask:
+        return False
+    if (bitarray[last_byte] & tail_mask) != tail_mask:
+        return False
+    return bitarray[first_byte+1:last_byte] == '\xff' * (last_byte - first_byte - 1)
+
+def bitmap_test(bitarray, index):
+    return (bitarray[index >> 3] & (128 >> (index & 7))) != 0
+
+BITMAP_NONEMPTY_BYTE_RE = re.compile('[^\x00]')
+BITMAP_NONFULL_BYTE_RE = re.compile('[^\xff]')
+BITMAP_FIRST_SET_BIT = [8] + [7 - len(bin(byte)) + 3 for byte in range(1, 256)]
+
+def get_bitmap_extents(bitarray, sectors):
+    # Yields (first_sector, sector_count) for every run of marked sectors.
+    # Runs of 0x00 and 0xff bytes are skipped with a single regex search.
+    bitmap_bytes = (sectors + 7) >> 3
+    sector = 0
+    while sector < sectors:
+        byte_index = sector >> 3
+        byte = bitarray[byte_index] & (0xff >> (sector & 7))
+        if byte == 0:
+            match = BITMAP_NONEMPTY_BYTE_RE.search(bitarray, byte_index+1, bitmap_bytes)
+            if match is None:
+                return
+            byte_index = match.start()
+            byte = bitarray[byte_index]
+        first_sector = (byte_index << 3) + BITMAP_FIRST_SET_BIT[byte]
+        if first_sector >= sectors:
+            return
+
+        byte_index = first_sector >> 3
+        byte = ~bitarray[byte_index] & (0xff >> (first_sector & 7))
+        if byte == 0:
+            match = BITMAP_NONFULL_BYTE_RE.search(bitarray, byte_index+1, bitmap_bytes)
+            if match is None:
+                yield (first_sector, sectors - first_sector)
+                return
+            byte_index = match.start()
+            byte = ~bitarray[byte_index] & 0xff
+        sector = min((byte_index << 3) + BITMAP_FIRST_SET_BIT[byte], sectors)
+        yield (first_sector, sector - first_sector)
 
 def gen_empty_vhd_bat(image_size):
-    bat_list = []
     max_tab_entries = image_size / VHD_DEFAULT_BLOCK_SIZE
-    for bat_index in range(max_tab_entries):
-        bat_list.append(0xffffffff)
-    return bat_list
+    return array.array(VHD_BAT_TYPECODE, [VHD_BAT_UNUSED_ENTRY]) * max_tab_entries
 
-def gen_empty_batmap():
-    return pack("!%ds" % (SECTOR_SIZE*2), '')
+def get_batmap_size(max_tab_entries):
+    # One bit per block, rounded up to whole sectors
+    return max(get_size_aligned_to_sector_boundary((max_tab_entries + 7) // 8), SECTOR_SIZE)
 
-def gen_batmap_header(batmap):
-    reserved = ''
-    for i in range(483):
-        reserved = reserved + pack('!c', chr(0))
-    batmap_header_struct = ('tdbatmap', 0, 0, 0x00010002, 0, 0, reserved) #empty
+def gen_empty_batmap(max_tab_entries):
+    return bytearray(get_batmap_size(max_tab_entries))
+
+def gen_vhd_batmap(max_tab_entries, full_blocks):
+    # Bits (MSB first, like the sector bitmaps) of the blocks with every sector present,
+    # tapdisk doesn't read the sector bitmaps of those blocks
+    batmap = gen_empty_batmap(max_tab_entries)
+    for block_number in full_blocks:
+        bitmap_set_range(batmap, block_number, 1)
+    return batmap
+
+def gen_batmap_header(batmap, batmap_offset):
+    batmap_header_struct = ('tdbatmap', batmap_offset, len(batmap)/SECTOR_SIZE, 0x00010002, checksum(batmap), 0, '')
     return batmap_header_struct
 
-def pack_vhd_bat(bat_list):
-    max_tab_entries = len(bat_list)
-    bat = ''
-    for bat_index in range(max_tab_entries):
-        bat = bat + pack("!I", bat_list[bat_index])
-    if max_tab_entries < SECTOR_SIZE/4:
-        bat = bat + pack("!%ds" % (SECTOR_SIZE - max_tab_entries*4), '')
+def pack_vhd_batmap(batmap, batmap_header_offset):
+    # BATMAP header followed by the map
+    batmap_header_struct = gen_batmap_header(batmap, batmap_header_offset + VHD_BATMAP_HEADER_SIZE)
+    return pack(VHD_BATMAP_HEADER_FORMAT, *batmap_header_struct) + str(batmap)
+
+def is_full_bitmap(bitarray):
+    return bitmap_test_range(bitarray, 0, VHD_DEFAULT_BLOCK_SIZE/SECTOR_SIZE)
+
+def pack_vhd_bat(bat, first=0, count=None):
+    # Big endian image of bat[first:first+count], zero padded to a sector boundary
+    if count is None:
+        count = len(bat) - first
+    entries = bat[first:first+count]
+    if len(entries) % VHD_BAT_ENTRIES_PER_SECTOR:
+        entries.extend([0] * (VHD_BAT_ENTRIES_PER_SECTOR - len(entries) % VHD_BAT_ENTRIES_PER_SECTOR))
+    if sys.byteorder == 'little':
+        entries.byteswap()
+    return entries.tostring()
+
+def unpack_vhd_bat(data):
+    bat = array.array(VHD_BAT_TYPECODE)
+    bat.fromstring(data.tobytes() if isinstance(data, memoryview) else str(data))
+    if sys.byteorder == 'little':
+        bat.byteswap()
     return bat
 
+def write_vhd_bat_sectors(VHD_FH, table_offset, bat, dirty_sectors):
+    # Rewrites only the BAT sectors holding changed entries, neighbouring sectors in one write
+    sectors = sorted(dirty_sectors)
+    index = 0
+    while index < len(sectors):
+        first = sectors[index]
+        count = 1
+        while (index + count < len(sectors)) and (sectors[index + count] == first + count):
+            count += 1
+        VHD_FH.seek(table_offset + first*SECTOR_SIZE, 0)
+        VHD_FH.write(pack_vhd_bat(bat, first*VHD_BAT_ENTRIES_PER_SECTOR, count*VHD_BAT_ENTRIES_PER_SECTOR))
+        index += count
+    return len(sectors)
+
 def gen_vhd_geometry_struct(image_size):
     totalSectors = image_size / SECTOR_SIZE
     if totalSectors > 65535*16*255:
@@ -396,20 +611,46 @@ def gen_vhd_dynamic_disk_header_struct(table_offset, image_size, checksum, paren
                     reserved)
     return dynamic_disk_header_struct
 
-def get_sector_bitmap_and_data(vhdfile, data_block_offset, block_size):
-    sectors_in_block = block_size/SECTOR_SIZE
-    bitmap_size = sectors_in_block/8
-    if bitmap_size%512>0:
-        bitmap_size=((bitmap_size//512)+1)*512
-    _format_ = "!%is%is" % (bitmap_size,block_size)
-    vhdfile.seek((data_block_offset)*512, 0)
-    BUFFER=vhdfile.read(bitmap_size+block_size)
-    bitmap_and_data=unpack(_format_,BUFFER)
-    _format_ = "!"
-    for i in range(sectors_in_block):
-        _format_ = _format_ + "512s"
-    data = unpack(_format_,bitmap_and_data[1])
-    return [bitmap_and_data[0],data]
+def get_buffer_view(obj, offset, length):
+    # Zero-copy slice. mmap objects only export the old buffer interface on python 2
+    try:
+        return memoryview(obj)[offset:offset+length]
+    except TypeError:
+        return buffer(obj, offset, length)
+
+def vhd_open(vhd):
+    VHD_FH = open(vhd, "rb")
+    try:
+        VHD_MAP = mmap.mmap(VHD_FH.fileno(), 0, access=mmap.ACCESS_READ)
+        DEBUG("VHD: File '%s' has been memory mapped" % vhd)
+    except (mmap.error, ValueError, EnvironmentError):
+        VHD_MAP = None
+        DEBUG("VHD: File '%s' can't be memory mapped, falling back to positional reads" % vhd)
+    return (VHD_FH, VHD_MAP)
+
+def vhd_close(VHD):
+    (VHD_FH, VHD_MAP) = VHD
+    if VHD_MAP is not None:
+        VHD_MAP.close()
+    VHD_FH.close()
+
+def vhd_read(VHD, offset, length):
+    # Returns a read-only view of `length` bytes at `offset`. The view stays valid
+    # until the VHD is closed, so callers may keep views of several blocks.
+    (VHD_FH, VHD_MAP) = VHD
+    if VHD_MAP is not None:
+        return get_buffer_view(VHD_MAP, offset, length)
+    _buffer_ = bytearray(length)
+    if hasattr(os, "preadv"):
+        read_bytes = os.preadv(VHD_FH.fileno(), [_buffer_], offset)
+    else:
+        VHD_FH.seek(offset, 0)
+        read_bytes = VHD_FH.readinto(_buffer_)
+    return memoryview(_buffer_)[0:read_bytes]
+
+def vhd_read_block(VHD, bat_entry, block_size, bitmap_size):
+    bitmap_and_data = vhd_read(VHD, bat_entry*SECTOR_SIZE, bitmap_size+block_size)
+    return (get_buffer_view(bitmap_and_data, 0, bitmap_size), get_buffer_view(bitmap_and_data, bitmap_size, block_size))
 
 def get_raw_byte_offset_of_sector(block_number, sector_in_block, block_size, sector_size):
     return block_number*block_size+sector_in_block*sector_size
@@ -418,19 +659,274 @@ def get_raw_sector_offset_of_sector(block_number, sector_in_block, block_size, s
     sector_per_block = block_size / sector_size
     return block_number*sector_per_block+sector_in_block
 
-def nbd_close_channel(sock, handle):
-    INFO("NBD: Going to send disconnect request with handle %d" % handle)
-    flags = 0
-    request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_DISC, handle, 0, 0)
-    DEBUG("NBD: Request header: %s" % hexdump(request_header))
-    while True:
-        ready = select.select([],[sock],[])
-        if ready[1]:
-            DEBUG("NBD: Socket ready for writing")
+def rbd_diff_open(rbd):
+    # Unbuffered raw handles: rbd_diff_records() does its own large reads
+    if rbd == "-":
+        return io.open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    else:
+        return io.open(rbd, "rb", buffering=0)
+
+def rbd_diff_fill(RBDDIFF_FH, buf, view, start, end, need):
+    # Make sure that at least `need` bytes are available in buf[start:end].
+    # Returns (start, end, shift) where shift is how far the data has been moved
+    # to the beginning of the buffer to make room for the next read.
+    shift = 0
+    if end - start >= need:
+        return (start, end, shift)
+    if start + need > len(buf):
+        buf[0:end-start] = buf[start:end]
+        shift = start
+        end -= start
+        start = 0
+    while end - start < need:
+        read_bytes = RBDDIFF_FH.readinto(view[end:])
+        if not read_bytes:
             break
+        end += read_bytes
+    return (start, end, shift)
+
+def rbd_diff_records(RBDDIFF_FH, buffer_size=RBD_DIFF_READ_BUFFER_SIZE, skip_data=False, resume_position=0):
+    # Yields (tag, offset, length, data, position) tuples, see _rbd_record_*_.
+    # Payload of `w` records is a memoryview into the reusable read buffer which is
+    # valid only until the next record is requested. Payloads larger than the buffer
+    # are yielded as several contiguous, sector aligned `w` records.
+    # With skip_data the payloads of a seekable diff are seeked over and `w` records carry None,
+    # a small buffer_size then keeps the reads close to the record headers.
+    # With resume_position (a record position of a seekable diff) the snap and size records are
+    # read as usual and the diff is then seeked to the record at resume_position.
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    base = 0
+    (start, end, shift) = rbd_diff_fill(RBDDIFF_FH, buf, view, 0, 0, len(RBD_HEADER))
+    if buf[0:len(RBD_HEADER)] != RBD_HEADER:
+        ERROR("RBD: Bad rbd diff header")
+        sys.exit(2)
+    start += len(RBD_HEADER)
+
+    while True:
+        (start, end, shift) = rbd_diff_fill(RBDDIFF_FH, buf, view, start, end, RBD_DIFF_META_RECORD_TAG_SIZE+RBD_DIFF_DATA_SIZE)
+        base += shift
+        if start == end:
+            INFO("RBD: Unexpected EOF")
+            return
+        position = base + start
+        record_tag = chr(buf[start])
+        if (position < resume_position) & ((record_tag == RBD_DIFF_RECORD_DATA) | (record_tag == RBD_DIFF_RECORD_ZERO)):
+            INFO("RBD: Resuming at position %d" % resume_position)
+            RBDDIFF_FH.seek(resume_position, 0)
+            base = resume_position
+            start = end = 0
+            resume_position = 0
+            continue
+        start += RBD_DIFF_META_RECORD_TAG_SIZE
+
+        if record_tag == RBD_DIFF_RECORD_DATA:
+            if end - start < RBD_DIFF_DATA_SIZE:
+                break
+            (offset, length) = RBD_DIFF_DATA_STRUCT.unpack_from(buf, start)
+            start += RBD_DIFF_DATA_SIZE
+            if skip_data:
+                buffered = min(length, end - start)
+                if buffered < length:
+                    RBDDIFF_FH.seek(length - buffered, 1)
+                    base += end + length - buffered
+                    start = end = 0
+                else:
+                    start += length
+                yield (record_tag, offset, length, None, position)
+                continue
+            while length > 0:
+                if end - start < min(length, SECTOR_SIZE):
+                    (start, end, shift) = rbd_diff_fill(RBDDIFF_FH, buf, view, start, end, min(length, buffer_size))
+                    base += shift
+                    if end - start < min(length, SECTOR_SIZE):
+                        ERROR("RBD: Truncated data record at offset 0x%08x" % offset)
+                        sys.exit(2)
+                chunk = min(length, end - start)
+                if chunk < length:
+                    chunk -= chunk % SECTOR_SIZE
+                yield (record_tag, offset, chunk, view[start:start+chunk], position)
+                start += chunk
+                offset += chunk
+                length -= chunk
+        elif record_tag == RBD_DIFF_RECORD_ZERO:
+            if end - start < RBD_DIFF_DATA_SIZE:
+                break
+            (offset, length) = RBD_DIFF_DATA_STRUCT.unpack_from(buf, start)
+            start += RBD_DIFF_DATA_SIZE
+            yield (record_tag, offset, length, None, position)
+        elif record_tag == RBD_DIFF_RECORD_SIZE:
+            if end - start < RBD_DIFF_META_SIZE_SIZE:
+                break
+            image_size = RBD_DIFF_SIZE_STRUCT.unpack_from(buf, start)[0]
+            start += RBD_DIFF_META_SIZE_SIZE
+            yield (record_tag, 0, image_size, None, position)
+        elif (record_tag == RBD_DIFF_RECORD_FROM_SNAP) or (record_tag == RBD_DIFF_RECORD_TO_SNAP):
+            if end - start < RBD_DIFF_META_SNAP_SIZE:
+                break
+            snap_name_length = RBD_DIFF_SNAP_STRUCT.unpack_from(buf, start)[0]
+            start += RBD_DIFF_META_SNAP_SIZE
+            (start, end, shift) = rbd_diff_fill(RBDDIFF_FH, buf, view, start, end, snap_name_length)
+            base += shift
+            if end - start < snap_name_length:
+                break
+            snap_name = view[start:start+snap_name_length].tobytes()
+            start += snap_name_length
+            yield (record_tag, 0, snap_name_length, snap_name, position)
+        elif record_tag == RBD_DIFF_RECORD_END:
+            yield (record_tag, 0, 0, None, position)
+            return
         else:
-            DEBUG("NBD: Socket isn't ready for writing")
+            ERROR("RBD: Error while reading rbd_diff file, unknown record tag 0x%02x" % ord(record_tag))
+            sys.exit(2)
+
+    ERROR("RBD: Truncated record \'%c\' at position %d" % (record_tag, position))
+    sys.exit(2)
+
+def get_libc_fallocate():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    for name in ("fallocate64", "fallocate"):
+        if hasattr(libc, name):
+            _fallocate_ = getattr(libc, name)
+            _fallocate_.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            _fallocate_.restype = ctypes.c_int
+            return _fallocate_
+    return None
+
+libc_fallocate = get_libc_fallocate()
+
+def raw_pwrite(RAW_FH, offset, data):
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(RAW_FH.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        RAW_FH.seek(offset, 0)
+        RAW_FH.write(data)
+
+def raw_write_zeros(RAW_FH, offset, length):
+    while length > 0:
+        chunk = min(length, ZERO_CHUNK_SIZE)
+        raw_pwrite(RAW_FH, offset, get_buffer_view(ZERO_CHUNK, 0, chunk))
+        offset += chunk
+        length -= chunk
+
+def raw_punch_hole(RAW_FH, offset, length):
+    # Deallocates (or at least zeroes) the range without writing data, falls back to writing zeros
+    if libc_fallocate is not None:
+        for mode in (FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE):
+            if libc_fallocate(RAW_FH.fileno(), mode, offset, length) == 0:
+                return True
+        DEBUG("RAW: fallocate failed with errno %d, writing zeros" % ctypes.get_errno())
+    raw_write_zeros(RAW_FH, offset, length)
+    return False
+
+def rbd_diff_create(rbd):
+    if rbd == "-":
+        return io.open(sys.stdout.fileno(), "wb", closefd=False)
+    else:
+        return io.open(rbd, "wb")
+
+def rbd_diff_write_data(RBDDIFF_FH, offset, length, chunks):
+    RBDDIFF_FH.write(RBD_DIFF_DATA_RECORD_STRUCT.pack(RBD_DIFF_RECORD_DATA, offset, length))
+    for chunk in chunks:
+        RBDDIFF_FH.write(chunk)
+
+def rbd_diff_write_zero(RBDDIFF_FH, offset, length):
+    RBDDIFF_FH.write(RBD_DIFF_DATA_RECORD_STRUCT.pack(RBD_DIFF_RECORD_ZERO, offset, length))
+
+def rbd_diff_write_snap(RBDDIFF_FH, record_tag, snap_name):
+    RBDDIFF_FH.write(pack("%s%s%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG, RBD_DIFF_META_SNAP, len(snap_name)), record_tag, len(snap_name), snap_name))
+
+def get_data_view(data, offset, length):
+    if isinstance(data, memoryview):
+        return data[offset:offset+length]
+    else:
+        return buffer(data, offset, length)
+
+def is_zero_data(data, offset, length):
+    # Both sides are compared with memcmp, views of the same kind are required for that
+    while length > 0:
+        chunk = min(length, ZERO_CHUNK_SIZE)
+        if isinstance(data, memoryview):
+            if data[offset:offset+chunk] != memoryview(ZERO_CHUNK)[0:chunk]:
+                return False
+        elif buffer(data, offset, chunk) != buffer(ZERO_CHUNK, 0, chunk):
+            return False
+        offset += chunk
+        length -= chunk
+    return True
+
+class ZeroDetector(object):
+    # Splits data into runs of zero and non-zero ZERO_DETECT_SIZE units aligned to the image offset,
+    # so that zeroed data can be turned into holes, unallocated blocks, write zeroes requests or `z` records
+
+    def __init__(self):
+        self.elided_bytes = 0
+
+    def runs(self, data, offset, length):
+        # yields (run_offset, run_length, is_zero) with run_offset relative to the data
+        if not isinstance(data, (memoryview, buffer)):
+            data = memoryview(data)
+        if is_zero_data(data, 0, length):
+            self.elided_bytes += length
+            yield (0, length, True)
+            return
+        run_offset = 0
+        run_zero = False
+        position = 0
+        while position < length:
+            unit = min(ZERO_DETECT_SIZE - (offset + position) % ZERO_DETECT_SIZE, length - position)
+            unit_zero = is_zero_data(data, position, unit)
+            if unit_zero != run_zero:
+                if position > run_offset:
+                    yield (run_offset, position - run_offset, run_zero)
+                run_offset = position
+                run_zero = unit_zero
+            if unit_zero:
+                self.elided_bytes += unit
+            position += unit
+        yield (run_offset, length - run_offset, run_zero)
+
+    def records(self, records):
+        # Splits `w` records of a parsed RBD diff into `w` and `z` records
+        for record in records:
+            if record[_rbd_record_tag_] != RBD_DIFF_RECORD_DATA:
+                yield record
+                continue
+            offset = record[_rbd_record_offset_]
+            data = record[_rbd_record_data_]
+            for (run_offset, run_length, run_zero) in self.runs(data, offset, record[_rbd_record_length_]):
+                if run_zero:
+                    DEBUG("ZERO: Zero data offset = 0x%08x and length = %d" % (offset+run_offset, run_length))
+                    yield (RBD_DIFF_RECORD_ZERO, offset+run_offset, run_length, None, record[_rbd_record_position_])
+                else:
+                    yield (RBD_DIFF_RECORD_DATA, offset+run_offset, run_length, get_data_view(data, run_offset, run_length), record[_rbd_record_position_])
+
+    def report(self):
+        INFO("ZERO: %d bytes of zero data elided" % self.elided_bytes)
+
+def nbd_recv_exact(sock, length):
+    # socket.recv() may return less than asked for, a reply header must never be split
+    _buffer_ = bytearray(length)
+    view = memoryview(_buffer_)
+    received = 0
+    while received < length:
+        read_bytes = sock.recv_into(view[received:], length - received)
+        if not read_bytes:
+            raise EnvironmentError("NBD: Connection closed by server after %d of %d bytes" % (received, length))
+        received += read_bytes
+    return _buffer_
 
+def nbd_close_channel(sock, handle):
+    INFO("NBD: Going to send disconnect request with handle %d" % handle)
+    request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, 0, NBD_CMD_DISC, handle, 0, 0)
+    DEBUG("NBD: Request header: %s" % hexdump(request_header))
     sock.sendall(request_header)
     INFO("NBD: Disconnect request has been sent")
     sock.close()
@@ -449,6 +945,9 @@ def nbd_open_channel(uri):
 
     if (proto == 'http'):
         port = 80
+        if ':' in server:
+            (server, port) = server.rsplit(':', 1)
+            port = int(port)
     else:
         ERROR("NBD: Unsupported protocol '%s'" % proto)
         sys.exit(3)
@@ -459,31 +958,32 @@ def nbd_open_channel(uri):
     # Connect the socket to the port on server
     INFO("NBD: Going to connect to server %s port %s" % (server, port))
     sock.connect((server, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     DEBUG("NBD: Going to send HTTP PUT request")
 
-    while True:
-        ready = select.select([],[sock],[])
-        if ready[1]:
-            DEBUG("NBD: Socket ready for writing")
-            break
-        else:
-            DEBUG("NBD: Socket isn't ready for writing")
-
     #eprint("PUT /services/SM/nbd/%s/%s/%s?session_id=OpaqueRef%%3a%s HTTP/1.1\r\nHost: %s\r\n\r\n" % (sr_uuid, vdi_uuid, dp_uuid, session_id, server))
 
     sock.sendall("PUT /services/SM/nbd/%s/%s/%s?session_id=OpaqueRef%%3a%s HTTP/1.1\r\nHost: %s\r\n\r\n" % (sr_uuid, vdi_uuid, dp_uuid, session_id, server))
     DEBUG("NBD: Waiting for reply")
 
+    # The negotiation may follow the HTTP reply in the same segment, so only the reply itself is consumed
+    reply = ""
     while True:
-        ready = select.select([sock],[],[])
-        if ready[0]:
-            DEBUG("NBD: Socket ready for reading")
+        peeked = sock.recv(NBD_HTTP_REPLY_MAX_SIZE, socket.MSG_PEEK)
+        if not peeked:
+            ERROR("NBD: Connection closed while waiting for HTTP response")
+            sock.close()
+            sys.exit(4)
+        end = (reply + peeked).find("\r\n\r\n")
+        if end >= 0:
+            reply += str(nbd_recv_exact(sock, end + 4 - len(reply)))
             break
-        else:
-            DEBUG("NBD: Socket isn't ready for reading")
-
-    reply = sock.recv(102)
+        reply += str(nbd_recv_exact(sock, len(peeked)))
+        if len(reply) > NBD_HTTP_REPLY_MAX_SIZE:
+            ERROR("NBD: Invalid HTTP response %s" % reply)
+            sock.close()
+            sys.exit(4)
     DEBUG("NBD: Reply has been received")
     #eprint(reply)
 
@@ -501,160 +1001,567 @@ def nbd_open_channel(uri):
 
     DEBUG("NBD: Server has been connected")
 
-def nbd_negotiate(sock):
-    INFO("NBD: Negotiation has been started")
-
-    while True:
-        ready = select.select([sock],[],[])
-        if ready[0]:
-            DEBUG("NBD: Socket ready for reading")
-            break
+def nbd_open_channels(uri, connections, block_status=False):
+    # Opens `connections` channels to the same export if the server allows it
+    socks = []
+    while len(socks) < connections:
+        (sock, encoding) = nbd_open_channel(uri)
+        if (encoding != 'nbd'):
+            ERROR("NBD: Unsupported encoding `%s`" % encoding)
+            nbd_close_channel(sock, 0)
+            for sock in socks:
+                nbd_close_channel(sock, 0)
+            sys.exit(5)
         else:
-            DEBUG("NBD: Socket isn't ready for reading")
+            INFO("NBD: Encoding: `%s`" % encoding)
+        (nbd_size, nbd_trans_flags, nbd_meta_context) = nbd_negotiate(sock, block_status)
+        socks.append(sock)
+        if not (nbd_trans_flags & NBD_FLAG_CAN_MULTI_CONN):
+            if connections > 1:
+                INFO("NBD: Server doesn't support multiple connections, using a single one")
+            break
+    INFO("NBD: %d connection(s) opened" % len(socks))
+    return (socks, nbd_size, nbd_trans_flags, nbd_meta_context)
 
-    reply = sock.recv(NBD_NEGOTIATION_SIZE+1)
-    negotiate_reply = unpack(NBD_NEGOTIATION_FORMAT, reply)
-    DEBUG("NBD: Negotiation reply size = %d" % len(reply))
-    DEBUG("NBD: Size = %d" % negotiate_reply[_nbd_negotiation_export_size_])
-    DEBUG("NBD: Init_passwd = %s" % negotiate_reply[_nbd_negotiation_init_passwd_])
-    DEBUG("NBD: Magic = 0x%016x" % negotiate_reply[_nbd_negotiation_cliserver_magic_])
-    DEBUG("NBD: Handshake flags = 0x%08x" % negotiate_reply[_nbd_negotiation_handshake_flags_])
-    DEBUG("NBD: Transmission flags = 0x%08x" % negotiate_reply[_nbd_negotiation_transmission_flags_])
+def nbd_negotiate(sock, block_status=False):
+    # Returns (export size, transmission flags, base:allocation context id or None)
+    INFO("NBD: Negotiation has been started")
 
-    if (negotiate_reply[_nbd_negotiation_init_passwd_] != NBD_INIT_PASSWD):
+    reply = str(nbd_recv_exact(sock, NBD_NEGOTIATION_MAGIC_SIZE))
+    (init_passwd, magic) = unpack(NBD_NEGOTIATION_MAGIC_FORMAT, reply)
+    DEBUG("NBD: Init_passwd = %s" % init_passwd)
+    DEBUG("NBD: Magic = 0x%016x" % magic)
+
+    if (init_passwd != NBD_INIT_PASSWD):
         ERROR("NBD: Bad magic in negotiate")
         sock.close()
         sys.exit(6)
 
-    if (negotiate_reply[_nbd_negotiation_cliserver_magic_] != NBD_CLISERVER_MAGIC):
+    if (magic == NBD_OPTS_MAGIC):
+        return nbd_negotiate_newstyle(sock, block_status)
+
+    if (magic != NBD_CLISERVER_MAGIC):
         ERROR("NBD: Bad cliserver magic in negotiate")
         sock.close()
         sys.exit(7)
 
+    reply += str(nbd_recv_exact(sock, NBD_NEGOTIATION_SIZE - NBD_NEGOTIATION_MAGIC_SIZE))
+    negotiate_reply = unpack(NBD_NEGOTIATION_FORMAT, reply)
+    DEBUG("NBD: Negotiation reply size = %d" % len(reply))
+    DEBUG("NBD: Size = %d" % negotiate_reply[_nbd_negotiation_export_size_])
+    DEBUG("NBD: Handshake flags = 0x%08x" % negotiate_reply[_nbd_negotiation_handshake_flags_])
+    DEBUG("NBD: Transmission flags = 0x%08x" % negotiate_reply[_nbd_negotiation_transmission_flags_])
+
     INFO("NBD: Negotiation has been finished")
 
-    return (negotiate_reply[_nbd_negotiation_export_size_], negotiate_reply[_nbd_negotiation_transmission_flags_])
+    return (negotiate_reply[_nbd_negotiation_export_size_], negotiate_reply[_nbd_negotiation_transmission_flags_], None)
 
-def nbd_send_write(sock, handle, request_handles, offset, length, data):
-    INFO("NBD: Going to send write data request(s) with handle %d" % handle)
-    DEBUG("NBD: Length from rbd = %d, length of data to send = %d" % (length, len(data)))
-    flags = 0
-    buffer_offset = 0
-    while length > 0:
-        DEBUG("NBD: Going to send request with handle = %d" % handle)
-        if length >= NBD_CHUNK_SIZE:
-            _buffer_ = data[buffer_offset:buffer_offset+NBD_CHUNK_SIZE]
-            request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_WRITE, handle, offset+buffer_offset, NBD_CHUNK_SIZE)
-            DEBUG("NBD: buffer_offset = %d, offset = %d, length = %d, calculated length of data to send = %d,length of _buffer_ %d" % (buffer_offset, offset, length, NBD_CHUNK_SIZE, len(_buffer_)))
-        else:
-            _buffer_ = data[buffer_offset:]
-            request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_WRITE, handle, offset+buffer_offset, length)
-            DEBUG("NBD: buffer_offset = %d, offset = %d, length = %d, calculated length of data to send = %d,length of _buffer_ %d" % (buffer_offset, offset, length, length, len(_buffer_)))
+def nbd_send_option(sock, option, data):
+    sock.sendall(pack(NBD_OPTION_HEADER_FORMAT, NBD_OPTS_MAGIC, option, len(data)) + data)
 
-        DEBUG("NBD: Request header: %s" % hexdump(request_header))
-        while True:
-            ready = select.select([],[sock],[])
-            if ready[1]:
-                DEBUG("NBD: Socket ready for writing request header")
-                break
-            else:
-                DEBUG("NBD: Socket isn't ready for writing request header")
-        sock.sendall(request_header)
+def nbd_receive_option_reply(sock, option):
+    reply = unpack(NBD_OPTION_REPLY_HEADER_FORMAT, str(nbd_recv_exact(sock, NBD_OPTION_REPLY_HEADER_SIZE)))
+    if (reply[_nbd_option_reply_magic_] != NBD_REP_MAGIC) | (reply[_nbd_option_reply_option_] != option):
+        ERROR("NBD: Bad option reply in negotiate")
+        sock.close()
+        sys.exit(7)
+    data = str(nbd_recv_exact(sock, reply[_nbd_option_reply_length_]))
+    DEBUG("NBD: Option %d reply type 0x%08x, %d bytes" % (option, reply[_nbd_option_reply_type_], len(data)))
+    return (reply[_nbd_option_reply_type_], data)
+
+def nbd_negotiate_newstyle(sock, block_status):
+    (handshake_flags,) = unpack("!H", str(nbd_recv_exact(sock, 2)))
+    DEBUG("NBD: Handshake flags = 0x%04x" % handshake_flags)
+    client_flags = handshake_flags & (NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+    sock.sendall(pack("!L", client_flags))
+
+    export_name = ""
+    meta_context = None
+    export_size = None
+
+    if (handshake_flags & NBD_FLAG_FIXED_NEWSTYLE) & block_status:
+        # Block status replies are structured, so both have to be agreed on
+        nbd_send_option(sock, NBD_OPT_STRUCTURED_REPLY, "")
+        (reply_type, data) = nbd_receive_option_reply(sock, NBD_OPT_STRUCTURED_REPLY)
+        if reply_type == NBD_REP_ACK:
+            nbd_send_option(sock, NBD_OPT_SET_META_CONTEXT, pack("!L%dsLL%ds" % (len(export_name), len(NBD_META_CONTEXT_BASE_ALLOCATION)),
+                            len(export_name), export_name, 1, len(NBD_META_CONTEXT_BASE_ALLOCATION), NBD_META_CONTEXT_BASE_ALLOCATION))
+            while True:
+                (reply_type, data) = nbd_receive_option_reply(sock, NBD_OPT_SET_META_CONTEXT)
+                if reply_type == NBD_REP_META_CONTEXT:
+                    (context_id,) = unpack_from("!L", data)
+                    if data[4:] == NBD_META_CONTEXT_BASE_ALLOCATION:
+                        meta_context = context_id
+                elif (reply_type == NBD_REP_ACK) | ((reply_type & NBD_REP_FLAG_ERROR) != 0):
+                    break
+        INFO("NBD: Block status context: %s" % meta_context)
 
-        INFO("NBD: Going to send body for request with handle %d" % handle)
+    if (handshake_flags & NBD_FLAG_FIXED_NEWSTYLE):
+        nbd_send_option(sock, NBD_OPT_GO, pack("!L%dsH" % len(export_name), len(export_name), export_name, 0))
         while True:
-            ready = select.select([],[sock],[])
-            if ready[1]:
-                DEBUG("NBD: Socket ready for writing body")
+            (reply_type, data) = nbd_receive_option_reply(sock, NBD_OPT_GO)
+            if (reply_type == NBD_REP_INFO) and (unpack_from("!H", data)[0] == NBD_INFO_EXPORT):
+                (export_size, transmission_flags) = unpack_from("!QH", data, 2)
+            elif reply_type == NBD_REP_ACK:
+                break
+            elif (reply_type & NBD_REP_FLAG_ERROR) != 0:
+                DEBUG("NBD: NBD_OPT_GO isn't supported, falling back to NBD_OPT_EXPORT_NAME")
                 break
-            else:
-                DEBUG("NBD: Socket isn't ready for writing body")
-        sock.sendall(_buffer_)
-        INFO("NBD: Write data request with handle %d has been sent" % handle)
 
-        buffer_offset += NBD_CHUNK_SIZE
-        length -= NBD_CHUNK_SIZE
-        request_handles[handle] = True
-        handle += 1
+    if export_size is None:
+        nbd_send_option(sock, NBD_OPT_EXPORT_NAME, export_name)
+        (export_size, transmission_flags) = unpack(NBD_EXPORT_NAME_REPLY_FORMAT, str(nbd_recv_exact(sock, NBD_EXPORT_NAME_REPLY_SIZE)))
+        if not (client_flags & NBD_FLAG_NO_ZEROES):
+            nbd_recv_exact(sock, 124)
 
-    return (handle, request_handles)
+    DEBUG("NBD: Size = %d" % export_size)
+    DEBUG("NBD: Transmission flags = 0x%08x" % transmission_flags)
+    INFO("NBD: Negotiation has been finished")
 
-def nbd_send_write_zeros(sock, handle, offset, length):
-    INFO("NBD: Going to send write zeros request with handle %d" % handle)
-    flags = 0
-    request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_WRITE_ZEROES, handle, offset, length)
-    DEBUG("NBD: Request header: %s" % hexdump(request_header))
-    while True:
-        ready = select.select([],[sock],[])
-        if ready[1]:
-            DEBUG("NBD: Socket ready for writing request header")
-            break
+    return (export_size, transmission_flags, meta_context)
+
+def get_percentile(sorted_values, percent):
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values)-1, (len(sorted_values)*percent)//100)]
+
+class NBDRequestTracker(object):
+    # Bookkeeping of in-flight NBD requests: bounds the number of outstanding requests,
+    # hands failed requests back for a retry and collects request-to-reply latencies.
+
+    def __init__(self, window=NBD_DEFAULT_INFLIGHT, retries=NBD_DEFAULT_RETRIES):
+        self.window = window
+        self.retries = retries
+        self.requests = {}
+        self.retry_queue = []
+        self.error = None
+        self.latencies = array.array('d')
+        self.completed_bytes = 0
+
+    def register(self, handle, sock, request_type, offset, length, data, attempts=0):
+        if (self.retries > 0) & (data is not None):
+            # The payload is a view of a reused buffer, keep a copy for a possible resend
+            data = bytearray(data)
         else:
-            DEBUG("NBD: Socket isn't ready for writing request header")
-
-    sock.sendall(request_header)
-    INFO("NBD: Wrire zeros request with handle %d has been sent" % handle)
-
-def nbd_send_read(sock, handle, offset, length):
-    INFO("NBD: Going to send read request with handle %d" % handle)
-    flags = 0
-    request_header = pack(NBD_REQUEST_HEADER_FORMAT, NBD_REQUEST_MAGIC, flags, NBD_CMD_READ, handle, offset, length)
-    DEBUG("NBD: Request header: %s" % hexdump(request_header))
-    while True:
-        ready = select.select([],[sock],[])
-        if ready[1]:
-            DEBUG("NBD: Socket ready for writing")
-            break
+            data = None
+        self.requests[handle] = [sock, request_type, offset, length, data, attempts, time.time()]
+
+    def lookup(self, handle):
+        return self.requests.get(handle)
+
+    def complete(self, handle, error):
+        request = self.requests.pop(handle, None)
+        if request is None:
+            self.fail("NBD: Reply for unknown handle %d" % handle)
+            return None
+        self.latencies.append(time.time() - request[_nbd_tracked_sent_])
+        if error == 0:
+            self.completed_bytes += request[_nbd_tracked_length_]
+        else:
+            if (request[_nbd_tracked_attempts_] < self.retries) & ((request[_nbd_tracked_type_] != NBD_CMD_WRITE) | (request[_nbd_tracked_data_] is not None)):
+                INFO("NBD: Request with handle %d failed with error %d, retrying" % (handle, error))
+                request[_nbd_tracked_attempts_] += 1
+                self.retry_queue.append(request)
+            else:
+                self.fail("NBD: Request with handle %d (offset 0x%08x, length %d) failed with error %d" % (handle, request[_nbd_tracked_offset_], request[_nbd_tracked_length_], error))
+        return request
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+
+    def full(self):
+        return len(self.requests) >= self.window
+
+    def idle(self):
+        return (len(self.requests) == 0) & (len(self.retry_queue) == 0)
+
+    def take_retries(self):
+        if self.error is not None:
+            ERROR(self.error)
+            sys.exit(8)
+        retries = self.retry_queue
+        self.retry_queue = []
+        return retries
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return
+        INFO("NBD: %d replies, latency min %.3f ms, avg %.3f ms, p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms" %
+             (len(latencies), latencies[0]*1000, sum(latencies)*1000/len(latencies), get_percentile(latencies, 50)*1000,
+              get_percentile(latencies, 90)*1000, get_percentile(latencies, 99)*1000, latencies[-1]*1000))
+
+class NBDClient(object):
+    # Single threaded NBD transmission engine. Requests are pipelined over nonblocking
+    # sockets and the sockets are only polled when a send would block or the in-flight
+    # window is full, replies are demultiplexed in the same loop.
+    # Small contiguous writes are coalesced into requests of up to `request_size` bytes,
+    # the size itself follows the measured throughput between NBD_MIN_REQUEST_SIZE and `max_request`.
+
+    def __init__(self, uri, connections=1, inflight=NBD_DEFAULT_INFLIGHT, retries=NBD_DEFAULT_RETRIES, max_request=NBD_DEFAULT_MAX_REQUEST_SIZE, block_status=False):
+        (self.socks, self.size, self.flags, self.meta_context) = nbd_open_channels(uri, connections, block_status)
+        self.tracker = NBDRequestTracker(inflight, retries)
+        self.max_request = max(max_request - max_request % SECTOR_SIZE, SECTOR_SIZE)
+        self.min_request = min(NBD_MIN_REQUEST_SIZE, self.max_request)
+        self.request_size = min(NBD_CHUNK_SIZE, self.max_request)
+        self.pending = bytearray()
+        self.pending_offset = 0
+        self.pending_zeros_offset = 0
+        self.pending_zeros_length = 0
+        self.coalesced = 0
+        self.adapt_time = time.time()
+        self.adapt_bytes = 0
+        self.adapt_replies = 0
+        self.adapt_throughput = 0
+        self.adapt_step = 2
+        self.handle = 10
+        self.channel = 0
+        self.callbacks = {}
+        self.chunk_errors = {}
+        self.received = {}
+        self.channels = {}
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+        for sock in self.socks:
+            sock.setblocking(0)
+            self.received[sock.fileno()] = bytearray()
+            self.channels[sock.fileno()] = sock
+            if self.poller is not None:
+                self.poller.register(sock, select.POLLIN)
+
+    def write(self, offset, length, data):
+        self.flush_pending_zeros()
+        if (len(self.pending) > 0) & (offset == self.pending_offset + len(self.pending)) & (len(self.pending) + length <= self.request_size):
+            # The data may be a view of a reused buffer, so it's copied
+            self.pending += data
+            self.coalesced += 1
+            return
+        self.flush_pending()
+        if length < self.request_size:
+            self.pending_offset = offset
+            self.pending += data
+            return
+        data_offset = 0
+        while data_offset < length:
+            chunk_length = min(length - data_offset, self.request_size)
+            self.submit(NBD_CMD_WRITE, offset+data_offset, chunk_length, get_data_view(data, data_offset, chunk_length))
+            data_offset += chunk_length
+
+    def write_zeros(self, offset, length):
+        if (len(self.pending) > 0) & (offset == self.pending_offset + len(self.pending)) & (length <= NBD_COALESCE_ZERO_GAP) & (len(self.pending) + length <= self.request_size):
+            # A short zeroed gap between writes is cheaper to send as data than as a separate request
+            self.pending += get_buffer_view(ZERO_CHUNK, 0, length)
+            self.coalesced += 1
+            return
+        if not (self.flags & NBD_FLAG_SEND_WRITE_ZEROES):
+            while length > 0:
+                chunk_length = min(length, ZERO_CHUNK_SIZE)
+                self.write(offset, chunk_length, get_buffer_view(ZERO_CHUNK, 0, chunk_length))
+                offset += chunk_length
+                length -= chunk_length
+            return
+        self.flush_pending()
+        if (self.pending_zeros_length > 0) & (offset == self.pending_zeros_offset + self.pending_zeros_length):
+            self.pending_zeros_length += length
+            self.coalesced += 1
+            return
+        self.flush_pending_zeros()
+        self.pending_zeros_offset = offset
+        self.pending_zeros_length = length
+
+    def flush_pending(self):
+        if len(self.pending) > 0:
+            self.submit(NBD_CMD_WRITE, self.pending_offset, len(self.pending), memoryview(self.pending))
+            del self.pending[:]
+
+    def flush_pending_zeros(self):
+        offset = self.pending_zeros_offset
+        length = self.pending_zeros_length
+        self.pending_zeros_length = 0
+        while length > 0:
+            chunk_length = min(length, NBD_MAX_ZEROES_REQUEST_SIZE)
+            self.submit(NBD_CMD_WRITE_ZEROES, offset, chunk_length, None)
+            offset += chunk_length
+            length -= chunk_length
+
+    def adapt(self):
+        # Multiplicative hill climbing on the request size: keep moving in the same direction
+        # while the throughput grows, turn back when it drops
+        now = time.time()
+        if now - self.adapt_time < NBD_ADAPT_INTERVAL:
+            return
+        replies = len(self.tracker.latencies) - self.adapt_replies
+        if replies == 0:
+            return
+        throughput = (self.tracker.completed_bytes - self.adapt_bytes) / (now - self.adapt_time)
+        if throughput < self.adapt_throughput:
+            if self.adapt_step > 1:
+                self.adapt_step = 0.5
+            else:
+                self.adapt_step = 2
+        request_size = int(self.request_size * self.adapt_step)
+        request_size = max(self.min_request, min(self.max_request, request_size - request_size % SECTOR_SIZE))
+        if request_size != self.request_size:
+            DEBUG("NBD: Throughput %d B/s, request size %d -> %d" % (throughput, self.request_size, request_size))
+            self.request_size = request_size
+        self.adapt_throughput = throughput
+        self.adapt_time = now
+        self.adapt_bytes = self.tracker.completed_bytes
+        self.adapt_replies = len(self.tracker.latencies)
+
+    def read(self, offset, length, callback):
+        # callback(offset, data) is called from the loop once the reply arrives,
+        # data is only valid until the callback returns
+        self.flush_pending()
+        self.flush_pending_zeros()
+        while length > 0:
+            chunk_length = min(length, self.request_size)
+            self.submit(NBD_CMD_READ, offset, chunk_length, None, 0, callback)
+            offset += chunk_length
+            length -= chunk_length
+
+    def block_status(self, offset, length, callback):
+        # callback(offset, [(length, flags), ...]) gets the base:allocation extents starting at offset,
+        # they may cover less than asked for
+        self.flush_pending()
+        self.flush_pending_zeros()
+        self.submit(NBD_CMD_BLOCK_STATUS, offset, length, None, 0, callback)
+
+    def submit(self, request_type, offset, length, data, attempts=0, callback=None):
+        while self.tracker.full():
+            self.poll()
+        self.resend()
+        handle = self.handle
+        self.handle += 1
+        sock = self.socks[self.channel]
+        self.channel = (self.channel + 1) % len(self.socks)
+        if callback is not None:
+            self.callbacks[handle] = callback
+            data = None
+        request_header = NBD_REQUEST_HEADER_STRUCT.pack(NBD_REQUEST_MAGIC, 0, request_type, handle, offset, length)
+        if debug:
+            DEBUG("NBD: Request %d with handle %d, header: %s" % (request_type, handle, hexdump(request_header)))
+        self.tracker.register(handle, sock, request_type, offset, length, data, attempts)
+        if request_type == NBD_CMD_WRITE:
+            self.send_request(sock, request_header, data)
         else:
-            DEBUG("NBD: Socket isn't ready for writing")
+            self.send(sock, request_header)
+        return handle
+
+    def resend(self):
+        for request in self.tracker.take_retries():
+            callback = None
+            if request[_nbd_tracked_type_] in (NBD_CMD_READ, NBD_CMD_BLOCK_STATUS):
+                callback = request[_nbd_tracked_data_]
+            self.submit(request[_nbd_tracked_type_], request[_nbd_tracked_offset_], request[_nbd_tracked_length_],
+                        request[_nbd_tracked_data_], request[_nbd_tracked_attempts_], callback)
+
+    def send_request(self, sock, request_header, data):
+        # Header and payload go out in one call without copying the payload where the
+        # platform allows it (sendmsg), otherwise small payloads are joined to the header
+        if hasattr(sock, 'sendmsg'):
+            while True:
+                try:
+                    sent = sock.sendmsg([request_header, data])
+                    break
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        ERROR("NBD: Send failed: %s" % e)
+                        sys.exit(8)
+                    self.poll(sock)
+            if sent < len(request_header):
+                self.send(sock, request_header[sent:])
+                self.send(sock, data)
+            elif sent < len(request_header) + len(data):
+                self.send(sock, get_data_view(data, sent - len(request_header), len(data) - sent + len(request_header)))
+        elif len(data) <= NBD_JOIN_PAYLOAD_SIZE:
+            request = bytearray(request_header)
+            request += data
+            self.send(sock, memoryview(request))
+        else:
+            self.send(sock, request_header)
+            self.send(sock, data)
+
+    def send(self, sock, data):
+        # The payload may be a view of a reused buffer, it's sent completely before returning
+        sent = 0
+        length = len(data)
+        while sent < length:
+            try:
+                if sent == 0:
+                    sent = sock.send(data)
+                else:
+                    sent += sock.send(get_data_view(data, sent, length - sent))
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    ERROR("NBD: Send failed: %s" % e)
+                    sys.exit(8)
+                self.poll(sock)
+
+    def poll(self, writer=None):
+        # Waits until a reply arrives or `writer` becomes writable
+        if self.poller is not None:
+            if writer is not None:
+                self.poller.modify(writer, select.POLLIN | select.POLLOUT)
+            try:
+                events = self.poller.poll()
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            if writer is not None:
+                self.poller.modify(writer, select.POLLIN)
+            readable = [self.channels[fd] for (fd, event) in events if event & (select.POLLIN | select.POLLERR | select.POLLHUP)]
+        else:
+            if writer is not None:
+                writers = [writer]
+            else:
+                writers = []
+            readable = select.select(self.socks, writers, [])[0]
+        for sock in readable:
+            self.receive(sock)
+        if self.tracker.error is not None:
+            self.tracker.take_retries()
+        self.adapt()
+
+    def receive(self, sock):
+        received = self.received[sock.fileno()]
+        try:
+            data = sock.recv(NBD_RECEIVE_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.tracker.fail("NBD: Receive failed: %s" % e)
+            return
+        if not data:
+            self.tracker.fail("NBD: Connection closed by server")
+            return
+        received.extend(data)
+        position = 0
+        while len(received) - position >= NBD_REPLY_HEADER_SIZE:
+            (magic,) = unpack_from("!L", received, position)
+            if magic == NBD_STRUCTURED_REPLY_MAGIC:
+                if len(received) - position < NBD_STRUCTURED_REPLY_HEADER_SIZE:
+                    break
+                reply = NBD_STRUCTURED_REPLY_HEADER_STRUCT.unpack_from(received, position)
+                if len(received) - position < NBD_STRUCTURED_REPLY_HEADER_SIZE + reply[_nbd_structured_reply_length_]:
+                    break
+                self.receive_chunk(reply, received, position + NBD_STRUCTURED_REPLY_HEADER_SIZE)
+                position += NBD_STRUCTURED_REPLY_HEADER_SIZE + reply[_nbd_structured_reply_length_]
+                continue
+            if magic != NBD_REPLY_MAGIC:
+                self.tracker.fail("NBD: Bad magic in received reply")
+                return
+            reply = NBD_REPLY_HEADER_STRUCT.unpack_from(received, position)
+            handle = reply[_nbd_reply_handle_]
+            request = self.tracker.lookup(handle)
+            payload = 0
+            if (request is not None) and (request[_nbd_tracked_type_] == NBD_CMD_READ) and (reply[_nbd_reply_error_] == 0):
+                payload = request[_nbd_tracked_length_]
+                if len(received) - position < NBD_REPLY_HEADER_SIZE + payload:
+                    break
+            if (payload > 0) & (handle in self.callbacks):
+                view = memoryview(received)
+                self.callbacks[handle](request[_nbd_tracked_offset_], view[position+NBD_REPLY_HEADER_SIZE:position+NBD_REPLY_HEADER_SIZE+payload])
+                del view
+            self.complete(handle, reply[_nbd_reply_error_])
+            position += NBD_REPLY_HEADER_SIZE + payload
+        del received[:position]
+
+    def receive_chunk(self, reply, received, position):
+        # One chunk of a structured reply, the request is completed by the chunk flagged as done
+        handle = reply[_nbd_structured_reply_handle_]
+        chunk_type = reply[_nbd_structured_reply_type_]
+        length = reply[_nbd_structured_reply_length_]
+        callback = self.callbacks.get(handle)
+        if debug:
+            DEBUG("NBD: Recived reply chunk %d for handle %d" % (chunk_type, handle))
+        if chunk_type & NBD_REPLY_TYPE_ERROR_BIT:
+            (error,) = unpack_from("!L", received, position)
+            self.chunk_errors.setdefault(handle, error)
+        elif callback is None:
+            pass
+        elif chunk_type == NBD_REPLY_TYPE_OFFSET_DATA:
+            (offset,) = unpack_from("!Q", received, position)
+            view = memoryview(received)
+            callback(offset, view[position+8:position+length])
+            del view
+        elif chunk_type == NBD_REPLY_TYPE_OFFSET_HOLE:
+            (offset, hole_length) = unpack_from("!QL", received, position)
+            while hole_length > 0:
+                chunk_length = min(hole_length, ZERO_CHUNK_SIZE)
+                callback(offset, get_buffer_view(ZERO_CHUNK, 0, chunk_length))
+                offset += chunk_length
+                hole_length -= chunk_length
+        elif chunk_type == NBD_REPLY_TYPE_BLOCK_STATUS:
+            descriptors = unpack_from("!L%dL" % ((length - 4)//4), received, position)
+            request = self.tracker.lookup(handle)
+            if (descriptors[0] == self.meta_context) and (request is not None):
+                callback(request[_nbd_tracked_offset_], zip(descriptors[1::2], descriptors[2::2]))
+        if reply[_nbd_structured_reply_flags_] & NBD_REPLY_FLAG_DONE:
+            self.complete(handle, self.chunk_errors.pop(handle, 0))
+
+    def complete(self, handle, error):
+        if debug:
+            DEBUG("NBD: Recived reply for handle %d" % handle)
+        callback = self.callbacks.pop(handle, None)
+        request = self.tracker.complete(handle, error)
+        if (callback is not None) & (error != 0) & (request is not None):
+            # The callback travels with the request to be retried
+            request[_nbd_tracked_data_] = callback
+
+    def flush(self):
+        # Waits for the replies to all requests sent so far
+        self.flush_pending()
+        self.flush_pending_zeros()
+        while not self.tracker.idle():
+            self.resend()
+            if not self.tracker.idle():
+                self.poll()
+        self.tracker.take_retries()
+
+    def close(self):
+        self.flush()
+        for sock in self.socks:
+            sock.setblocking(1)
+            nbd_close_channel(sock, self.handle)
+            self.handle += 1
+        INFO("NBD: %d writes coalesced, final request size %d" % (self.coalesced, self.request_size))
+        self.tracker.report()
 
-    sock.sendall(request_header)
-    INFO("NBD: Read request with handle %d has been sent" % handle)
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
-def rbd2nbd(rbd, uri, progress, mrout):
-    if rbd == "-":
-        RBDDIFF_FH = sys.stdin
+def rbd2nbd(rbd, uri, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros, index_file='', raw_range=None, checkpoint_file='', resume=False):
+    (checkpoint, resume_position) = rbd_diff_checkpoint_open(checkpoint_file, resume, rbd, raw_range)
+    (RBDDIFF, index) = rbd_diff_open_indexed(rbd, index_file, False)
+    (range_start, range_end) = raw_range if raw_range is not None else (0, RBD_DIFF_RANGE_END)
+    if index is None:
+        RBDDIFF_FH = rbd_diff_open(rbd)
+        records = rbd_diff_records(RBDDIFF_FH, resume_position=resume_position)
     else:
-        RBDDIFF_FH = open(rbd, "rb")
+        records = rbd_diff_index_records(RBDDIFF, index, rbd_diff_resume_entries(index, index.overlapping(range_start, range_end), resume_position))
+    if raw_range is not None:
+        records = rbd_diff_range_records(records, range_start, range_end)
+    client = NBDClient(uri, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request)
 
-    rbd_meta_read_finished = 0
-    _prev_percent_ = 0
-    _offset_ = 0
-    handle_index = 10
-    finished = False
+    rbd_records2nbd(records, client, progress, mrout, detect_zeros, checkpoint)
 
-    request_handles = {}
-    #request_handles_lock = threading.Lock()
-
-    (sock, encoding) = nbd_open_channel(uri)
-    if (encoding != 'nbd'):
-        ERROR("NBD: Unsupported encoding `%s`" % encoding)
-        nbd_close_channel(sock, 0)
-        sys.exit(5)
+    if index is None:
+        RBDDIFF_FH.close()
     else:
-        INFO("NBD: Encoding: `%s`" % encoding)
+        vhd_close(RBDDIFF)
+    client.close()
 
-    def nbd_receive_reply(sock):
-        INFO("NBD: Replies reciver thread has been started")
-        DEBUG("NBD: len(request_handles)=%d, finished=%s" % (len(request_handles), finished))
-        while (len(request_handles)>0 or (finished == False & len(request_handles)==0)):
-            while True:
-                ready = select.select([sock],[],[])
-                if ready[0]:
-                    DEBUG("NBD: Socket ready for reading")
-                    break
-                else:
-                    DEBUG("NBD: Socket isn't ready for reading")
-            reply = unpack(NBD_REPLY_HEADER_FORMAT, sock.recv(NBD_REPLY_HEADER_SIZE))
-            if reply[_nbd_reply_magic_] != NBD_REPLY_MAGIC:
-                ERROR("NBD: Bad magic in received reply")
-            INFO("NBD: Recived reply for handle %d" % reply[_nbd_reply_handle_])
-            #request_handles_lock.acquire()
-            request_handles.pop(reply[_nbd_reply_handle_])
-            #request_handles_lock.release()
-        INFO("NBD: Replies reciver thread has been finished")
-
-    rbd_header = RBDDIFF_FH.read(len(RBD_HEADER))
+    return 0
+
+def rbd_records2nbd(records, client, progress, mrout, detect_zeros, checkpoint=None):
+    # Writes records in the format of rbd_diff_records() to the export and waits for all replies.
+    # A checkpoint is saved once the replies to all writes of the records before it have come back.
+    rbd_meta_read_finished = 0
+    _prev_percent_ = 0
+    _offset_ = 0
 
     if (progress):
         if (mrout):
@@ -662,95 +1569,192 @@ def rbd2nbd(rbd, uri, progress, mrout):
         else:
             eprint("Progress: 0")
 
-    (nbd_size, nbd_trans_flags) = nbd_negotiate(sock)
-
-    DEBUG("NBD: Prepare replies reciver thread")
-    t = threading.Thread(target=nbd_receive_reply, args=(sock,))
-    t.start()
-
     DEBUG("RBD: Start RBD diff reading")
 
-    while True:
-        record_tag = RBDDIFF_FH.read(RBD_DIFF_META_RECORD_TAG_SIZE)
-        #record_tag = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG), record)
-        if not record_tag:
-            INFO("RBD: Unexpected EOF")
+    if detect_zeros & (not (client.flags & NBD_FLAG_SEND_WRITE_ZEROES)):
+        INFO("NBD: Server doesn't support write zeroes requests, zero detection is disabled")
+        detect_zeros = False
+    if detect_zeros:
+        zero_detector = ZeroDetector()
+        records = zero_detector.records(records)
+
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        INFO("RBD: Record TAG = \'%c\'" % record_tag)
+        if record_tag == RBD_DIFF_RECORD_END:
+            INFO("RBD: Got EOF record TAG")
             break
+        if record_tag == RBD_DIFF_RECORD_FROM_SNAP:
+            from_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: From snap = %s" % from_snap_name)
+        elif record_tag == RBD_DIFF_RECORD_TO_SNAP:
+            to_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: To snap = %s" % to_snap_name)
+        elif record_tag == RBD_DIFF_RECORD_SIZE:
+            image_size = record[_rbd_record_length_]
+            INFO("RBD: Image size = %d" % image_size)
+        elif record_tag == RBD_DIFF_RECORD_DATA:
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+        elif record_tag == RBD_DIFF_RECORD_ZERO:
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+
+        if (rbd_meta_read_finished == 1):
+            if (checkpoint is not None) and checkpoint.due():
+                client.flush()
+                checkpoint.save(record[_rbd_record_position_], _offset_)
+
+            if record_tag == RBD_DIFF_RECORD_DATA:
+                client.write(offset, length, record[_rbd_record_data_])
+            elif record_tag == RBD_DIFF_RECORD_ZERO:
+                client.write_zeros(offset, length)
+
+            _offset_ = offset + length
+
+            #time.sleep(0.05)
+
+            if (progress):
+                _percent_ = (100*_offset_)//image_size
+                if _prev_percent_ != _percent_ :
+                    _prev_percent_ = _percent_
+                    if (mrout):
+                        MROUTPUT("Progress: %d" % _percent_)
+                    else:
+                        eprint("Progress: %d" % _percent_)
+
+    client.flush()
+    if checkpoint is not None:
+        checkpoint.remove()
+    if detect_zeros:
+        zero_detector.report()
+
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 100")
+            MROUTPUT("")
         else:
-            INFO("RBD: Record TAG = \'%c\'" % record_tag)
-            if record_tag == "e":
-                INFO("RBD: Got EOF record TAG")
-                break
-            if record_tag == "f":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                from_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                from_snap_name = regex.sub('', from_snap_name)
-                INFO("RBD: From snap = %s" % from_snap_name)
-            elif record_tag == "t":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                to_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                to_snap_name = regex.sub('', to_snap_name)
-                INFO("RBD: To snap = %s" % to_snap_name)
-            elif record_tag == "s":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SIZE_SIZE)
-                image_size = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SIZE), record)[0])
-                INFO("RBD: Image size = %d" % image_size)
-            elif record_tag == "w":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
-                INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
-            elif record_tag == "z":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
-                INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
+            eprint("Progress: 100")
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def nbd_export_records(client, zero_detector):
+    # Reads the whole export in batches and yields it as records in the format of rbd_diff_records().
+    # Ranges reported as zero by block status are never read, the data views are valid until the next batch.
+    yield (RBD_DIFF_RECORD_SIZE, 0, client.size, None, 0)
+
+    offset = 0
+    while offset < client.size:
+        length = min(NBD_EXPORT_BATCH_SIZE, client.size - offset)
+        extents = [(length, 0)]
+        if client.meta_context is not None:
+            status = []
+            client.block_status(offset, length, lambda status_offset, status_extents: status.extend(status_extents))
+            client.flush()
+            if len(status) > 0:
+                extents = []
+                covered = 0
+                for (extent_length, flags) in status:
+                    extent_length = min(extent_length, length - covered)
+                    if extent_length == 0:
+                        break
+                    extents.append((extent_length, flags))
+                    covered += extent_length
+                length = covered
+
+        batch = bytearray(length)
+        def store(data_offset, data):
+            batch[data_offset-offset:data_offset-offset+len(data)] = data
+
+        extent_offset = offset
+        for (extent_length, flags) in extents:
+            if not (flags & NBD_STATE_ZERO):
+                client.read(extent_offset, extent_length, store)
+            extent_offset += extent_length
+        client.flush()
+
+        view = memoryview(batch)
+        extent_offset = offset
+        for (extent_length, flags) in extents:
+            if flags & NBD_STATE_ZERO:
+                DEBUG("NBD: Zero extent offset = 0x%08x and length = %d" % (extent_offset, extent_length))
+                yield (RBD_DIFF_RECORD_ZERO, extent_offset, extent_length, None, 0)
+            elif zero_detector is not None:
+                for (run_offset, run_length, run_zero) in zero_detector.runs(view[extent_offset-offset:extent_offset-offset+extent_length], extent_offset, extent_length):
+                    if run_zero:
+                        yield (RBD_DIFF_RECORD_ZERO, extent_offset+run_offset, run_length, None, 0)
+                    else:
+                        yield (RBD_DIFF_RECORD_DATA, extent_offset+run_offset, run_length, view[extent_offset-offset+run_offset:extent_offset-offset+run_offset+run_length], 0)
             else:
-                ERROR("RBD: Error while reading rbd_diff file")
-                nbd_close_channel(sock, 0)
-                sys.exit(2)
+                yield (RBD_DIFF_RECORD_DATA, extent_offset, extent_length, view[extent_offset-offset:extent_offset-offset+extent_length], 0)
+            extent_offset += extent_length
+        del view
+
+        offset += length
+
+    yield (RBD_DIFF_RECORD_END, 0, 0, None, 0)
+
+def nbd_export_open(uri, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros):
+    client = NBDClient(uri, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, True)
+    if client.meta_context is None:
+        # Without block status everything is read, so zeroed ranges are at least not copied
+        INFO("NBD: Server doesn't report block status, zero detection is enabled")
+        detect_zeros = True
+    if detect_zeros:
+        zero_detector = ZeroDetector()
+    else:
+        zero_detector = None
+    return (client, zero_detector)
 
-            if (rbd_meta_read_finished == 1):
-                #request_handles_lock.acquire()
+def nbd2rbd(uri, rbd, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros):
+    (client, zero_detector) = nbd_export_open(uri, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros)
+    RBDDIFF_FH = rbd_diff_create(rbd)
 
-                if record_tag == "w":
-                    _buffer_ = RBDDIFF_FH.read(length)
-                    (handle_index, request_handles) = nbd_send_write(sock, handle_index, request_handles, offset, length, _buffer_)
-                elif record_tag == "z":
-                    if (nbd_trans_flags & NBD_FLAG_SEND_WRITE_ZEROES):
-                        nbd_send_write_zeros(sock, handle_index, offset, length)
-                    else:
-                        _buffer_ = pack("!%ds" % length, '')
-                        (handle_index, request_handles) = nbd_send_write(sock, handle_index, request_handles, offset, length, _buffer_)
+    _prev_percent_ = 0
+    total_written_bytes = 0
 
-                #request_handles_lock.release()
-                _offset_ = offset + length
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 0")
+        else:
+            eprint("Progress: 0")
 
-                #time.sleep(0.05)
+    INFO("RBD: Writing RBD diff header")
+    RBDDIFF_FH.write(RBD_HEADER)
 
-                if (progress):
-                    _percent_ = (100*_offset_)//image_size
-                    if _prev_percent_ != _percent_ :
-                        _prev_percent_ = _percent_
-                        if (mrout):
-                            MROUTPUT("Progress: %d" % _percent_)
-                        else:
-                            eprint("Progress: %d" % _percent_)
+    for record in nbd_export_records(client, zero_detector):
+        record_tag = record[_rbd_record_tag_]
+        offset = record[_rbd_record_offset_]
+        length = record[_rbd_record_length_]
+        if record_tag == RBD_DIFF_RECORD_SIZE:
+            INFO("RBD: Writing RBD size record")
+            image_size = length
+            RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_META_SIZE, RBD_DIFF_RECORD_SIZE, image_size))
+            continue
+        elif record_tag == RBD_DIFF_RECORD_DATA:
+            INFO("RBD: Write RBD data record offset 0x%08x length %d" % (offset, length))
+            rbd_diff_write_data(RBDDIFF_FH, offset, length, [record[_rbd_record_data_]])
+            total_written_bytes += length
+        elif record_tag == RBD_DIFF_RECORD_ZERO:
+            INFO("RBD: Write RBD zero data record offset 0x%08x length %d" % (offset, length))
+            rbd_diff_write_zero(RBDDIFF_FH, offset, length)
+        elif record_tag == RBD_DIFF_RECORD_END:
+            RBDDIFF_FH.write(RBD_DIFF_RECORD_END)
+            break
 
-    finished = True
-    t.join()
+        if (progress):
+            _percent_ = (100*(offset+length))//image_size
+            if _prev_percent_ != _percent_ :
+                _prev_percent_ = _percent_
+                if (mrout):
+                    MROUTPUT("Progress: %d" % _percent_)
+                else:
+                    eprint("Progress: %d" % _percent_)
 
     if (progress):
         if (mrout):
@@ -759,109 +1763,470 @@ def rbd2nbd(rbd, uri, progress, mrout):
         else:
             eprint("Progress: 100")
 
-    if RBDDIFF_FH is not sys.stdin:
-        RBDDIFF_FH.close
+    INFO("RBD: Total written bytes: %d" % total_written_bytes)
+    if zero_detector is not None:
+        zero_detector.report()
+
+    client.close()
+    RBDDIFF_FH.close()
+
+    return 0
+
+def nbd2vhd(uri, vhd, rbd_image_uuid, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros):
+    (client, zero_detector) = nbd_export_open(uri, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros)
+
+    VHD_FH = vhd_create(vhd, mrout)
+    if is_seekable_file(VHD_FH):
+        rbd_records2vhd(nbd_export_records(client, zero_detector), VHD_FH, rbd_image_uuid, progress, mrout)
+    else:
+        rbd_records2vhd_stream(nbd_export_records(client, zero_detector), VHD_FH, rbd_image_uuid, progress, mrout)
+    VHD_FH.close()
+
+    if zero_detector is not None:
+        zero_detector.report()
 
-    nbd_close_channel(sock, handle_index)
+    client.close()
 
     return 0
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
-def rbd2raw(rbd, raw, progress, mrout):
-    RAW_FH = open(raw, "wb")
-    if rbd == "-":
-        RBDDIFF_FH = sys.stdin
+def rbd2raw(rbd, raw, progress, mrout, sparse, detect_zeros, index_file='', raw_range=None, jobs=1, checkpoint_file='', resume=False):
+    # With raw_range only that part of the image is written, into the existing file or device.
+    # With an index (built on the fly for jobs) only the records of the range are looked at.
+    # A resumed conversion continues in the existing file from the position of its checkpoint.
+    if checkpoint_file and (jobs > 1):
+        ERROR("RAW: Checkpoints can't be used with more than one job")
+        sys.exit(2)
+    (checkpoint, resume_position) = rbd_diff_checkpoint_open(checkpoint_file, resume, rbd, raw_range)
+    # The diff (and its index) is opened first, the output isn't truncated if that fails
+    (RBDDIFF, index) = rbd_diff_open_indexed(rbd, index_file, jobs > 1)
+    if index is None:
+        RBDDIFF_FH = rbd_diff_open(rbd)
+    (range_start, range_end) = raw_range if raw_range is not None else (0, RBD_DIFF_RANGE_END)
+    if (index is not None) and (jobs > 1) and (not index.ordered):
+        # Records that overlap must be written in file order
+        INFO("RAW: Records of '%s' are not in ascending order, writing with one job" % rbd)
+        jobs = 1
+    truncated = (raw_range is None) & (resume_position == 0)
+    if truncated:
+        RAW_FH = io.open(raw, "wb", buffering=0)
     else:
-        RBDDIFF_FH = open(rbd, "rb")
+        RAW_FH = io.open(os.open(raw, os.O_WRONLY | os.O_CREAT, 0o644), "wb", buffering=0)
+
+    if index is None:
+        records = rbd_diff_records(RBDDIFF_FH, resume_position=resume_position)
+        if raw_range is not None:
+            records = rbd_diff_range_records(records, range_start, range_end)
+        rbd_records2raw(records, RAW_FH, progress, mrout, sparse, detect_zeros, truncated, checkpoint)
+        RBDDIFF_FH.close()
+    elif jobs > 1:
+        rbd2raw_parallel(rbd, index, index.overlapping(range_start, range_end), raw, RAW_FH, range_start, range_end, progress, mrout, sparse, detect_zeros, jobs, truncated)
+        vhd_close(RBDDIFF)
+    else:
+        entries = rbd_diff_resume_entries(index, index.overlapping(range_start, range_end), resume_position)
+        records = rbd_diff_range_records(rbd_diff_index_records(RBDDIFF, index, entries), range_start, range_end)
+        rbd_records2raw(records, RAW_FH, progress, mrout, sparse, detect_zeros, truncated, checkpoint)
+        vhd_close(RBDDIFF)
+
+    RAW_FH.close()
+
+    return 0
+
+def rbd2raw_parallel(rbd, index, entries, raw, RAW_FH, range_start, range_end, progress, mrout, sparse, detect_zeros, jobs, truncated):
+    # The index entries of the range are cut into partitions of about the same payload size,
+    # `jobs` workers write them through their own maps of the diff and handles of the raw file
+    if stat.S_ISREG(os.fstat(RAW_FH.fileno()).st_mode):
+        RAW_FH.truncate(index.image_size)
+    RAW_FH.flush()
+
+    entries = list(entries)
+    total_bytes = sum(index.lengths[entry] for entry in entries)
+    partition_bytes = max(total_bytes // (jobs*RAW_PARALLEL_PARTITIONS_PER_JOB), 1)
+    partitions = Queue.Queue()
+    first = 0
+    collected = 0
+    for position in range(len(entries)):
+        collected += index.lengths[entries[position]]
+        if (collected >= partition_bytes) | (position == len(entries) - 1):
+            partitions.put((entries[first:position+1], collected))
+            first = position + 1
+            collected = 0
+
+    # [bytes done, errors], shared by the workers under status_lock
+    status = [0, []]
+    status_lock = threading.Lock()
+    zero_detectors = []
+    workers = []
+    for job in range(min(jobs, max(partitions.qsize(), 1))):
+        zero_detector = ZeroDetector() if detect_zeros else None
+        zero_detectors.append(zero_detector)
+        worker = threading.Thread(target=raw_parallel_worker, args=(rbd, index, raw, partitions, range_start, range_end, sparse, zero_detector, truncated, status, status_lock))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    INFO("RAW: %d workers write %d records in %d partitions" % (len(workers), len(entries), partitions.qsize()))
+
+    _prev_percent_ = -1
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(VHD_PROGRESS_INTERVAL)
+            if (progress):
+                _percent_ = (100*status[0])//max(total_bytes, 1)
+                if _prev_percent_ != _percent_ :
+                    _prev_percent_ = _percent_
+                    if (mrout):
+                        MROUTPUT("Progress: %d" % _percent_)
+                    else:
+                        eprint("Progress: %d" % _percent_)
+
+    if len(status[1]) > 0:
+        ERROR("RAW: %d of %d workers failed" % (len(status[1]), len(workers)))
+        sys.exit(max(status[1]))
+
+    if detect_zeros:
+        INFO("ZERO: %d bytes of zero data elided" % sum(zero_detector.elided_bytes for zero_detector in zero_detectors))
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 100")
+            MROUTPUT("")
+        else:
+            eprint("Progress: 100")
+
+def raw_parallel_worker(rbd, index, raw, partitions, range_start, range_end, sparse, zero_detector, truncated, status, status_lock):
+    RBDDIFF = None
+    RAW_FH = None
+    try:
+        RBDDIFF = vhd_open(rbd)
+        RAW_FH = io.open(os.open(raw, os.O_WRONLY), "wb", buffering=0)
+        while True:
+            try:
+                (entries, partition_bytes) = partitions.get_nowait()
+            except Queue.Empty:
+                break
+            records = rbd_diff_range_records(rbd_diff_index_records(RBDDIFF, index, entries, False), range_start, range_end)
+            if zero_detector is not None:
+                records = zero_detector.records(records)
+            rbd_records2raw(records, RAW_FH, False, False, sparse, False, truncated)
+            with status_lock:
+                status[0] += partition_bytes
+    except SystemExit as e:
+        with status_lock:
+            status[1].append(e.code if isinstance(e.code, int) else 1)
+    except Exception as e:
+        ERROR("RAW: Worker failed: %s" % e)
+        with status_lock:
+            status[1].append(1)
+    finally:
+        if RAW_FH is not None:
+            RAW_FH.close()
+        if RBDDIFF is not None:
+            vhd_close(RBDDIFF)
+
+def rbd_records2raw(records, RAW_FH, progress, mrout, sparse, detect_zeros, truncated=True, checkpoint=None):
+    # Writes records in the format of rbd_diff_records() to the raw file or device.
+    # A checkpoint is saved once the writes of the records before it have been synced.
+
+    # Regular files truncated when opened have holes in their unwritten ranges already
+    raw_is_file = stat.S_ISREG(os.fstat(RAW_FH.fileno()).st_mode)
+    raw_is_empty = raw_is_file & truncated
 
     rbd_meta_read_finished = 0
     _prev_percent_ = 0
     _offset_ = 0
 
-    rbd_header = RBDDIFF_FH.read(len(RBD_HEADER))
-
     if (progress):
         if (mrout):
             MROUTPUT("Progress: 0")
         else:
             eprint("Progress: 0")
 
-    while True:
-        record_tag = RBDDIFF_FH.read(RBD_DIFF_META_RECORD_TAG_SIZE)
-        #record_tag = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG), record)
-        if not record_tag:
-            INFO("RBD: Unexpected EOF")
+    if detect_zeros:
+        zero_detector = ZeroDetector()
+        records = zero_detector.records(records)
+
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        INFO("RBD: Record TAG = \'%c\'" % record_tag)
+        if record_tag == RBD_DIFF_RECORD_END:
+            INFO("RBD: Got EOF record TAG")
             break
+        if record_tag == RBD_DIFF_RECORD_FROM_SNAP:
+            from_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: From snap = %s" % from_snap_name)
+        elif record_tag == RBD_DIFF_RECORD_TO_SNAP:
+            to_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: To snap = %s" % to_snap_name)
+        elif record_tag == RBD_DIFF_RECORD_SIZE:
+            image_size = record[_rbd_record_length_]
+            INFO("RBD: Image size = %d" % image_size)
+            if raw_is_file:
+                RAW_FH.truncate(image_size)
+        elif record_tag == RBD_DIFF_RECORD_DATA:
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+        elif record_tag == RBD_DIFF_RECORD_ZERO:
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+
+        if (rbd_meta_read_finished == 1):
+            if (checkpoint is not None) and checkpoint.due():
+                os.fsync(RAW_FH.fileno())
+                checkpoint.save(record[_rbd_record_position_], _offset_)
+
+            if record_tag == RBD_DIFF_RECORD_DATA:
+                raw_pwrite(RAW_FH, offset, record[_rbd_record_data_])
+            elif record_tag == RBD_DIFF_RECORD_ZERO:
+                if sparse & raw_is_empty:
+                    DEBUG("RAW: Skip zero data offset = 0x%08x and length = %d" % (offset, length))
+                elif sparse:
+                    raw_punch_hole(RAW_FH, offset, length)
+                else:
+                    raw_write_zeros(RAW_FH, offset, length)
+            _offset_ = offset + length
+
+            if (progress):
+                _percent_ = (100*_offset_)//image_size
+                if _prev_percent_ != _percent_ :
+                    _prev_percent_ = _percent_
+                    if (mrout):
+                        MROUTPUT("Progress: %d" % _percent_)
+                    else:
+                        eprint("Progress: %d" % _percent_)
+
+    if checkpoint is not None:
+        os.fsync(RAW_FH.fileno())
+        checkpoint.remove()
+
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 100")
+            MROUTPUT("")
         else:
-            INFO("RBD: Record TAG = \'%c\'" % record_tag)
-            if record_tag == "e":
-                INFO("RBD: Got EOF record TAG")
-                break
-            if record_tag == "f":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                from_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                from_snap_name = regex.sub('', from_snap_name)
-                INFO("RBD: From snap = %s" % from_snap_name)
-            elif record_tag == "t":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                to_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                to_snap_name = regex.sub('', to_snap_name)
-                INFO("RBD: To snap = %s" % to_snap_name)
-            elif record_tag == "s":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SIZE_SIZE)
-                image_size = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SIZE), record)[0])
-                INFO("RBD: Image size = %d" % image_size)
-            elif record_tag == "w":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
-                INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
-            elif record_tag == "z":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
-                INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
+            eprint("Progress: 100")
+
+    if detect_zeros:
+        zero_detector.report()
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def gen_vhd_prologue(image_size, rbd_image_uuid, from_snap_name, to_snap_name, bat, full_blocks=()):
+    # Returns (footer, dynamic disk header struct, prologue), the prologue is everything in front of
+    # the first data block: footer copy, dynamic disk header, BAT, BATMAP and parent locators
+    if rbd_image_uuid == '':
+        ERROR("RBD: RBD image UUID is not specified")
+        sys.exit(1)
+    if from_snap_name:
+            parent_uuid = uuid.UUID(from_snap_name)
+            parent_exists = True
+    else:
+            parent_uuid = uuid.UUID('00000000-0000-0000-0000-000000000000')
+            parent_exists = False
+    if to_snap_name:
+        vhd_uuid = uuid.UUID(to_snap_name)
+        rbd_uuid = uuid.UUID(rbd_image_uuid)
+    else:
+        vhd_uuid = uuid.UUID(rbd_image_uuid)
+        rbd_uuid = uuid.UUID(rbd_image_uuid)
+
+    if parent_exists:
+        vhd_footer_struct = gen_vhd_footer_struct(VHD_DIFF_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, 0)
+    else:
+        vhd_footer_struct = gen_vhd_footer_struct(VHD_DYNAMIC_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, 0)
+    VHD_FOOTER = pack(VHD_FOTTER_FORMAT, *vhd_footer_struct)
+    vhd_footer_struct = modTupleByIndex(vhd_footer_struct, _vhd_footter_checksum_, checksum(VHD_FOOTER))
+    VHD_FOOTER = pack(VHD_FOTTER_FORMAT, *vhd_footer_struct)
+
+    if parent_exists:
+        vhd_dynamic_disk_header_struct = gen_vhd_dynamic_disk_header_struct(VHD_FOTTER_RECORD_SIZE+VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE, image_size, 0, parent_uuid.bytes, "%s.vhd" % str(parent_uuid))
+        vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_parent_time_stamp_, time.time()-946684800) #????
+    else:
+        vhd_dynamic_disk_header_struct = gen_vhd_dynamic_disk_header_struct(VHD_FOTTER_RECORD_SIZE+VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE, image_size, 0, '', '')
+
+    VHD_BAT = pack_vhd_bat(bat)
+    vhd_file_offset = VHD_FOTTER_RECORD_SIZE + VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE + len(VHD_BAT)
+
+    VHD_BATMAP = pack_vhd_batmap(gen_vhd_batmap(len(bat), full_blocks), vhd_file_offset)
+    vhd_file_offset += len(VHD_BATMAP)
+
+    parent_locators = []
+    for index in range(VHD_PARENT_LOCATORS_COUNT):
+        if parent_exists:
+            if index == 0:
+                parent_locator = "file://./%s.vhd" % parent_uuid
+                parent_locator_encoded = parent_locator
+                parent_locator_entry_struct = (_platform_code_MacX_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #MacX
+            elif index == 1:
+                parent_locator = ".\%s.vhd" % parent_uuid
+                parent_locator_encoded = parent_locator.encode("UTF-16LE")
+                parent_locator_entry_struct = (_platform_code_W2ku_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #W2ku
+            elif index == 2:
+                parent_locator = ".\%s.vhd" % parent_uuid
+                parent_locator_encoded = parent_locator.encode("UTF-16LE")
+                parent_locator_entry_struct = (_platform_code_W2ru_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #W2ru
             else:
-                ERROR("RBD: Error while reading rbd_diff file")
-                sys.exit(2)
+                parent_locator_encoded = ''
+                parent_locator_entry_struct = (0x00000000, 0, 0, 0, 0) #empty
+        else:
+            parent_locator_encoded = ''
+            parent_locator_entry_struct = (0x00000000, 0, 0, 0, 0) #empty
 
-            if (rbd_meta_read_finished == 1):
+        if len(parent_locator_encoded) > 0:
+            parent_locator_packed = pack("!%ds" % get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), parent_locator_encoded)
+        else:
+            parent_locator_packed = pack("!%ds" % SECTOR_SIZE, parent_locator_encoded)
 
-                if record_tag == "w":
-                    _buffer_ = RBDDIFF_FH.read(length)
-                elif record_tag == "z":
-                    _buffer_ = pack("!%ds" % length, '')
+        parent_locator_entry = pack(VHD_PARENT_LOCATOR_ENTRY_FORMAT, *parent_locator_entry_struct)
+        vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_parent_locator_entry_1_ + index, parent_locator_entry)
 
-                if (_offset_ == 0):
-                    RAW_FH.seek(offset,1)
-                    _offset_ = offset + length
-                    RAW_FH.write(_buffer_)
-                else:
-                    RAW_FH.seek(offset-_offset_,1)
-                    _offset_ = offset + length
-                    RAW_FH.write(_buffer_)
+        parent_locators.append(parent_locator_packed)
+        vhd_file_offset += len(parent_locator_packed)
 
-                if (progress):
-                    _percent_ = (100*_offset_)//image_size
-                    if _prev_percent_ != _percent_ :
-                        _prev_percent_ = _percent_
-                        if (mrout):
-                            MROUTPUT("Progress: %d" % _percent_)
-                        else:
-                            eprint("Progress: %d" % _percent_)
+    VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
+    vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, checksum(VHD_DYNAMIC_DISK_HEADER))
+    VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
+
+    VHD_PROLOGUE = "".join([VHD_FOOTER, VHD_DYNAMIC_DISK_HEADER, VHD_BAT, VHD_BATMAP] + parent_locators)
+    return (VHD_FOOTER, vhd_dynamic_disk_header_struct, VHD_PROLOGUE)
+
+def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout, detect_zeros, jobs=1):
+    RBDDIFF_FH = rbd_diff_open(rbd)
+    VHD_FH = vhd_create(vhd, mrout)
+
+    if jobs > 1:
+        # Workers open the diff and the VHD by name, stdin and stdout can't be reopened
+        if (rbd != "-") and (vhd != "-") and is_seekable_file(VHD_FH) and is_seekable_file(RBDDIFF_FH):
+            if rbd_diff2vhd_parallel(RBDDIFF_FH, rbd, VHD_FH, vhd, rbd_image_uuid, progress, mrout, detect_zeros, jobs):
+                VHD_FH.close()
+                RBDDIFF_FH.close()
+                return 0
+            RBDDIFF_FH.seek(0, 0)
+        else:
+            INFO("VHD: Parallel conversion needs a seekable RBD diff and VHD given by name, converting sequentially")
+
+    plan = None
+    if (not is_seekable_file(VHD_FH)) and is_seekable_file(RBDDIFF_FH):
+        # A seekable diff is read twice: record headers first to lay out the BAT, then the data
+        INFO("VHD: Output is not seekable, pre-scanning RBD diff for allocated blocks")
+        if detect_zeros:
+            records = ZeroDetector().records(rbd_diff_records(RBDDIFF_FH))
+        else:
+            records = rbd_diff_records(RBDDIFF_FH, RBD_DIFF_SCAN_BUFFER_SIZE, skip_data=True)
+        # The stream writer can't go back to a block, unordered records are refused before anything is written
+        plan = vhd_plan_blocks(records, ordered=True)
+        RBDDIFF_FH.seek(0, 0)
+
+    records = rbd_diff_records(RBDDIFF_FH)
+    if detect_zeros:
+        zero_detector = ZeroDetector()
+        records = zero_detector.records(records)
+
+    if is_seekable_file(VHD_FH):
+        rbd_records2vhd(records, VHD_FH, rbd_image_uuid, progress, mrout)
+    else:
+        rbd_records2vhd_stream(records, VHD_FH, rbd_image_uuid, progress, mrout, plan)
+
+    if detect_zeros:
+        zero_detector.report()
+
+    VHD_FH.close()
+    RBDDIFF_FH.close()
+
+    return 0
+
+def rbd_diff_collect_extents(records, meta, extents):
+    # Passes the records through, collecting [from snap, to snap, image size] into meta and
+    # (tag, offset, length, payload position) of `w` and `z` records into extents
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        if record_tag == RBD_DIFF_RECORD_FROM_SNAP:
+            meta[0] = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+        elif record_tag == RBD_DIFF_RECORD_TO_SNAP:
+            meta[1] = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+        elif record_tag == RBD_DIFF_RECORD_SIZE:
+            meta[2] = record[_rbd_record_length_]
+        elif (record_tag == RBD_DIFF_RECORD_DATA) or (record_tag == RBD_DIFF_RECORD_ZERO):
+            extents.append((record_tag, record[_rbd_record_offset_], record[_rbd_record_length_],
+                            record[_rbd_record_position_] + RBD_DIFF_META_RECORD_TAG_SIZE + RBD_DIFF_DATA_SIZE))
+        yield record
+
+def rbd_diff_pread(RBDDIFF_FH, position, view):
+    RBDDIFF_FH.seek(position, 0)
+    received = 0
+    while received < len(view):
+        read_bytes = RBDDIFF_FH.readinto(view[received:])
+        if not read_bytes:
+            ERROR("RBD: Truncated data record payload at position %d" % position)
+            sys.exit(2)
+        received += read_bytes
+
+def rbd_diff2vhd_parallel(RBDDIFF_FH, rbd, VHD_FH, vhd, rbd_image_uuid, progress, mrout, detect_zeros, jobs):
+    # A header-only pass over a seekable diff fixes the BAT, the BATMAP and the layout of the blocks.
+    # Then `jobs` workers fill runs of VHD_PARALLEL_CHUNK_BLOCKS blocks each: they copy payloads and
+    # write the sector bitmaps at the precomputed offsets, through their own file handles.
+    # Returns False, with nothing written, if the records are not in ascending order without overlaps.
+    meta = ['', '', 0]
+    extents = []
+    (blocks, full_blocks) = vhd_plan_blocks(rbd_diff_collect_extents(rbd_diff_records(RBDDIFF_FH, RBD_DIFF_SCAN_BUFFER_SIZE, skip_data=True), meta, extents))
+    if not all(extents[index-1][_rbd_record_offset_] + extents[index-1][_rbd_record_length_] <= extents[index][_rbd_record_offset_] for index in range(1, len(extents))):
+        # Workers find the records of a block by bisection and would apply overlapping ones out of file order
+        INFO("VHD: Records of '%s' are not in ascending order, converting sequentially" % rbd)
+        return False
+    (from_snap_name, to_snap_name, image_size) = meta
+    if not from_snap_name:
+        # Sectors which are not marked in a dynamic disk read as zeros
+        extents = [extent for extent in extents if extent[_rbd_record_tag_] == RBD_DIFF_RECORD_DATA]
+    block_bitmap_size = get_size_aligned_to_sector_boundary(VHD_DEFAULT_BLOCK_SIZE/SECTOR_SIZE/8)
+
+    (VHD_FOOTER, vhd_bat) = write_vhd_stream_prologue(VHD_FH, image_size, rbd_image_uuid, from_snap_name, to_snap_name, blocks, full_blocks, block_bitmap_size)
+    footer_offset = VHD_FH.tell() + len(blocks)*(block_bitmap_size + VHD_DEFAULT_BLOCK_SIZE)
+    VHD_FH.flush()
+
+    extent_ends = [offset + length for (record_tag, offset, length, position) in extents]
+    chunks = Queue.Queue()
+    for index in range(0, len(blocks), VHD_PARALLEL_CHUNK_BLOCKS):
+        chunk_blocks = blocks[index:index+VHD_PARALLEL_CHUNK_BLOCKS]
+        chunks.put((chunk_blocks, bisect.bisect_right(extent_ends, chunk_blocks[0]*VHD_DEFAULT_BLOCK_SIZE)))
+
+    # [blocks done, errors], shared by the workers under status_lock
+    status = [0, []]
+    status_lock = threading.Lock()
+    zero_detectors = []
+    workers = []
+    for index in range(min(jobs, max(chunks.qsize(), 1))):
+        zero_detector = ZeroDetector() if detect_zeros else None
+        zero_detectors.append(zero_detector)
+        worker = threading.Thread(target=vhd_parallel_worker, args=(rbd, vhd, vhd_bat, extents, chunks, block_bitmap_size, zero_detector, status, status_lock))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    INFO("VHD: %d workers convert %d blocks in runs of %d" % (len(workers), len(blocks), VHD_PARALLEL_CHUNK_BLOCKS))
+
+    _prev_percent_ = -1
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(VHD_PROGRESS_INTERVAL)
+            if (progress):
+                _percent_ = (100*status[0])//max(len(blocks), 1)
+                if _prev_percent_ != _percent_ :
+                    _prev_percent_ = _percent_
+                    if (mrout):
+                        MROUTPUT("Progress: %d" % _percent_)
+                    else:
+                        eprint("Progress: %d" % _percent_)
 
+    if len(status[1]) > 0:
+        ERROR("VHD: %d of %d workers failed" % (len(status[1]), len(workers)))
+        sys.exit(max(status[1]))
+
+    VHD_FH.seek(footer_offset, 0)
+    VHD_FH.write(VHD_FOOTER)
+
+    if detect_zeros:
+        INFO("ZERO: %d bytes of zero data elided" % sum(zero_detector.elided_bytes for zero_detector in zero_detectors))
     if (progress):
         if (mrout):
             MROUTPUT("Progress: 100")
@@ -869,21 +2234,254 @@ def rbd2raw(rbd, raw, progress, mrout):
         else:
             eprint("Progress: 100")
 
-    RAW_FH.close
-    if RBDDIFF_FH is not sys.stdin:
-        RBDDIFF_FH.close
+    return True
+
+def vhd_parallel_worker(rbd, vhd, vhd_bat, extents, chunks, block_bitmap_size, zero_detector, status, status_lock):
+    # Positional reads and writes go through handles of this worker, so that seek() + read()/write()
+    # needs no locking where os.pread()/os.pwrite() are missing. Both release the GIL while copying.
+    RBDDIFF_FH = None
+    VHD_FH = None
+    view = memoryview(bytearray(VHD_DEFAULT_BLOCK_SIZE))
+    try:
+        RBDDIFF_FH = io.open(rbd, "rb", buffering=0)
+        VHD_FH = io.open(vhd, "r+b", buffering=0)
+        while True:
+            try:
+                (chunk_blocks, index) = chunks.get_nowait()
+            except Queue.Empty:
+                break
+            end = (chunk_blocks[-1] + 1)*VHD_DEFAULT_BLOCK_SIZE
+            bitmaps = {}
+            while (index < len(extents)) and (extents[index][_rbd_record_offset_] < end):
+                (record_tag, offset, length, position) = extents[index]
+                segment_offset = max(offset, chunk_blocks[0]*VHD_DEFAULT_BLOCK_SIZE)
+                segment_end = min(offset + length, end)
+                while segment_offset < segment_end:
+                    BlockNumber = segment_offset // VHD_DEFAULT_BLOCK_SIZE
+                    offset_in_block = segment_offset % VHD_DEFAULT_BLOCK_SIZE
+                    chunk = min(segment_end, (BlockNumber + 1)*VHD_DEFAULT_BLOCK_SIZE) - segment_offset
+                    if BlockNumber not in bitmaps:
+                        bitmaps[BlockNumber] = gen_empty_bitarray_for_bitmap(block_bitmap_size)
+                    bitmap_set_range(bitmaps[BlockNumber], offset_in_block/SECTOR_SIZE, chunk/SECTOR_SIZE)
+                    if record_tag == RBD_DIFF_RECORD_DATA:
+                        rbd_diff_pread(RBDDIFF_FH, position + segment_offset - offset, view[0:chunk])
+                        data_offset = vhd_bat[BlockNumber]*SECTOR_SIZE + block_bitmap_size + offset_in_block
+                        if zero_detector is None:
+                            raw_pwrite(VHD_FH, data_offset, view[0:chunk])
+                        else:
+                            # Zeroed runs stay holes of the block
+                            for (run_offset, run_length, run_zero) in zero_detector.runs(view[0:chunk], segment_offset, chunk):
+                                if not run_zero:
+                                    raw_pwrite(VHD_FH, data_offset + run_offset, view[run_offset:run_offset+run_length])
+                    segment_offset += chunk
+                index += 1
+            for BlockNumber in chunk_blocks:
+                DEBUG("VHD: Write block %d sector bitmap" % BlockNumber)
+                raw_pwrite(VHD_FH, vhd_bat[BlockNumber]*SECTOR_SIZE, gen_bitmap_from_bitarray(bitmaps.get(BlockNumber, gen_empty_bitarray_for_bitmap(block_bitmap_size))))
+            with status_lock:
+                status[0] += len(chunk_blocks)
+    except SystemExit as e:
+        with status_lock:
+            status[1].append(e.code if isinstance(e.code, int) else 1)
+    except Exception as e:
+        ERROR("VHD: Worker failed: %s" % e)
+        with status_lock:
+            status[1].append(1)
+    finally:
+        if VHD_FH is not None:
+            VHD_FH.close()
+        if RBDDIFF_FH is not None:
+            RBDDIFF_FH.close()
+
+def vhd_create(vhd, mrout):
+    if vhd == "-":
+        if mrout:
+            ERROR("VHD: Machine readable output and VHD on stdout can't be combined")
+            sys.exit(1)
+        return io.open(sys.stdout.fileno(), "wb", closefd=False)
+    else:
+        return open(vhd, "wb")
 
-    return 0
-#-------------------------------------------------------------------------------------------------------------------------------------------------------#
-def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
+def is_seekable_file(FH):
+    mode = os.fstat(FH.fileno()).st_mode
+    return stat.S_ISREG(mode) or stat.S_ISBLK(mode)
 
-    VHD_FH = open(vhd, "wb")
-    if rbd == "-":
-        RBDDIFF_FH = sys.stdin
-    else:
-        RBDDIFF_FH = open(rbd, "rb")
+def vhd_plan_blocks(records, ordered=False):
+    # Returns (blocks, full blocks): the numbers of the VHD blocks the records allocate, in ascending
+    # order, and of those the ones whose sector bitmaps the records fill. Zero records allocate blocks
+    # only in differencing disks, where they mask the parent. With ordered, records that go back to
+    # a lower block are refused, as rbd_records2vhd_stream() refuses them.
+    parent_exists = False
+    block_bitmap_size = get_size_aligned_to_sector_boundary(VHD_DEFAULT_BLOCK_SIZE/SECTOR_SIZE/8)
+    bitmaps = {}
+    last_block = None
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        if record_tag == RBD_DIFF_RECORD_FROM_SNAP:
+            parent_exists = True
+        elif (record_tag == RBD_DIFF_RECORD_DATA) or ((record_tag == RBD_DIFF_RECORD_ZERO) and parent_exists):
+            offset = record[_rbd_record_offset_]
+            end = offset + record[_rbd_record_length_]
+            while offset < end:
+                block_number = offset // VHD_DEFAULT_BLOCK_SIZE
+                offset_in_block = offset % VHD_DEFAULT_BLOCK_SIZE
+                chunk = min(end - offset, VHD_DEFAULT_BLOCK_SIZE - offset_in_block)
+                if ordered and (last_block is not None) and (block_number < last_block):
+                    ERROR("RBD: Records are not sorted by offset, offset 0x%08x follows block %d" % (offset, last_block))
+                    sys.exit(2)
+                last_block = block_number
+                if block_number not in bitmaps:
+                    bitmaps[block_number] = gen_empty_bitarray_for_bitmap(block_bitmap_size)
+                bitmap_set_range(bitmaps[block_number], offset_in_block/SECTOR_SIZE, chunk/SECTOR_SIZE)
+                offset += chunk
+    blocks = sorted(bitmaps)
+    return (blocks, [block_number for block_number in blocks if is_full_bitmap(bitmaps[block_number])])
+
+def write_vhd_stream_prologue(VHD_FH, image_size, rbd_image_uuid, from_snap_name, to_snap_name, blocks, full_blocks, block_bitmap_size):
+    # Writes the prologue with the blocks laid out one after another behind it, returns (footer, BAT)
+    bat = gen_empty_vhd_bat(image_size)
+    # The prologue length depends on the BAT size only, not on its entries
+    block_offset = len(gen_vhd_prologue(image_size, rbd_image_uuid, from_snap_name, to_snap_name, bat)[2])
+    for block_number in blocks:
+        bat[block_number] = block_offset / SECTOR_SIZE
+        block_offset += block_bitmap_size + VHD_DEFAULT_BLOCK_SIZE
+    (VHD_FOOTER, vhd_dynamic_disk_header_struct, VHD_PROLOGUE) = gen_vhd_prologue(image_size, rbd_image_uuid, from_snap_name, to_snap_name, bat, full_blocks)
+    VHD_FH.write(VHD_PROLOGUE)
+    INFO("VHD: Wrote headers and BAT with %d allocated blocks, %d of them full" % (len(blocks), len(full_blocks)))
+    return (VHD_FOOTER, bat)
+
+def emit_vhd_stream_block(SINK, block_number, block_bitmap, block_data, emitted_blocks, full_blocks, planned_blocks):
+    if planned_blocks is not None:
+        if (len(emitted_blocks) >= len(planned_blocks)) or (planned_blocks[len(emitted_blocks)] != block_number):
+            ERROR("VHD: Block %d was not planned by the pre-scan" % block_number)
+            sys.exit(2)
+    DEBUG("VHD: Emit block %d" % block_number)
+    SINK.write(gen_bitmap_from_bitarray(block_bitmap))
+    SINK.write(block_data)
+    emitted_blocks.append(block_number)
+    if is_full_bitmap(block_bitmap):
+        full_blocks.append(block_number)
+
+def rbd_records2vhd_stream(records, VHD_FH, rbd_image_uuid, progress, mrout, plan=None):
+    # Writes records in the order of rbd_diff_records() to a dynamic or differencing VHD without
+    # seeking, e.g. to a pipe. Every block is assembled in memory, bitmap included, before it is
+    # emitted. With a plan from vhd_plan_blocks() the BAT and BATMAP are known up front and blocks go
+    # straight to VHD_FH. Otherwise they are spooled until the end of the records fixes the BAT.
+    from_snap_name = ''
+    to_snap_name = ''
+    image_size = 0
+    parent_exists = False
+    vhd_headers_written = False
+    block_bitmap_size = get_size_aligned_to_sector_boundary(VHD_DEFAULT_BLOCK_SIZE/SECTOR_SIZE/8)
+    block_number = None
+    block_bitmap = None
+    block_data = None
+    emitted_blocks = []
+    full_blocks = []
+    planned_blocks = plan[0] if plan is not None else None
+    _prev_percent_ = 0
+
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 0")
+        else:
+            eprint("Progress: 0")
+
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        if record_tag == RBD_DIFF_RECORD_FROM_SNAP:
+            from_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            parent_exists = True
+            INFO("RBD: From snap = %s" % from_snap_name)
+            continue
+        elif record_tag == RBD_DIFF_RECORD_TO_SNAP:
+            to_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: To snap = %s" % to_snap_name)
+            continue
+        elif record_tag == RBD_DIFF_RECORD_SIZE:
+            image_size = record[_rbd_record_length_]
+            INFO("RBD: Image size = %d" % image_size)
+            continue
+
+        if not vhd_headers_written:
+            if planned_blocks is not None:
+                SINK = VHD_FH
+                (VHD_FOOTER, vhd_bat) = write_vhd_stream_prologue(VHD_FH, image_size, rbd_image_uuid, from_snap_name, to_snap_name, plan[0], plan[1], block_bitmap_size)
+            else:
+                SINK = tempfile.SpooledTemporaryFile(max_size=VHD_STREAM_SPOOL_MEMORY_SIZE)
+                INFO("VHD: RBD diff is not seekable, spooling blocks until the BAT is known")
+            vhd_headers_written = True
+
+        if record_tag == RBD_DIFF_RECORD_END:
+            break
+        if (record_tag == RBD_DIFF_RECORD_ZERO) and (parent_exists == False):
+            # Sectors which are not marked in a dynamic disk read as zeros
+            continue
+
+        offset = record[_rbd_record_offset_]
+        length = record[_rbd_record_length_]
+        data = record[_rbd_record_data_] if record_tag == RBD_DIFF_RECORD_DATA else None
+        data_offset = 0
+        while length > 0:
+            BlockNumber = offset // VHD_DEFAULT_BLOCK_SIZE
+            offset_in_block = offset % VHD_DEFAULT_BLOCK_SIZE
+            chunk = min(length, VHD_DEFAULT_BLOCK_SIZE - offset_in_block)
+            if BlockNumber != block_number:
+                if block_number is not None:
+                    emit_vhd_stream_block(SINK, block_number, block_bitmap, block_data, emitted_blocks, full_blocks, planned_blocks)
+                if (len(emitted_blocks) > 0) and (BlockNumber < emitted_blocks[-1]):
+                    ERROR("RBD: Records are not sorted by offset, offset 0x%08x follows block %d" % (offset, emitted_blocks[-1]))
+                    sys.exit(2)
+                INFO("VHD: New block %d allocated" % BlockNumber)
+                block_number = BlockNumber
+                block_bitmap = gen_empty_bitarray_for_bitmap(block_bitmap_size)
+                block_data = bytearray(VHD_DEFAULT_BLOCK_SIZE)
+            bitmap_set_range(block_bitmap, offset_in_block / SECTOR_SIZE, chunk / SECTOR_SIZE)
+            if data is not None:
+                block_data[offset_in_block:offset_in_block+chunk] = get_data_view(data, data_offset, chunk)
+            offset += chunk
+            data_offset += chunk
+            length -= chunk
+
+            if (progress) and (image_size > 0):
+                _percent_ = (100*offset)//image_size
+                if _prev_percent_ != _percent_ :
+                    _prev_percent_ = _percent_
+                    if (mrout):
+                        MROUTPUT("Progress: %d" % _percent_)
+                    else:
+                        eprint("Progress: %d" % _percent_)
+
+    if not vhd_headers_written:
+        ERROR("RBD: Unexpected end of RBD diff before any data record")
+        sys.exit(2)
+    if block_number is not None:
+        emit_vhd_stream_block(SINK, block_number, block_bitmap, block_data, emitted_blocks, full_blocks, planned_blocks)
+
+    if planned_blocks is None:
+        (VHD_FOOTER, vhd_bat) = write_vhd_stream_prologue(VHD_FH, image_size, rbd_image_uuid, from_snap_name, to_snap_name, emitted_blocks, full_blocks, block_bitmap_size)
+        SINK.seek(0, 0)
+        shutil.copyfileobj(SINK, VHD_FH, VHD_DEFAULT_BLOCK_SIZE)
+        SINK.close()
+    elif (emitted_blocks, full_blocks) != plan:
+        ERROR("VHD: Pre-scan planned %d blocks (%d full), the records allocated %d (%d full)" % (len(plan[0]), len(plan[1]), len(emitted_blocks), len(full_blocks)))
+        sys.exit(2)
+
+    VHD_FH.write(VHD_FOOTER)
+    VHD_FH.flush()
+
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 100")
+            MROUTPUT("")
+        else:
+            eprint("Progress: 100")
+
+    return 0
 
-    rbd_header = RBDDIFF_FH.read(len(RBD_HEADER))
+def rbd_records2vhd(records, VHD_FH, rbd_image_uuid, progress, mrout):
+    # Writes records in the order of rbd_diff_records() to a dynamic or differencing VHD,
+    # the records have to be sorted by offset
 
     rbd_meta_read_finished = 0
     vhd_headers_written = 0
@@ -894,249 +2492,144 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
     rbd_eof = False
     rbd_data_exists = False
     allocated_block_count=0
+    last_block_number = None
     last_written_sector_in_block = 0
     _prev_percent_ = 0
 
-    while True:
-        record_tag = RBDDIFF_FH.read(RBD_DIFF_META_RECORD_TAG_SIZE)
-        #record_tag = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_RECORD_TAG), record)
-        if not record_tag:
-            INFO("RBD: Unexpected EOF")
-            break
-        else:
-            INFO("RBD: Record TAG = \'%c\'" % record_tag)
-            if record_tag == "e":
-                INFO("RBD: Got EOF record TAG")
-                rbd_eof = True
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
-            if record_tag == "f":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                from_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                from_snap_name = regex.sub('', from_snap_name)
-                INFO("RBD: From snap = %s" % from_snap_name)
-            elif record_tag == "t":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SNAP_SIZE)
-                snap_name_length = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SNAP), record)[0])
-                record = RBDDIFF_FH.read(snap_name_length)
-                to_snap_name = unpack("%s%ds" % (RBD_DIFF_META_ENDIAN_PREFIX, snap_name_length),record)[0]
-                regex = re.compile(SNAPSHOT_PREFIX)
-                to_snap_name = regex.sub('', to_snap_name)
-                INFO("RBD: To snap = %s" % to_snap_name)
-            elif record_tag == "s":
-                record = RBDDIFF_FH.read(RBD_DIFF_META_SIZE_SIZE)
-                image_size = int(unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_META_SIZE), record)[0])
-                INFO("RBD: Image size = %d" % image_size)
-            elif record_tag == "w":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
-                INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
-                rbd_data_exists = True
-            elif record_tag == "z":
-                record = RBDDIFF_FH.read(RBD_DIFF_DATA_SIZE)
-                _record_ = unpack("%s%s" % (RBD_DIFF_META_ENDIAN_PREFIX, RBD_DIFF_DATA), record)
-                offset = _record_[0]
-                length = _record_[1]
-                INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
-                if rbd_meta_read_finished == 0:
-                    rbd_meta_read_finished = 1
-                rbd_data_exists = True
-            elif (rbd_eof == False):
-                ERROR("RBD: Error while reading rbd_diff file")
-                sys.exit(2)
-
-            if (rbd_meta_read_finished == 1) & (vhd_headers_written == 0):
-                if rbd_image_uuid == '':
-                    ERROR("RBD: RBD image UUID is not specified")
-                    sys.exit(1)
-                if from_snap_name:
-                        parent_uuid = uuid.UUID(from_snap_name)
-                        parent_exists = True
-                else:
-                        parent_uuid = uuid.UUID('00000000-0000-0000-0000-000000000000')
-                        parent_exists = False
-                if to_snap_name:
-                    vhd_uuid = uuid.UUID(to_snap_name)
-                    rbd_uuid = uuid.UUID(rbd_image_uuid)
-                else:
-                    vhd_uuid = uuid.UUID(rbd_image_uuid)
-                    rbd_uuid = uuid.UUID(rbd_image_uuid)
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        INFO("RBD: Record TAG = \'%c\'" % record_tag)
+        if record_tag == RBD_DIFF_RECORD_END:
+            INFO("RBD: Got EOF record TAG")
+            rbd_eof = True
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+        if record_tag == RBD_DIFF_RECORD_FROM_SNAP:
+            from_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: From snap = %s" % from_snap_name)
+        elif record_tag == RBD_DIFF_RECORD_TO_SNAP:
+            to_snap_name = SNAPSHOT_PREFIX_RE.sub('', record[_rbd_record_data_])
+            INFO("RBD: To snap = %s" % to_snap_name)
+        elif record_tag == RBD_DIFF_RECORD_SIZE:
+            image_size = record[_rbd_record_length_]
+            INFO("RBD: Image size = %d" % image_size)
+        elif record_tag == RBD_DIFF_RECORD_DATA:
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            INFO("RBD: Data offset = 0x%08x and length = %d" % (offset, length))
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+            rbd_data_exists = True
+        elif record_tag == RBD_DIFF_RECORD_ZERO:
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            INFO("RBD: Zero data offset = 0x%08x and length = %d" % (offset, length))
+            if rbd_meta_read_finished == 0:
+                rbd_meta_read_finished = 1
+            rbd_data_exists = True
+
+        if (rbd_meta_read_finished == 1) & (vhd_headers_written == 0):
+            parent_exists = bool(from_snap_name)
+            vhd_bat = gen_empty_vhd_bat(image_size)
+            vhd_bat_dirty_sectors = set()
+            (VHD_FOOTER, vhd_dynamic_disk_header_struct, VHD_PROLOGUE) = gen_vhd_prologue(image_size, rbd_image_uuid, from_snap_name, to_snap_name, vhd_bat)
+
+            VHD_FH.write(VHD_PROLOGUE)
+            vhd_file_offset = len(VHD_PROLOGUE)
+
+            vhd_headers_written = 1
+            block_bitmap_size = get_bitmap_size(vhd_dynamic_disk_header_struct)
+            data_offset = vhd_file_offset
+
+            if (rbd_eof == True):
+                break
 
-                if parent_exists:
-                    vhd_footer_struct = gen_vhd_footer_struct(VHD_DIFF_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, 0)
-                else:
-                    vhd_footer_struct = gen_vhd_footer_struct(VHD_DYNAMIC_HARDDISK_TYPE, image_size, vhd_uuid.bytes, rbd_uuid.bytes, 0)
-                VHD_FOOTER = pack(VHD_FOTTER_FORMAT, *vhd_footer_struct)
-                vhd_footer_struct = modTupleByIndex(vhd_footer_struct, _vhd_footter_checksum_, checksum(VHD_FOOTER))
-                VHD_FOOTER = pack(VHD_FOTTER_FORMAT, *vhd_footer_struct)
-
-                if parent_exists:
-                    vhd_dynamic_disk_header_struct = gen_vhd_dynamic_disk_header_struct(VHD_FOTTER_RECORD_SIZE+VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE, image_size, 0, parent_uuid.bytes, "%s.vhd" % str(parent_uuid))
-                    vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_parent_time_stamp_, time.time()-946684800) #????
+            DEBUG("VHD: Begining of data - offset 0x%08x" % data_offset)
+            DEBUG("VHD: Begining of data - real offset 0x%08x" % VHD_FH.tell())
+
+        if (rbd_meta_read_finished == 1) & (vhd_headers_written == 1) & (rbd_eof == False) & (record_tag == RBD_DIFF_RECORD_ZERO) & (parent_exists == False):
+            # Sectors which are not marked in a dynamic disk read as zeros, so
+            # zero extents need neither allocated blocks nor bitmap bits
+            DEBUG("VHD: Skip zero data offset = 0x%08x and length = %d" % (offset, length))
+        elif (rbd_meta_read_finished == 1) & (vhd_headers_written == 1) & (rbd_eof == False):
+            _offset_ = offset
+            _data_offset_ = 0
+            _total_blocks_ = image_size / VHD_DEFAULT_BLOCK_SIZE
+            while length > 0:
+                SectorsPerBlock = VHD_DEFAULT_BLOCK_SIZE / SECTOR_SIZE
+                RawSectorNumber = _offset_ / SECTOR_SIZE
+                BlockNumber = RawSectorNumber // (VHD_DEFAULT_BLOCK_SIZE//SECTOR_SIZE)
+                SectorInBlock = RawSectorNumber % SectorsPerBlock
+
+                if (vhd_bat[BlockNumber] != VHD_BAT_UNUSED_ENTRY) and (BlockNumber != last_block_number):
+                    # Blocks are written one after another, an earlier one can't be reopened
+                    ERROR("RBD: Records are not sorted by offset, offset 0x%08x follows block %d" % (_offset_, last_block_number))
+                    sys.exit(2)
+                if vhd_bat[BlockNumber] == VHD_BAT_UNUSED_ENTRY:
+                    if last_written_sector_in_block != 0:
+                        DEBUG("VHD: Write %d zero sectors to the end of block" % (SectorsPerBlock - SectorInBlock - read_sectors))
+                        _buffer_ = pack("!%ds" % ((SectorsPerBlock - last_written_sector_in_block)*SECTOR_SIZE), '')
+                        VHD_FH.write(_buffer_)
+                        vhd_file_offset += (SectorsPerBlock - SectorInBlock - read_sectors)*SECTOR_SIZE
+                    INFO("VHD: New block %d allocated" % BlockNumber)
+                    block_offset_in_bytes = data_offset+allocated_block_count*VHD_DEFAULT_BLOCK_SIZE + block_bitmap_size*allocated_block_count
+                    block_offset_in_sectors = block_offset_in_bytes / SECTOR_SIZE
+                    vhd_bat[BlockNumber] = block_offset_in_sectors
+                    vhd_bat_dirty_sectors.add(BlockNumber // VHD_BAT_ENTRIES_PER_SECTOR)
+                    DEBUG("VHD: New block offset in bytes 0x%08x" % block_offset_in_bytes)
+                    DEBUG("VHD: New block offset in sectors %d" % block_offset_in_sectors)
+                    allocated_block_count = allocated_block_count + 1
+                    last_block_number = BlockNumber
+                    DEBUG("VHD: Write %d bytes of empty sectors bitmap" % block_bitmap_size)
+                    VHD_FH.write(gen_bitmap_from_bitarray(gen_empty_bitarray_for_bitmap(block_bitmap_size)))
+                    DEBUG("VHD: Skeep %d bytes (%d sectors)" % (SectorInBlock*SECTOR_SIZE, SectorInBlock))
+                    VHD_FH.seek(SectorInBlock*SECTOR_SIZE,1)
+                    vhd_file_offset += block_bitmap_size + SectorInBlock*SECTOR_SIZE
+                    last_written_sector_in_block = 0
+
+                if length < (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE:
+                    read_length = length
+                    length = 0
                 else:
-                    vhd_dynamic_disk_header_struct = gen_vhd_dynamic_disk_header_struct(VHD_FOTTER_RECORD_SIZE+VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE, image_size, 0, '', '')
-                VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-                vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, checksum(VHD_DYNAMIC_DISK_HEADER))
-                VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-
-                vhd_bat_list = gen_empty_vhd_bat(image_size)
-                VHD_BAT = pack_vhd_bat(vhd_bat_list)
-
-                vhd_file_offset = 0
-
-                VHD_FH.write(VHD_FOOTER)
-                vhd_file_offset += VHD_FOTTER_RECORD_SIZE
-
-                VHD_FH.write(VHD_DYNAMIC_DISK_HEADER)
-                vhd_file_offset += VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE
-
-                VHD_FH.write(VHD_BAT)
-                vhd_file_offset += len(VHD_BAT)
-
-                VHD_BATMAP = gen_empty_batmap()
-                vhd_batmap_header_struct = gen_batmap_header(VHD_BATMAP)
-                vhd_batmap_header_struct = modTupleByIndex(vhd_batmap_header_struct, _batmap_offset_, vhd_file_offset+VHD_BATMAP_HEADER_SIZE)
-                vhd_batmap_header_struct = modTupleByIndex(vhd_batmap_header_struct, _batmap_size_, len(VHD_BATMAP)/SECTOR_SIZE)
-                vhd_batmap_header_struct = modTupleByIndex(vhd_batmap_header_struct, _batmap_checksum_, checksum(VHD_BATMAP))
-                VHD_BATMAP_HEADER = pack(VHD_BATMAP_HEADER_FORMAT, *vhd_batmap_header_struct)
-
-                VHD_FH.write(VHD_BATMAP_HEADER)
-                vhd_file_offset += VHD_BATMAP_HEADER_SIZE
-
-                VHD_FH.write(VHD_BATMAP)
-                vhd_file_offset += len(VHD_BATMAP)
-
-                for index in range(VHD_PARENT_LOCATORS_COUNT):
-                    if parent_exists:
-                        if index == 0:
-                            parent_locator = "file://./%s.vhd" % parent_uuid
-                            parent_locator_encoded = parent_locator
-                            parent_locator_entry_struct = (_platform_code_MacX_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #MacX
-                        elif index == 1:
-                            parent_locator = ".\%s.vhd" % parent_uuid
-                            parent_locator_encoded = parent_locator.encode("UTF-16LE")
-                            parent_locator_entry_struct = (_platform_code_W2ku_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #W2ku
-                        elif index == 2:
-                            parent_locator = ".\%s.vhd" % parent_uuid
-                            parent_locator_encoded = parent_locator.encode("UTF-16LE")
-                            parent_locator_entry_struct = (_platform_code_W2ru_, get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), len(parent_locator_encoded), 0, vhd_file_offset) #W2ru
-                        else:
-                            parent_locator_encoded = ''
-                            parent_locator_entry_struct = (0x00000000, 0, 0, 0, 0) #empty
-                    else:
-                        parent_locator_encoded = ''
-                        parent_locator_entry_struct = (0x00000000, 0, 0, 0, 0) #empty
+                    read_length = (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE
+                    length = length - read_length
 
-                    if len(parent_locator_encoded) > 0:
-                        parent_locator_packed = pack("!%ds" % get_size_aligned_to_sector_boundary(len(parent_locator_encoded)), parent_locator_encoded)
-                    else:
-                        parent_locator_packed = pack("!%ds" % SECTOR_SIZE, parent_locator_encoded)
+                read_sectors = read_length/SECTOR_SIZE
 
-                    parent_locator_entry = pack(VHD_PARENT_LOCATOR_ENTRY_FORMAT, *parent_locator_entry_struct)
-                    vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_parent_locator_entry_1_ + index, parent_locator_entry)
+                if not blocks_bitmaps.has_key(BlockNumber):
+                    blocks_bitmaps[BlockNumber] = gen_empty_bitarray_for_bitmap(block_bitmap_size)
+                bitmap_set_range(blocks_bitmaps[BlockNumber], SectorInBlock, read_sectors)
 
-                    VHD_FH.write(parent_locator_packed)
-                    vhd_file_offset += len(parent_locator_packed)
+                DEBUG("VHD: SectorsPerBlock %d, SectorInBlock %d, read_sectors %d" % (SectorsPerBlock, SectorInBlock, read_sectors))
 
-                #print_vhd_footer(vhd_footer_struct)
-                #print_dynamic_disk_header(dynamic_disk_header_struct)
+                if last_written_sector_in_block != 0:
+                    sectors_to_skeep = SectorInBlock - last_written_sector_in_block
+                    DEBUG("VHD: Skeep %d sectors to the next sector with data" % sectors_to_skeep)
+                    VHD_FH.seek(sectors_to_skeep*SECTOR_SIZE,1)
+                    vhd_file_offset += sectors_to_skeep*SECTOR_SIZE
 
-                vhd_headers_written = 1
-                block_bitmap_size = get_bitmap_size(vhd_dynamic_disk_header_struct)
-                data_offset = vhd_file_offset
+                if record_tag == RBD_DIFF_RECORD_DATA:
+                    INFO("RBD->VHD: Write %d bytes of data" % read_length)
+                    VHD_FH.write(record[_rbd_record_data_][_data_offset_:_data_offset_+read_length])
+                else:
+                    # The data area of a freshly allocated block is a hole in the
+                    # output file, only the bitmap has to mask the parent's sectors
+                    INFO("RBD->VHD: Skip %d bytes of zero data" % read_length)
+                    VHD_FH.seek(read_length,1)
+                vhd_file_offset += read_length
+                _offset_ += read_length
+                _data_offset_ += read_length
 
-                if (rbd_eof == True):
-                    break
+                last_written_sector_in_block = SectorInBlock + read_sectors
 
-                DEBUG("VHD: Begining of data - offset 0x%08x" % data_offset)
-                DEBUG("VHD: Begining of data - real offset 0x%08x" % VHD_FH.tell())
-
-            if (rbd_meta_read_finished == 1) & (vhd_headers_written == 1) & (rbd_eof == False):
-                _offset_ = offset
-                _total_blocks_ = image_size / VHD_DEFAULT_BLOCK_SIZE
-                while length > 0:
-                    SectorsPerBlock = VHD_DEFAULT_BLOCK_SIZE / SECTOR_SIZE
-                    RawSectorNumber = _offset_ / SECTOR_SIZE
-                    BlockNumber = RawSectorNumber // (VHD_DEFAULT_BLOCK_SIZE//SECTOR_SIZE)
-                    SectorInBlock = RawSectorNumber % SectorsPerBlock
-
-                    if vhd_bat_list[BlockNumber] == 0xffffffff:
-                        if last_written_sector_in_block != 0:
-                            DEBUG("VHD: Write %d zero sectors to the end of block" % (SectorsPerBlock - SectorInBlock - read_sectors))
-                            _buffer_ = pack("!%ds" % ((SectorsPerBlock - last_written_sector_in_block)*SECTOR_SIZE), '')
-                            VHD_FH.write(_buffer_)
-                            vhd_file_offset += (SectorsPerBlock - SectorInBlock - read_sectors)*SECTOR_SIZE
-                        INFO("VHD: New block %d allocated" % BlockNumber)
-                        block_offset_in_bytes = data_offset+allocated_block_count*VHD_DEFAULT_BLOCK_SIZE + block_bitmap_size*allocated_block_count
-                        block_offset_in_sectors = block_offset_in_bytes / SECTOR_SIZE
-                        vhd_bat_list[BlockNumber] = block_offset_in_sectors
-                        DEBUG("VHD: New block offset in bytes 0x%08x" % block_offset_in_bytes)
-                        DEBUG("VHD: New block offset in sectors %d" % block_offset_in_sectors)
-                        allocated_block_count = allocated_block_count + 1
-                        DEBUG("VHD: Write %d bytes of empty sectors bitmap" % len(gen_bitmap_from_bitarray(gen_empty_bitarray_for_bitmap(block_bitmap_size))))
-                        VHD_FH.write(gen_bitmap_from_bitarray(gen_empty_bitarray_for_bitmap(block_bitmap_size)))
-                        DEBUG("VHD: Skeep %d bytes (%d sectors)" % (SectorInBlock*SECTOR_SIZE, SectorInBlock))
-                        VHD_FH.seek(SectorInBlock*SECTOR_SIZE,1)
-                        vhd_file_offset += block_bitmap_size + SectorInBlock*SECTOR_SIZE
-                        last_written_sector_in_block = 0
-
-                    if length < (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE:
-                        if record_tag == "w":
-                            _buffer_ = RBDDIFF_FH.read(length)
-                        elif record_tag == "z":
-                            _buffer_ = pack("!%ds" % length, '')
-                        read_length = length
-                        length = 0
-                    else:
-                        if record_tag == "w":
-                            _buffer_ = RBDDIFF_FH.read((SectorsPerBlock-SectorInBlock)*SECTOR_SIZE)
-                        elif record_tag == "z":
-                            _buffer_ = pack("!%ds" % ((SectorsPerBlock-SectorInBlock)*SECTOR_SIZE), '')
-                        read_length = (SectorsPerBlock-SectorInBlock)*SECTOR_SIZE
-                        length = length - read_length
-
-                    read_sectors = read_length/SECTOR_SIZE
-
-                    for sector_index in range(read_length/SECTOR_SIZE):
-                        if blocks_bitmaps.has_key(BlockNumber):
-                            if blocks_bitmaps[BlockNumber][SectorInBlock+sector_index] == 0:
-                                del blocks_bitmaps[BlockNumber][SectorInBlock+sector_index]
-                                blocks_bitmaps[BlockNumber].insert(SectorInBlock+sector_index, 1)
+                if (progress):
+                    _percent_ = (100*BlockNumber)//_total_blocks_
+                    if _prev_percent_ != _percent_ :
+                        _prev_percent_ = _percent_
+                        if (mrout):
+                            MROUTPUT("Progress: %d" % _percent_)
                         else:
-                            blocks_bitmaps[BlockNumber] = gen_empty_bitarray_for_bitmap(block_bitmap_size)
-                            del blocks_bitmaps[BlockNumber][SectorInBlock+sector_index]
-                            blocks_bitmaps[BlockNumber].insert(SectorInBlock+sector_index, 1)
-
-                    DEBUG("VHD: SectorsPerBlock %d, SectorInBlock %d, read_sectors %d" % (SectorsPerBlock, SectorInBlock, read_sectors))
-
-                    if last_written_sector_in_block != 0:
-                        sectors_to_skeep = SectorInBlock - last_written_sector_in_block
-                        DEBUG("VHD: Skeep %d sectors to the next sector with data" % sectors_to_skeep)
-                        VHD_FH.seek(sectors_to_skeep*SECTOR_SIZE,1)
-                        vhd_file_offset += sectors_to_skeep*SECTOR_SIZE
-
-                    INFO("RBD->VHD: Write %d bytes of data" % len(_buffer_))
-                    VHD_FH.write(_buffer_)
-                    vhd_file_offset += read_length
-                    _offset_ += read_length
-
-                    last_written_sector_in_block = SectorInBlock + read_sectors
-
-                    if (progress):
-                        _percent_ = (100*BlockNumber)//_total_blocks_
-                        if _prev_percent_ != _percent_ :
-                            _prev_percent_ = _percent_
-                            if (mrout):
-                                MROUTPUT("Progress: %d" % _percent_)
-                            else:
-                                eprint("Progress: %d" % _percent_)
+                            eprint("Progress: %d" % _percent_)
 
     if last_written_sector_in_block != 0:
         DEBUG("VHD: Write %d zero sectors to the end of block" % (SectorsPerBlock - SectorInBlock - read_sectors))
@@ -1146,28 +2639,26 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
 
     VHD_FH.write(VHD_FOOTER)
     if (rbd_data_exists == True):
-        VHD_FH.seek(VHD_FOTTER_RECORD_SIZE,0)
-        vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, 0)
-        VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-        vhd_dynamic_disk_header_struct = modTupleByIndex(vhd_dynamic_disk_header_struct, _dynamic_disk_header_checksum_, checksum(VHD_DYNAMIC_DISK_HEADER))
-        VHD_DYNAMIC_DISK_HEADER = pack(VHD_DYNAMIC_DISK_HEADER_FORMAT, *vhd_dynamic_disk_header_struct)
-        VHD_FH.write(VHD_DYNAMIC_DISK_HEADER)
-        vhd_file_offset = VHD_FOTTER_RECORD_SIZE + VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE
-        VHD_BAT = pack_vhd_bat(vhd_bat_list)
-        VHD_FH.write(VHD_BAT)
-        vhd_file_offset += len(VHD_BAT)
-        INFO("VHD: Rewrite BAT (write %d entries, %d bytes)" % (vhd_dynamic_disk_header_struct[_dynamic_disk_header_max_table_entries_], vhd_dynamic_disk_header_struct[_dynamic_disk_header_max_table_entries_]*4))
+        # The headers and the empty BAT are on disk already, only the BAT sectors with allocated blocks change
+        table_offset = vhd_dynamic_disk_header_struct[_dynamic_disk_header_table_offset_]
+        dirty_sectors = write_vhd_bat_sectors(VHD_FH, table_offset, vhd_bat, vhd_bat_dirty_sectors)
+        INFO("VHD: Rewrite BAT (write %d of %d sectors)" % (dirty_sectors, get_size_aligned_to_sector_boundary(len(vhd_bat)*4)/SECTOR_SIZE))
+
+        full_blocks = [BlockNumber for BlockNumber in sorted(blocks_bitmaps) if is_full_bitmap(blocks_bitmaps[BlockNumber])]
+        VHD_FH.seek(table_offset + get_size_aligned_to_sector_boundary(len(vhd_bat)*4), 0)
+        VHD_FH.write(pack_vhd_batmap(gen_vhd_batmap(len(vhd_bat), full_blocks), VHD_FH.tell()))
+        vhd_file_offset = VHD_FH.tell()
+        INFO("VHD: Rewrite BATMAP (%d of %d allocated blocks are full)" % (len(full_blocks), len(blocks_bitmaps)))
 
         DEBUG("VHD: Current offset in VHD file is 0x%08x" % vhd_file_offset)
 
-        for BlockNumber in range(len(vhd_bat_list)):
-            if vhd_bat_list[BlockNumber] != 0xffffffff:
-                DEBUG("VHD: Block %d offset is 0x%08x, skeep 0x%08x bytes from last offest 0x%08x" % (BlockNumber, vhd_bat_list[BlockNumber]*SECTOR_SIZE, (vhd_bat_list[BlockNumber]*SECTOR_SIZE-vhd_file_offset), vhd_file_offset))
-                VHD_FH.seek((vhd_bat_list[BlockNumber]*SECTOR_SIZE-vhd_file_offset),1)
-                vhd_file_offset = vhd_bat_list[BlockNumber]*SECTOR_SIZE
-                INFO("VHD: Rewrite block %d sector bitmap" % BlockNumber)
-                VHD_FH.write(gen_bitmap_from_bitarray(blocks_bitmaps[BlockNumber]))
-                vhd_file_offset += block_bitmap_size
+        for BlockNumber in sorted(blocks_bitmaps):
+            DEBUG("VHD: Block %d offset is 0x%08x, skeep 0x%08x bytes from last offest 0x%08x" % (BlockNumber, vhd_bat[BlockNumber]*SECTOR_SIZE, (vhd_bat[BlockNumber]*SECTOR_SIZE-vhd_file_offset), vhd_file_offset))
+            VHD_FH.seek((vhd_bat[BlockNumber]*SECTOR_SIZE-vhd_file_offset),1)
+            vhd_file_offset = vhd_bat[BlockNumber]*SECTOR_SIZE
+            INFO("VHD: Rewrite block %d sector bitmap" % BlockNumber)
+            VHD_FH.write(gen_bitmap_from_bitarray(blocks_bitmaps[BlockNumber]))
+            vhd_file_offset += block_bitmap_size
 
     if (progress):
         if (mrout):
@@ -1176,34 +2667,308 @@ def rbd2vhd(rbd, vhd, rbd_image_uuid, progress, mrout):
         else:
             eprint("Progress: 100")
 
-    VHD_FH.close
-    if RBDDIFF_FH is not sys.stdin:
-        RBDDIFF_FH.close
-
     return 0
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
-def vhd2rbd(vhd, rbd, progress, mrout):
+def vhd_decode_block(block_index, bitmap, block_data, block_size, bitmap_size, zero_detector):
+    # Returns (data offset, length, is zero) runs of the sectors present in a block, offsets relative to the block data
+    BITMAPARRAY = get_bitarray_from_bitmap(bitmap, bitmap_size)
+    return vhd_decode_extents(block_index, get_bitmap_extents(BITMAPARRAY, block_size/SECTOR_SIZE), block_data, block_size, zero_detector)
+
+def vhd_decode_extents(block_index, extents, block_data, block_size, zero_detector):
+    runs = []
+    for (first_sector, sector_count) in extents:
+        DEBUG("VHD: Data sectors range (in block %d) %d - %d" % (block_index, first_sector, first_sector+sector_count-1))
+        if zero_detector is not None:
+            for (run_offset, run_length, run_zero) in zero_detector.runs(get_buffer_view(block_data, first_sector*SECTOR_SIZE, sector_count*SECTOR_SIZE),
+                                                                         get_raw_byte_offset_of_sector(block_index, first_sector, block_size, SECTOR_SIZE),
+                                                                         sector_count*SECTOR_SIZE):
+                # Offsets of runs are relative to the range passed in
+                runs.append((first_sector*SECTOR_SIZE + run_offset, run_length, run_zero))
+        else:
+            runs.append((first_sector*SECTOR_SIZE, sector_count*SECTOR_SIZE, False))
+    return runs
+
+def vhd_read_blocks(VHD, BAT_TABLE, block_size, bitmap_size, zero_detector):
+    # Yields (block index, block data, runs) of the allocated blocks in BAT order
+    for block_index in range(len(BAT_TABLE)):
+        if BAT_TABLE[block_index] != VHD_BAT_UNUSED_ENTRY:
+            DATA_BLOCK = vhd_read_block(VHD, BAT_TABLE[block_index], block_size, bitmap_size)
+            INFO("VHD: Read VHD block %d" % block_index)
+            yield (block_index, DATA_BLOCK[1], vhd_decode_block(block_index, DATA_BLOCK[0], DATA_BLOCK[1], block_size, bitmap_size, zero_detector))
+
+def vhd_read_blocks_parallel(vhd, BAT_TABLE, block_size, bitmap_size, zero_detectors, read_ahead):
+    # Same as vhd_read_blocks(), but one worker per entry of zero_detectors (None when not detecting zeros)
+    # reads and decodes blocks while the caller writes the diff. At most read_ahead blocks are being read
+    # or wait in the reorder buffer, which hands them out in BAT order.
+    allocated = [block_index for block_index in range(len(BAT_TABLE)) if BAT_TABLE[block_index] != VHD_BAT_UNUSED_ENTRY]
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    reorder = {}
+    workers = []
+    for zero_detector in zero_detectors:
+        worker = threading.Thread(target=vhd_block_reader, args=(vhd, BAT_TABLE, block_size, bitmap_size, zero_detector, tasks, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    INFO("VHD: Reading %d blocks with %d workers, up to %d blocks ahead" % (len(allocated), len(workers), read_ahead))
+
+    submitted = 0
+    try:
+        for position in range(len(allocated)):
+            while (submitted < len(allocated)) & (submitted - position < read_ahead):
+                tasks.put(allocated[submitted])
+                submitted += 1
+            block_index = allocated[position]
+            while block_index not in reorder:
+                (index, block_data, runs, error) = results.get()
+                if error is not None:
+                    ERROR("VHD: Failed to read VHD block %d: %s" % (index, error))
+                    sys.exit(2)
+                reorder[index] = (block_data, runs)
+            (block_data, runs) = reorder.pop(block_index)
+            yield (block_index, block_data, runs)
+    finally:
+        # Drop the blocks nobody has picked up yet and stop the workers
+        while True:
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                break
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+def vhd_block_reader(vhd, BAT_TABLE, block_size, bitmap_size, zero_detector, tasks, results):
+    # Reads blocks into private buffers through its own handle, so the I/O happens here
+    # and not in the caller through page faults on a shared mmap
+    VHD_FH = io.open(vhd, "rb", buffering=0)
+    try:
+        while True:
+            block_index = tasks.get()
+            if block_index is None:
+                break
+            try:
+                view = memoryview(bytearray(bitmap_size + block_size))
+                VHD_FH.seek(BAT_TABLE[block_index]*SECTOR_SIZE, 0)
+                received = 0
+                while received < len(view):
+                    read_bytes = VHD_FH.readinto(view[received:])
+                    if not read_bytes:
+                        raise IOError("Unexpected end of file at offset %d" % (BAT_TABLE[block_index]*SECTOR_SIZE + received))
+                    received += read_bytes
+                INFO("VHD: Read VHD block %d" % block_index)
+                runs = vhd_decode_block(block_index, view[0:bitmap_size], view[bitmap_size:], block_size, bitmap_size, zero_detector)
+                results.put((block_index, view[bitmap_size:], runs, None))
+            except Exception as e:
+                results.put((block_index, None, None, e))
+    finally:
+        VHD_FH.close()
+
+def vhd_read_metadata(VHD):
+    VHD_FOOTER = unpack_from(VHD_FOTTER_FORMAT, vhd_read(VHD, 0, VHD_FOTTER_RECORD_SIZE))
+    DYNAMIC_DISK_HEADER = unpack_from(VHD_DYNAMIC_DISK_HEADER_FORMAT, vhd_read(VHD, VHD_FOOTER[_vhd_footter_data_offset_], VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE))
+    BAT_TABLE = unpack_vhd_bat(vhd_read(VHD, DYNAMIC_DISK_HEADER[_dynamic_disk_header_table_offset_], DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]*4))
+    return (VHD_FOOTER, DYNAMIC_DISK_HEADER, BAT_TABLE)
+
+def vhd_get_parent_paths(VHD, DYNAMIC_DISK_HEADER):
+    # Returns the parent paths of the parent locators (file:// URIs and Windows relative/absolute paths),
+    # then the parent unicode name
+    paths = []
+    for index in range(_dynamic_disk_header_parent_locator_entry_8_ - _dynamic_disk_header_parent_locator_entry_1_ + 1):
+        parent_locator_entry = unpack(VHD_PARENT_LOCATOR_ENTRY_FORMAT, DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_locator_entry_1_ + index])
+        platform_code = parent_locator_entry[_parent_locator_platform_code_]
+        if platform_code not in (_platform_code_MacX_, _platform_code_W2ku_, _platform_code_W2ru_):
+            continue
+        parent_locator = str(bytearray(vhd_read(VHD, parent_locator_entry[_parent_locator_platform_data_offset_],
+                                                parent_locator_entry[_parent_locator_platform_data_length_])))
+        if platform_code == _platform_code_MacX_:
+            path = re.sub('^file://', '', parent_locator)
+        else:
+            path = parent_locator.decode("UTF-16LE").encode("UTF-8").replace('\\', '/')
+        DEBUG("VHD: Parent locator 0x%08x: '%s'" % (platform_code, path))
+        paths.append(path)
+    parent_unicode_name = DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unicode_name_].decode("UTF-16BE").rstrip(u'\x00')
+    if len(parent_unicode_name) > 0:
+        paths.append(parent_unicode_name.encode("UTF-8"))
+    return paths
+
+def vhd_find_parent(vhd, VHD, DYNAMIC_DISK_HEADER):
+    # Relative parent paths are relative to the directory of the child
+    for path in vhd_get_parent_paths(VHD, DYNAMIC_DISK_HEADER):
+        path = os.path.normpath(os.path.join(os.path.dirname(vhd), path))
+        if os.path.isfile(path):
+            return path
+    return None
+
+class VHDChain(object):
+    # A leaf VHD and the parents resolved through its parent locators, layer 0 is the leaf.
+    # The BAT of every layer is read when the chain is opened. Which layer owns each sector of
+    # a block is merged over all layers once and cached, so each sector bitmap is read once.
+
+    def __init__(self, vhd):
+        self.layers = []
+        self.owners = collections.OrderedDict()
+        seen = set()
+        path = vhd
+        parent_uuid = None
+        while True:
+            if (os.path.realpath(path) in seen) | (len(self.layers) >= VHD_CHAIN_MAX_DEPTH):
+                ERROR("VHD: Chain of '%s' loops or is deeper than %d layers" % (vhd, VHD_CHAIN_MAX_DEPTH))
+                sys.exit(2)
+            seen.add(os.path.realpath(path))
+            VHD = vhd_open(path)
+            (VHD_FOOTER, DYNAMIC_DISK_HEADER, BAT_TABLE) = vhd_read_metadata(VHD)
+            self.layers.append((path, VHD, VHD_FOOTER, DYNAMIC_DISK_HEADER, BAT_TABLE))
+            INFO("VHD: Chain layer %d is '%s'" % (len(self.layers)-1, path))
+            if parent_uuid is not None:
+                if VHD_FOOTER[_vhd_footter_unique_iq_] != parent_uuid:
+                    ERROR("VHD: '%s' has unique id %s, its child expects %s" % (path, uuid.UUID(bytes=VHD_FOOTER[_vhd_footter_unique_iq_]), uuid.UUID(bytes=parent_uuid)))
+                    sys.exit(2)
+                if (VHD_FOOTER[_vhd_footter_current_size_] != self.footer[_vhd_footter_current_size_]) | \
+                   (DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_] != self.block_size):
+                    ERROR("VHD: '%s' differs from its child in size or block size" % path)
+                    sys.exit(2)
+            else:
+                self.footer = VHD_FOOTER
+                self.header = DYNAMIC_DISK_HEADER
+                self.block_size = DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_]
+                self.bitmap_size = get_bitmap_size(DYNAMIC_DISK_HEADER)
+            if VHD_FOOTER[_vhd_footter_disk_type_] != _disk_type_differencing_hard_disk:
+                break
+            parent_uuid = DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unique_id_]
+            parent = vhd_find_parent(path, VHD, DYNAMIC_DISK_HEADER)
+            if parent is None:
+                ERROR("VHD: Parent %s of '%s' not found" % (uuid.UUID(bytes=parent_uuid), path))
+                sys.exit(2)
+            path = parent
+
+    def close(self):
+        for layer in self.layers:
+            vhd_close(layer[1])
+
+    def allocated_blocks(self):
+        # Blocks allocated in at least one layer
+        blocks = set()
+        for layer in self.layers:
+            BAT_TABLE = layer[4]
+            blocks.update(block_index for block_index in range(len(BAT_TABLE)) if BAT_TABLE[block_index] != VHD_BAT_UNUSED_ENTRY)
+        return sorted(blocks)
+
+    def block_owners(self, block_index):
+        # Returns (first_sector, sector_count, layer) runs of the sectors present in some layer, the upper layer wins
+        if block_index in self.owners:
+            owners = self.owners.pop(block_index)
+            self.owners[block_index] = owners
+            return owners
+        sectors_in_block = self.block_size/SECTOR_SIZE
+        owners = []
+        claimed = None
+        for layer in range(len(self.layers)):
+            VHD = self.layers[layer][1]
+            BAT_TABLE = self.layers[layer][4]
+            if BAT_TABLE[block_index] == VHD_BAT_UNUSED_ENTRY:
+                continue
+            BITMAPARRAY = get_bitarray_from_bitmap(vhd_read(VHD, BAT_TABLE[block_index]*SECTOR_SIZE, self.bitmap_size), self.bitmap_size)
+            if claimed is None:
+                present = BITMAPARRAY
+                claimed = bytearray(BITMAPARRAY)
+            else:
+                present = bytearray(byte & ~claimed_byte for (byte, claimed_byte) in zip(BITMAPARRAY, claimed))
+                claimed = bytearray(byte | claimed_byte for (byte, claimed_byte) in zip(BITMAPARRAY, claimed))
+            for (first_sector, sector_count) in get_bitmap_extents(present, sectors_in_block):
+                owners.append((first_sector, sector_count, layer))
+            if bitmap_test_range(claimed, 0, sectors_in_block):
+                break
+        owners.sort()
+        self.owners[block_index] = owners
+        if len(self.owners) > VHD_CHAIN_OWNERS_CACHE_BLOCKS:
+            self.owners.popitem(last=False)
+        return owners
+
+    def owner(self, sector):
+        # Returns the layer that holds the sector, None if no layer does and it reads as zeros
+        (block_index, sector_in_block) = divmod(sector, self.block_size/SECTOR_SIZE)
+        if block_index >= len(self.layers[0][4]):
+            return None
+        for (first_sector, sector_count, layer) in self.block_owners(block_index):
+            if first_sector <= sector_in_block < first_sector + sector_count:
+                return layer
+        return None
+
+    def read(self, layer, block_index, first_sector, sector_count):
+        VHD = self.layers[layer][1]
+        BAT_TABLE = self.layers[layer][4]
+        return vhd_read(VHD, BAT_TABLE[block_index]*SECTOR_SIZE + self.bitmap_size + first_sector*SECTOR_SIZE, sector_count*SECTOR_SIZE)
+
+def vhd_chain_read_blocks(chain, zero_detector):
+    # Same as vhd_read_blocks(), for the logical disk of a chain. A block whose sectors come
+    # from more than one layer is assembled in a fresh buffer.
+    sectors_in_block = chain.block_size/SECTOR_SIZE
+    for block_index in chain.allocated_blocks():
+        owners = chain.block_owners(block_index)
+        if len(owners) == 0:
+            continue
+        layers = set(owner[2] for owner in owners)
+        if len(layers) == 1:
+            block_data = chain.read(owners[0][2], block_index, 0, sectors_in_block)
+        else:
+            block_data = bytearray(chain.block_size)
+            for (first_sector, sector_count, layer) in owners:
+                block_data[first_sector*SECTOR_SIZE:(first_sector+sector_count)*SECTOR_SIZE] = chain.read(layer, block_index, first_sector, sector_count)
+        INFO("VHD: Read VHD block %d from layers %s" % (block_index, sorted(layers)))
+        yield (block_index, block_data, vhd_decode_extents(block_index, [owner[0:2] for owner in owners], block_data, chain.block_size, zero_detector))
+
+def vhd_open_blocks(vhd, chain, read_ahead, zero_detectors):
+    # Returns (footer, dynamic disk header, blocks, close) of a VHD, or of the logical disk of its chain.
+    # blocks yields (block index, block data, runs) in BAT order, a single VHD is read by one worker
+    # per entry of zero_detectors (None when not detecting zeros).
+    if chain:
+        CHAIN = VHDChain(vhd)
+        return (CHAIN.footer, CHAIN.header, vhd_chain_read_blocks(CHAIN, zero_detectors[0]), CHAIN.close)
+    VHD = vhd_open(vhd)
+    (VHD_FOOTER, DYNAMIC_DISK_HEADER, BAT_TABLE) = vhd_read_metadata(VHD)
+    block_size = DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_]
+    BITMAP_SIZE = get_bitmap_size(DYNAMIC_DISK_HEADER)
+    if len(zero_detectors) > 1:
+        blocks = vhd_read_blocks_parallel(vhd, BAT_TABLE, block_size, BITMAP_SIZE, zero_detectors, max(read_ahead, len(zero_detectors)))
+    else:
+        blocks = vhd_read_blocks(VHD, BAT_TABLE, block_size, BITMAP_SIZE, zero_detectors[0])
+    return (VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks, lambda: vhd_close(VHD))
+
+def vhd_export_records(VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks):
+    # Yields the sectors present in the blocks as records in the format of rbd_diff_records(),
+    # so the raw and NBD writers take them without an RBD diff in between
+    block_size = DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_]
+    yield (RBD_DIFF_RECORD_SIZE, 0, VHD_FOOTER[_vhd_footter_current_size_], None, 0)
+    for (block_index, block_data, runs) in blocks:
+        for (data_offset, length, run_zero) in runs:
+            if run_zero:
+                yield (RBD_DIFF_RECORD_ZERO, block_index*block_size + data_offset, length, None, 0)
+            else:
+                yield (RBD_DIFF_RECORD_DATA, block_index*block_size + data_offset, length, get_buffer_view(block_data, data_offset, length), 0)
+    yield (RBD_DIFF_RECORD_END, 0, 0, None, 0)
+
+def vhd2rbd(vhd, rbd, progress, mrout, detect_zeros, jobs=1, read_ahead=VHD_DEFAULT_READ_AHEAD, chain=False):
 
     _prev_percent_ = 0
 
-    VHD_FH = open(vhd, "rb")
-    if rbd == "-":
-        RBDDIFF_FH = sys.stdout
+    zero_detector = ZeroDetector()
+    if (jobs > 1) & (not chain):
+        zero_detectors = [ZeroDetector() if detect_zeros else None for index in range(jobs)]
     else:
-        RBDDIFF_FH = open(rbd, "wb")
+        zero_detectors = [zero_detector if detect_zeros else None]
 
-    VHD_FOOTER = unpack(VHD_FOTTER_FORMAT, VHD_FH.read(VHD_FOTTER_RECORD_SIZE))
-    DYNAMIC_DISK_HEADER = unpack(VHD_DYNAMIC_DISK_HEADER_FORMAT, VHD_FH.read(VHD_DYNAMIC_DISK_HEADER_RECORD_SIZE))
-    BAT_TABLE = unpack("!%iI" % DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_],
-                       VHD_FH.read(DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]*4))
-    BATMAP_HEADER = unpack(VHD_BATMAP_HEADER_FORMAT, VHD_FH.read(VHD_BATMAP_HEADER_SIZE))
+    # With chain the flattened logical disk of the leaf and all of its parents is exported
+    (VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks, vhd_close_blocks) = vhd_open_blocks(vhd, chain, read_ahead, zero_detectors)
+    RBDDIFF_FH = rbd_diff_create(rbd)
 
     # Write RBD diff header
     INFO("RBD: Writing RBD diff header")
     RBDDIFF_FH.write(RBD_HEADER)
 
     # Write RBD from_snap record
-    if DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unique_id_] != '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00':
+    if (not chain) & (DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unique_id_] != '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'):
         INFO("RBD: Writing RBD from_snap record")
         from_snap_uuid = uuid.UUID(bytes=DYNAMIC_DISK_HEADER[_dynamic_disk_header_parent_unique_id_])
         from_snap = "%s%s" % (SNAPSHOT_PREFIX, str(from_snap_uuid))
@@ -1221,67 +2986,45 @@ def vhd2rbd(vhd, rbd, progress, mrout):
     RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_META_SIZE, 's', VHD_FOOTER[_vhd_footter_current_size_]))
 
     total_changed_sectors = 0
-    total_changed_sectors_ = 0
-    raw_first_sector = -1
-    raw_last_sector = -1
-    in_block_first_sector = -1
-    in_block_last_sector = -1
-
-    for block_index in range(DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]):
-        if BAT_TABLE[block_index] != 0xffffffff:
-            DATA_BLOCK = get_sector_bitmap_and_data(VHD_FH, BAT_TABLE[block_index], DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_])
-
-            BITMAP_SIZE = get_bitmap_size(DYNAMIC_DISK_HEADER)
-            INFO("VHD: Read VHD block %d" % block_index)
-
-            BITMAPARRAY = get_bitarray_from_bitmap(DATA_BLOCK[0], BITMAP_SIZE)
-
-            for sector_in_block_index in range(BITMAP_SIZE*8):
-                if BITMAPARRAY[sector_in_block_index] == 1:
-                    DEBUG("VHD: Read sector %d with data in block %d" % (sector_in_block_index, block_index))
-                    total_changed_sectors_ += 1
-                    if raw_first_sector == -1:
-                        raw_first_sector = get_raw_sector_offset_of_sector(block_index, sector_in_block_index, DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_], SECTOR_SIZE)
-                        in_block_first_sector = sector_in_block_index
-                        raw_last_sector = -1
-                else:
-                    if (raw_last_sector == -1) & (raw_first_sector != -1) :
-                        raw_last_sector = get_raw_sector_offset_of_sector(block_index, sector_in_block_index-1, DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_], SECTOR_SIZE)
-                        in_block_last_sector = sector_in_block_index-1
-                        DEBUG("VHD: Data sectors range (raw) %d - %d" % (raw_first_sector, raw_last_sector))
-                        DEBUG("VHD: Data sectors range (in block) %d - %d" % (in_block_first_sector, in_block_last_sector))
-                        # Write RBD data record header
-                        INFO("RBD: Write RBD data record header ...")
-                        RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_DATA, 'w', raw_first_sector*512,(raw_last_sector-raw_first_sector+1)*512))
-                        INFO("RBD: Write RBD data record data ...")
-                        for sector_index in range(in_block_first_sector, in_block_last_sector+1):
-                            DEBUG("VHD->RBD: Write sector %d from block %d" % (sector_index, block_index))
-                            total_changed_sectors += 1
-                            # Write RBD data record data
-                            RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+"512s",DATA_BLOCK[1][sector_index]))
-                        raw_first_sector = -1
-                        raw_last_sector = -1
-                        in_block_first_sector = -1
-                        in_block_last_sector = -1
-
-            if (sector_in_block_index == BITMAP_SIZE*8-1) and (raw_first_sector != -1) :
-                raw_last_sector = get_raw_sector_offset_of_sector(block_index, sector_in_block_index, DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_], SECTOR_SIZE)
-                in_block_last_sector = sector_in_block_index
-                DEBUG("VHD: Data sectors range (raw) %d - %d" % (raw_first_sector, raw_last_sector))
-                DEBUG("VHD: Data sectors range (in block) %d - %d" % (in_block_first_sector, in_block_last_sector))
-                # Write RBD data record header
-                INFO("RBD: Write RBD data record header ...")
-                RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_DATA, 'w', raw_first_sector*512,(raw_last_sector-raw_first_sector+1)*512))
-                INFO("RBD: Write RBD data record data ...")
-                for sector_index in range(in_block_first_sector, in_block_last_sector+1):
-                    DEBUG("VHD->RBD: Write sector %d from block %d" % (sector_index, block_index))
-                    # Write RBD data record data
-                    total_changed_sectors += 1
-                    RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+"512s",DATA_BLOCK[1][sector_index]))
-                raw_first_sector = -1
-                raw_last_sector = -1
-                in_block_first_sector = -1
-                in_block_last_sector = -1
+    block_size = DYNAMIC_DISK_HEADER[_dynamic_disk_header_block_size_]
+    extent_offset = 0
+    extent_length = 0
+    extent_data = []
+    zero_extent_offset = 0
+    zero_extent_length = 0
+
+    for (block_index, block_data, runs) in blocks:
+        for (data_offset, length, run_zero) in runs:
+            raw_offset = block_index*block_size + data_offset
+            if run_zero:
+                if (extent_length > 0):
+                    INFO("RBD: Write RBD data record offset 0x%08x length %d" % (extent_offset, extent_length))
+                    rbd_diff_write_data(RBDDIFF_FH, extent_offset, extent_length, extent_data)
+                    total_changed_sectors += extent_length/SECTOR_SIZE
+                    extent_length = 0
+                    extent_data = []
+                if (zero_extent_length > 0) & (zero_extent_offset + zero_extent_length != raw_offset):
+                    INFO("RBD: Write RBD zero data record offset 0x%08x length %d" % (zero_extent_offset, zero_extent_length))
+                    rbd_diff_write_zero(RBDDIFF_FH, zero_extent_offset, zero_extent_length)
+                    zero_extent_length = 0
+                if zero_extent_length == 0:
+                    zero_extent_offset = raw_offset
+                zero_extent_length += length
+                continue
+            if (zero_extent_length > 0):
+                INFO("RBD: Write RBD zero data record offset 0x%08x length %d" % (zero_extent_offset, zero_extent_length))
+                rbd_diff_write_zero(RBDDIFF_FH, zero_extent_offset, zero_extent_length)
+                zero_extent_length = 0
+            if (extent_length > 0) & ((extent_offset + extent_length != raw_offset) | (extent_length + length > RBD_DIFF_MAX_RECORD_SIZE)):
+                INFO("RBD: Write RBD data record offset 0x%08x length %d" % (extent_offset, extent_length))
+                rbd_diff_write_data(RBDDIFF_FH, extent_offset, extent_length, extent_data)
+                total_changed_sectors += extent_length/SECTOR_SIZE
+                extent_length = 0
+                extent_data = []
+            if extent_length == 0:
+                extent_offset = raw_offset
+            extent_length += length
+            extent_data.append(get_buffer_view(block_data, data_offset, length))
 
         if (progress):
             _percent_ = (100*block_index)//DYNAMIC_DISK_HEADER[_dynamic_disk_header_max_table_entries_]
@@ -1292,6 +3035,14 @@ def vhd2rbd(vhd, rbd, progress, mrout):
                 else:
                     eprint("Progress: %d" % _percent_)
 
+    if extent_length > 0:
+        INFO("RBD: Write RBD data record offset 0x%08x length %d" % (extent_offset, extent_length))
+        rbd_diff_write_data(RBDDIFF_FH, extent_offset, extent_length, extent_data)
+        total_changed_sectors += extent_length/SECTOR_SIZE
+    if zero_extent_length > 0:
+        INFO("RBD: Write RBD zero data record offset 0x%08x length %d" % (zero_extent_offset, zero_extent_length))
+        rbd_diff_write_zero(RBDDIFF_FH, zero_extent_offset, zero_extent_length)
+
     if (progress):
         if (mrout):
             MROUTPUT("Progress: 100")
@@ -1300,15 +3051,512 @@ def vhd2rbd(vhd, rbd, progress, mrout):
 
     INFO("RBD: Total wrintten sectors : %d" % total_changed_sectors)
     INFO("RBD: Total written bytes: %d" % (total_changed_sectors*512))
+    if detect_zeros:
+        zero_detector.elided_bytes = sum(detector.elided_bytes for detector in zero_detectors)
+        zero_detector.report()
 
     RBDDIFF_FH.write('e')
 
-    VHD_FH.close
-    if RBDDIFF_FH is not sys.stdout:
-        RBDDIFF_FH.close
+    vhd_close_blocks()
+    RBDDIFF_FH.close()
+
+    return 0
+
+def vhd2raw(vhd, raw, progress, mrout, sparse, detect_zeros, jobs=1, read_ahead=VHD_DEFAULT_READ_AHEAD, chain=False):
+    # Zero detection is done by the raw writer on the records
+    (VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks, vhd_close_blocks) = vhd_open_blocks(vhd, chain, read_ahead, [None]*(1 if chain else jobs))
+    RAW_FH = io.open(raw, "wb", buffering=0)
+
+    rbd_records2raw(vhd_export_records(VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks), RAW_FH, progress, mrout, sparse, detect_zeros)
+
+    RAW_FH.close()
+    vhd_close_blocks()
+
+    return 0
+
+def vhd2nbd(vhd, uri, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros, jobs=1, read_ahead=VHD_DEFAULT_READ_AHEAD, chain=False):
+    # Zero detection is done by the NBD writer on the records
+    (VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks, vhd_close_blocks) = vhd_open_blocks(vhd, chain, read_ahead, [None]*(1 if chain else jobs))
+    client = NBDClient(uri, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request)
+
+    rbd_records2nbd(vhd_export_records(VHD_FOOTER, DYNAMIC_DISK_HEADER, blocks), client, progress, mrout, detect_zeros)
+
+    client.close()
+    vhd_close_blocks()
 
     return 0
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
+#-- MERGE EXTENT FIELDs --#
+_merge_extent_start_    = 0
+_merge_extent_end_      = 1
+_merge_extent_tag_      = 2
+_merge_extent_source_   = 3
+_merge_extent_position_ = 4
+#-- MERGE EXTENT FIELDs --#
+
+def rbd_diff_scan(RBDDIFF_FH):
+    # Returns (from snap, to snap, image size, extents) of a seekable diff, reading only the record headers.
+    # Snap names are kept as they are, extents are (tag, offset, length, payload position) in file order.
+    meta = ['', '', 0]
+    snaps = ['', '']
+    extents = []
+    for record in rbd_diff_collect_extents(rbd_diff_records(RBDDIFF_FH, RBD_DIFF_SCAN_BUFFER_SIZE, skip_data=True), meta, extents):
+        if record[_rbd_record_tag_] == RBD_DIFF_RECORD_FROM_SNAP:
+            snaps[0] = record[_rbd_record_data_]
+        elif record[_rbd_record_tag_] == RBD_DIFF_RECORD_TO_SNAP:
+            snaps[1] = record[_rbd_record_data_]
+    return (snaps[0], snaps[1], meta[2], extents)
+
+def clip_merge_extent(extent, start, end):
+    (extent_start, extent_end, record_tag, source, position) = extent
+    if record_tag == RBD_DIFF_RECORD_DATA:
+        position += start - extent_start
+    return (start, end, record_tag, source, position)
+
+def overlay_merge_extents(lower, upper):
+    # Both lists are sorted and non-overlapping, returns them merged with upper winning where they overlap
+    merged = []
+    index = 0
+    piece = lower[0] if len(lower) > 0 else None
+    for extent in upper:
+        while (piece is not None) and (piece[_merge_extent_start_] < extent[_merge_extent_start_]):
+            if piece[_merge_extent_end_] <= extent[_merge_extent_start_]:
+                merged.append(piece)
+                index += 1
+                piece = lower[index] if index < len(lower) else None
+            else:
+                merged.append(clip_merge_extent(piece, piece[_merge_extent_start_], extent[_merge_extent_start_]))
+                piece = clip_merge_extent(piece, extent[_merge_extent_start_], piece[_merge_extent_end_])
+        merged.append(extent)
+        while (piece is not None) and (piece[_merge_extent_start_] < extent[_merge_extent_end_]):
+            if piece[_merge_extent_end_] <= extent[_merge_extent_end_]:
+                index += 1
+                piece = lower[index] if index < len(lower) else None
+            else:
+                piece = clip_merge_extent(piece, extent[_merge_extent_end_], piece[_merge_extent_end_])
+    if piece is not None:
+        merged.append(piece)
+        merged.extend(lower[index+1:])
+    return merged
+
+def truncate_merge_extents(extents, size):
+    index = bisect.bisect_left([extent[_merge_extent_end_] for extent in extents], size+1)
+    truncated = extents[0:index]
+    if (index < len(extents)) and (extents[index][_merge_extent_start_] < size):
+        truncated.append(clip_merge_extent(extents[index], extents[index][_merge_extent_start_], size))
+    return truncated
+
+def rbd_diff_merge_layers(extents, source):
+    # Splits the `w`/`z` records of a diff into runs that are ascending and non-overlapping, in file order.
+    # A diff written by rbd export-diff is a single run, a later run overrides the earlier ones.
+    layers = []
+    layer = []
+    for (record_tag, offset, length, position) in extents:
+        if length == 0:
+            continue
+        if (len(layer) > 0) and (offset < layer[-1][_merge_extent_end_]):
+            layers.append(layer)
+            layer = []
+        layer.append((offset, offset + length, record_tag, source, position))
+    if len(layer) > 0:
+        layers.append(layer)
+    return layers
+
+def rbd_diff_copy_payload(RBDDIFF_FH, SOURCE_FH, position, length, view):
+    while length > 0:
+        chunk = min(length, len(view))
+        rbd_diff_pread(SOURCE_FH, position, view[0:chunk])
+        RBDDIFF_FH.write(view[0:chunk])
+        position += chunk
+        length -= chunk
+
+def rbddiff_merge(rbd, sources, progress, mrout):
+    # Consolidates an ordered chain of diffs into one. The record headers of every diff are scanned
+    # first and overlaid into a map of the newest record for every byte range, then the merged diff
+    # is written from it, reading only the payloads that survived.
+    if len(sources) == 0:
+        ERROR("RBD: No diffs to merge")
+        sys.exit(1)
+
+    SOURCE_FHS = []
+    merged = []
+    image_size = 0
+    for source in range(len(sources)):
+        SOURCE_FH = rbd_diff_open(sources[source])
+        if not is_seekable_file(SOURCE_FH):
+            ERROR("RBD: '%s' is not a regular file, diffs are merged from seekable files only" % sources[source])
+            sys.exit(1)
+        SOURCE_FHS.append(SOURCE_FH)
+        (from_snap_name, to_snap_name, size, extents) = rbd_diff_scan(SOURCE_FH)
+        INFO("RBD: '%s' from snap '%s' to snap '%s', size %d, %d records" % (sources[source], from_snap_name, to_snap_name, size, len(extents)))
+        if source == 0:
+            first_snap_name = from_snap_name
+        else:
+            if (from_snap_name == '') or (from_snap_name != last_snap_name):
+                ERROR("RBD: '%s' starts at snap '%s', but '%s' ends at snap '%s'" % (sources[source], from_snap_name, sources[source-1], last_snap_name))
+                sys.exit(1)
+            if size < image_size:
+                # Data past a shrink is gone, it reads as zeros if the image grows again
+                merged = overlay_merge_extents(truncate_merge_extents(merged, size), [(size, image_size, RBD_DIFF_RECORD_ZERO, source, None)])
+        last_snap_name = to_snap_name
+        image_size = size
+        for layer in rbd_diff_merge_layers(extents, source):
+            merged = overlay_merge_extents(merged, layer)
+    merged = truncate_merge_extents(merged, image_size)
+    INFO("RBD: %d extents after merging %d diffs" % (len(merged), len(sources)))
+
+    RBDDIFF_FH = rbd_diff_create(rbd)
+    RBDDIFF_FH.write(RBD_HEADER)
+    if first_snap_name != '':
+        rbd_diff_write_snap(RBDDIFF_FH, RBD_DIFF_RECORD_FROM_SNAP, first_snap_name)
+    if last_snap_name != '':
+        rbd_diff_write_snap(RBDDIFF_FH, RBD_DIFF_RECORD_TO_SNAP, last_snap_name)
+    RBDDIFF_FH.write(pack(RBD_DIFF_META_ENDIAN_PREFIX+RBD_DIFF_META_RECORD_TAG+RBD_DIFF_META_SIZE, 's', image_size))
+
+    _prev_percent_ = 0
+    view = memoryview(bytearray(RBD_DIFF_READ_BUFFER_SIZE))
+    total_data_bytes = 0
+    index = 0
+    while index < len(merged):
+        # Adjacent extents of the same kind become one record, `w` records up to RBD_DIFF_MAX_RECORD_SIZE
+        (start, end, record_tag, source, position) = merged[index]
+        last = index + 1
+        while (last < len(merged)) and (merged[last][_merge_extent_tag_] == record_tag) and (merged[last][_merge_extent_start_] == end):
+            if (record_tag == RBD_DIFF_RECORD_DATA) and (merged[last][_merge_extent_end_] - start > RBD_DIFF_MAX_RECORD_SIZE):
+                break
+            end = merged[last][_merge_extent_end_]
+            last += 1
+        if record_tag == RBD_DIFF_RECORD_DATA:
+            INFO("RBD: Write RBD data record offset 0x%08x length %d" % (start, end - start))
+            RBDDIFF_FH.write(RBD_DIFF_DATA_RECORD_STRUCT.pack(RBD_DIFF_RECORD_DATA, start, end - start))
+            for (extent_start, extent_end, extent_tag, source, position) in merged[index:last]:
+                rbd_diff_copy_payload(RBDDIFF_FH, SOURCE_FHS[source], position, extent_end - extent_start, view)
+            total_data_bytes += end - start
+        else:
+            INFO("RBD: Write RBD zero data record offset 0x%08x length %d" % (start, end - start))
+            rbd_diff_write_zero(RBDDIFF_FH, start, end - start)
+        index = last
+
+        if (progress):
+            _percent_ = (100*end)//max(image_size, 1)
+            if _prev_percent_ != _percent_ :
+                _prev_percent_ = _percent_
+                if (mrout):
+                    MROUTPUT("Progress: %d" % _percent_)
+                else:
+                    eprint("Progress: %d" % _percent_)
+
+    RBDDIFF_FH.write('e')
+    RBDDIFF_FH.close()
+    for SOURCE_FH in SOURCE_FHS:
+        SOURCE_FH.close()
+
+    if (progress):
+        if (mrout):
+            MROUTPUT("Progress: 100")
+        else:
+            eprint("Progress: 100")
+    INFO("RBD: Total written bytes: %d" % total_data_bytes)
+
+    return 0
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def gen_index_column(values):
+    if RBD_DIFF_INDEX_TYPECODE is None:
+        return list(values)
+    return array.array(RBD_DIFF_INDEX_TYPECODE, values)
+
+def pack_index_column(values):
+    if RBD_DIFF_INDEX_TYPECODE is None:
+        return pack("<%dQ" % len(values), *values)
+    column = array.array(RBD_DIFF_INDEX_TYPECODE, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tostring()
+
+def unpack_index_column(data, offset, count):
+    if RBD_DIFF_INDEX_TYPECODE is None:
+        return unpack_from("<%dQ" % count, data, offset)
+    column = array.array(RBD_DIFF_INDEX_TYPECODE)
+    column.fromstring(data[offset:offset+count*8])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+class RBDDiffIndex(object):
+    # Record tags, offsets, lengths and payload positions of the `w` and `z` records of a diff, in file order,
+    # with its snap names and image size. diff_size and diff_mtime tell whether the diff changed since.
+
+    def __init__(self, from_snap, to_snap, image_size, tags, offsets, lengths, positions, diff_size, diff_mtime):
+        self.from_snap = from_snap
+        self.to_snap = to_snap
+        self.image_size = image_size
+        self.tags = tags
+        self.offsets = offsets
+        self.lengths = lengths
+        self.positions = positions
+        self.diff_size = diff_size
+        self.diff_mtime = diff_mtime
+        # rbd export-diff writes records in ascending order, ranges of such an index are found by bisection
+        self.ordered = all(offsets[entry-1] + lengths[entry-1] <= offsets[entry] for entry in range(1, len(offsets)))
+
+    def overlapping(self, start, end):
+        # Returns the entries of the records overlapping [start, end), in file order
+        if not self.ordered:
+            return [entry for entry in range(len(self.offsets)) if (self.offsets[entry] < end) & (self.offsets[entry] + self.lengths[entry] > start)]
+        first = bisect.bisect_right(self.offsets, start) - 1
+        if (first < 0) or (self.offsets[first] + self.lengths[first] <= start):
+            first += 1
+        return xrange(first, bisect.bisect_left(self.offsets, end, first))
+
+    def summary(self):
+        # Returns [(name, value), ...] without reading the diff
+        data = [entry for entry in range(len(self.tags)) if self.tags[entry] == RBD_DIFF_RECORD_DATA]
+        zero = [entry for entry in range(len(self.tags)) if self.tags[entry] == RBD_DIFF_RECORD_ZERO]
+        lines = [("from_snap", self.from_snap), ("to_snap", self.to_snap), ("image_size", self.image_size),
+                 ("data_records", len(data)), ("data_bytes", sum(self.lengths[entry] for entry in data)),
+                 ("zero_records", len(zero)), ("zero_bytes", sum(self.lengths[entry] for entry in zero)),
+                 ("ordered", self.ordered)]
+        if len(self.offsets) > 0:
+            lines.append(("first_offset", min(self.offsets)))
+            lines.append(("last_offset", max(self.offsets[entry] + self.lengths[entry] for entry in range(len(self.offsets)))))
+        return lines
+
+def rbd_diff_index_build(rbd):
+    RBDDIFF_FH = rbd_diff_open(rbd)
+    if not is_seekable_file(RBDDIFF_FH):
+        ERROR("RBD: '%s' is not a regular file, only seekable diffs can be indexed" % rbd)
+        sys.exit(1)
+    diff_stat = os.fstat(RBDDIFF_FH.fileno())
+    (from_snap_name, to_snap_name, image_size, extents) = rbd_diff_scan(RBDDIFF_FH)
+    RBDDIFF_FH.close()
+    INFO("RBD: Indexed %d records of '%s'" % (len(extents), rbd))
+    return RBDDiffIndex(from_snap_name, to_snap_name, image_size,
+                        "".join(extent[0] for extent in extents),
+                        gen_index_column(extent[1] for extent in extents),
+                        gen_index_column(extent[2] for extent in extents),
+                        gen_index_column(extent[3] for extent in extents),
+                        diff_stat.st_size, diff_stat.st_mtime)
+
+def rbd_diff_index_save(index, index_file):
+    INDEX_FH = open(index_file, "wb")
+    INDEX_FH.write(RBD_DIFF_INDEX_MAGIC)
+    INDEX_FH.write(RBD_DIFF_INDEX_HEADER_STRUCT.pack(len(index.tags), index.diff_size, index.diff_mtime, index.image_size, len(index.from_snap), len(index.to_snap)))
+    INDEX_FH.write(index.from_snap)
+    INDEX_FH.write(index.to_snap)
+    INDEX_FH.write(index.tags)
+    for column in (index.offsets, index.lengths, index.positions):
+        INDEX_FH.write(pack_index_column(column))
+    INDEX_FH.close()
+
+def rbd_diff_index_load(index_file, rbd):
+    INDEX_FH = open(index_file, "rb")
+    data = INDEX_FH.read()
+    INDEX_FH.close()
+    offset = len(RBD_DIFF_INDEX_MAGIC)
+    if (data[0:offset] != RBD_DIFF_INDEX_MAGIC) | (len(data) < offset + RBD_DIFF_INDEX_HEADER_STRUCT.size):
+        ERROR("RBD: '%s' is not an rbd diff index" % index_file)
+        sys.exit(2)
+    (count, diff_size, diff_mtime, image_size, from_snap_length, to_snap_length) = RBD_DIFF_INDEX_HEADER_STRUCT.unpack_from(data, offset)
+    offset += RBD_DIFF_INDEX_HEADER_STRUCT.size
+    if len(data) != offset + from_snap_length + to_snap_length + count*(1 + 3*8):
+        ERROR("RBD: Index '%s' is truncated" % index_file)
+        sys.exit(2)
+    diff_stat = os.stat(rbd)
+    if (diff_stat.st_size != diff_size) | (diff_stat.st_mtime != diff_mtime):
+        ERROR("RBD: Index '%s' is stale, '%s' has changed since it was built" % (index_file, rbd))
+        sys.exit(2)
+    from_snap_name = data[offset:offset+from_snap_length]
+    offset += from_snap_length
+    to_snap_name = data[offset:offset+to_snap_length]
+    offset += to_snap_length
+    tags = data[offset:offset+count]
+    offset += count
+    columns = []
+    for column in range(3):
+        columns.append(unpack_index_column(data, offset, count))
+        offset += count*8
+    return RBDDiffIndex(from_snap_name, to_snap_name, image_size, tags, columns[0], columns[1], columns[2], diff_size, diff_mtime)
+
+def rbd_diff_open_indexed(rbd, index_file, build):
+    # Returns (mapped diff, index), (None, None) when there is no index and none is to be built.
+    # The diff is mapped with vhd_open(), vhd_read() then returns views of its payloads.
+    if (rbd == "-") and (index_file or build):
+        ERROR("RBD: --index and --jobs need an rbd diff file, it can't be read from stdin")
+        sys.exit(2)
+    if index_file:
+        index = rbd_diff_index_load(index_file, rbd)
+    elif build:
+        index = rbd_diff_index_build(rbd)
+    else:
+        return (None, None)
+    return (vhd_open(rbd), index)
+
+def rbd_diff_index_records(RBDDIFF, index, entries, meta=True):
+    # Yields the records of the index entries in the format of rbd_diff_records(), with the snap, size and end
+    # records around them when meta is set. Data views stay valid until the diff is closed.
+    header_size = RBD_DIFF_META_RECORD_TAG_SIZE + RBD_DIFF_DATA_SIZE
+    if meta:
+        if index.from_snap:
+            yield (RBD_DIFF_RECORD_FROM_SNAP, 0, len(index.from_snap), index.from_snap, 0)
+        if index.to_snap:
+            yield (RBD_DIFF_RECORD_TO_SNAP, 0, len(index.to_snap), index.to_snap, 0)
+        yield (RBD_DIFF_RECORD_SIZE, 0, index.image_size, None, 0)
+    for entry in entries:
+        (record_tag, offset, length, position) = (index.tags[entry], index.offsets[entry], index.lengths[entry], index.positions[entry])
+        if record_tag == RBD_DIFF_RECORD_ZERO:
+            yield (record_tag, offset, length, None, position - header_size)
+            continue
+        done = 0
+        while done < length:
+            chunk = min(length - done, RBD_DIFF_READ_BUFFER_SIZE)
+            yield (record_tag, offset + done, chunk, vhd_read(RBDDIFF, position + done, chunk), position - header_size)
+            done += chunk
+    if meta:
+        yield (RBD_DIFF_RECORD_END, 0, 0, None, 0)
+
+def rbd_diff_range_records(records, range_start, range_end):
+    # Passes the records through, with `w` and `z` records clipped to [range_start, range_end)
+    for record in records:
+        record_tag = record[_rbd_record_tag_]
+        if (record_tag == RBD_DIFF_RECORD_DATA) or (record_tag == RBD_DIFF_RECORD_ZERO):
+            offset = record[_rbd_record_offset_]
+            length = record[_rbd_record_length_]
+            start = max(offset, range_start)
+            end = min(offset + length, range_end)
+            if start >= end:
+                continue
+            if (start != offset) | (end != offset + length):
+                data = record[_rbd_record_data_]
+                if record_tag == RBD_DIFF_RECORD_DATA:
+                    data = get_buffer_view(data, start - offset, end - start)
+                record = (record_tag, start, end - start, data, record[_rbd_record_position_])
+        yield record
+
+def parse_range(arg):
+    # "<offset>:<length>" in bytes, both sector aligned -> (start, end)
+    try:
+        (offset, length) = [int(value, 0) for value in arg.split(':')]
+    except ValueError:
+        ERROR("Bad range '%s', expected <offset>:<length>" % arg)
+        sys.exit(2)
+    if (offset < 0) | (length <= 0) | (offset % SECTOR_SIZE != 0) | (length % SECTOR_SIZE != 0):
+        ERROR("Bad range '%s', offset and length must be multiples of %d" % (arg, SECTOR_SIZE))
+        sys.exit(2)
+    return (offset, offset + length)
+
+class RBDDiffCheckpoint(object):
+    # Journal of a resumable conversion. It holds the position of the first diff record whose output isn't
+    # known to be done (synced to the raw file or acknowledged by the NBD server) and the end of the output
+    # written before that record. The journal is replaced atomically and removed once the conversion is done.
+
+    def __init__(self, journal, rbd, raw_range, interval=RBD_DIFF_CHECKPOINT_INTERVAL):
+        if rbd == "-":
+            ERROR("RBD: Checkpoints need an rbd diff file, it can't be read from stdin")
+            sys.exit(2)
+        diff_stat = os.stat(rbd)
+        self.journal = journal
+        self.rbd = rbd
+        self.diff_size = diff_stat.st_size
+        self.diff_mtime = diff_stat.st_mtime
+        (self.range_start, self.range_length) = (raw_range[0], raw_range[1] - raw_range[0]) if raw_range is not None else (0, 0)
+        self.interval = interval
+        self.next_time = time.time() + interval
+        self.position = 0
+        self.output_offset = 0
+
+    def load(self):
+        # Returns the position to resume at, 0 if there is no journal yet
+        if not os.path.exists(self.journal):
+            INFO("RBD: No checkpoint in '%s', starting from the beginning" % self.journal)
+            return 0
+        JOURNAL_FH = open(self.journal, "rb")
+        data = JOURNAL_FH.read()
+        JOURNAL_FH.close()
+        offset = len(RBD_DIFF_CHECKPOINT_MAGIC)
+        if (data[0:offset] != RBD_DIFF_CHECKPOINT_MAGIC) | (len(data) != offset + RBD_DIFF_CHECKPOINT_STRUCT.size):
+            ERROR("RBD: '%s' is not an rbd diff checkpoint" % self.journal)
+            sys.exit(2)
+        (diff_size, diff_mtime, range_start, range_length, position, output_offset) = RBD_DIFF_CHECKPOINT_STRUCT.unpack_from(data, offset)
+        if (diff_size != self.diff_size) | (diff_mtime != self.diff_mtime):
+            ERROR("RBD: Checkpoint '%s' is stale, '%s' has changed since it was written" % (self.journal, self.rbd))
+            sys.exit(2)
+        if (range_start != self.range_start) | (range_length != self.range_length):
+            ERROR("RBD: Checkpoint '%s' was written for another range" % self.journal)
+            sys.exit(2)
+        self.position = position
+        self.output_offset = output_offset
+        INFO("RBD: Resuming from checkpoint '%s', position %d, output done up to 0x%08x" % (self.journal, position, output_offset))
+        return position
+
+    def due(self):
+        return time.time() >= self.next_time
+
+    def save(self, position, output_offset):
+        # The output before position must have been synced or acknowledged by the caller
+        journal_tmp = self.journal + ".tmp"
+        JOURNAL_FH = open(journal_tmp, "wb")
+        JOURNAL_FH.write(RBD_DIFF_CHECKPOINT_MAGIC)
+        JOURNAL_FH.write(RBD_DIFF_CHECKPOINT_STRUCT.pack(self.diff_size, self.diff_mtime, self.range_start, self.range_length, position, output_offset))
+        JOURNAL_FH.flush()
+        os.fsync(JOURNAL_FH.fileno())
+        JOURNAL_FH.close()
+        os.rename(journal_tmp, self.journal)
+        self.position = position
+        self.output_offset = output_offset
+        self.next_time = time.time() + self.interval
+        DEBUG("RBD: Checkpoint at position %d, output done up to 0x%08x" % (position, output_offset))
+
+    def remove(self):
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+        INFO("RBD: Conversion is done, checkpoint '%s' removed" % self.journal)
+
+def rbd_diff_checkpoint_open(checkpoint_file, resume, rbd, raw_range):
+    # Returns (checkpoint or None, position to resume at)
+    if not checkpoint_file:
+        if resume:
+            ERROR("--resume needs a --checkpoint journal")
+            sys.exit(2)
+        return (None, 0)
+    checkpoint = RBDDiffCheckpoint(checkpoint_file, rbd, raw_range)
+    return (checkpoint, checkpoint.load() if resume else 0)
+
+def rbd_diff_resume_entries(index, entries, resume_position):
+    # Drops the index entries of the records before resume_position
+    if resume_position == 0:
+        return entries
+    header_size = RBD_DIFF_META_RECORD_TAG_SIZE + RBD_DIFF_DATA_SIZE
+    return [entry for entry in entries if index.positions[entry] - header_size >= resume_position]
+
+def rbddiff_index(rbd, index_file, summary):
+    # Builds the sidecar index of a diff. With summary the index (built first if there is none) is printed.
+    if not index_file:
+        index_file = rbd + RBD_DIFF_INDEX_SUFFIX
+    if summary & os.path.exists(index_file):
+        index = rbd_diff_index_load(index_file, rbd)
+    else:
+        index = rbd_diff_index_build(rbd)
+        rbd_diff_index_save(index, index_file)
+        INFO("RBD: Index of '%s' written to '%s'" % (rbd, index_file))
+    if summary:
+        for (name, value) in index.summary():
+            print("%s: %s" % (name, value))
+
+    return 0
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def print_usage():
+    eprint('Usage:')
+    eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [--chain] [--jobs <count>] [--read-ahead <blocks>] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file|-> [--uuid <vdi_uuid>] [--jobs <count>] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\trbd2raw --rbd <rbd_file> --raw <raw_file> [--index <index_file>] [--range <offset>:<length>] [--jobs <count>] [--checkpoint <journal_file>] [--resume] [--sparse] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\tvhd2raw --vhd <vhd_file> --raw <raw_file> [--chain] [--jobs <count>] [--read-ahead <blocks>] [--sparse] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [--index <index_file>] [--range <offset>:<length>] [--checkpoint <journal_file>] [--resume] [--nbd-connections <count>] [--nbd-inflight <count>] [--nbd-retries <count>] [--nbd-max-request <bytes>] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\tnbd2rbd --nbd <nbd_server> --rbd <rbd_file> [--nbd-connections <count>] [--nbd-inflight <count>] [--nbd-retries <count>] [--nbd-max-request <bytes>] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\tvhd2nbd --vhd <vhd_file> --nbd <nbd_server> [--chain] [--jobs <count>] [--read-ahead <blocks>] [--nbd-connections <count>] [--nbd-inflight <count>] [--nbd-retries <count>] [--nbd-max-request <bytes>] [--detect-zeros] [-p] [-m] [-v] [-d]')
+    eprint('\trbddiff-index --rbd <rbd_file> [--index <index_file>] [--summary] [-v] [-d]')
+    eprint('\trbddiff-merge --rbd <merged_rbd_file> [-p] [-m] [-v] [-d] <rbd_file> [<rbd_file> ...]')
+    eprint('\tnbd2vhd --nbd <nbd_server> --vhd <vhd_file|-> --uuid <vdi_uuid> [--nbd-connections <count>] [--nbd-inflight <count>] [--nbd-retries <count>] [--nbd-max-request <bytes>] [--detect-zeros] [-p] [-m] [-v] [-d]')
+
 def main(argv):
 
     cmdname = sys.argv[0]
@@ -1319,13 +3567,9 @@ def main(argv):
 
     if len(sys.argv) > 1:
         try:
-            opts, args = getopt.getopt(argv,"hvdpm",["vhd=","rbd=","nbd=","raw=","uuid="])
+            opts, args = getopt.getopt(argv,"hvdpm",["vhd=","rbd=","nbd=","raw=","uuid=","sparse","nbd-connections=","nbd-inflight=","nbd-retries=","nbd-max-request=","detect-zeros","jobs=","read-ahead=","chain","index=","range=","summary","checkpoint=","resume"])
         except getopt.GetoptError:
-            eprint('Usage:')
-            eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [--uuid <vhd_uuid>] [-p] [-m] [-v] [-d]')
-            eprint('\trbd2raw --rbd <rbd_file> --raw <vhd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [-p] [-m] [-v] [-d]')
+            print_usage()
             sys.exit(2)
 
         vhd_file = ''
@@ -1333,14 +3577,24 @@ def main(argv):
         vhd_uuid = ''
         progress = False
         mrout = False
+        sparse = False
+        nbd_connections = 1
+        nbd_inflight = NBD_DEFAULT_INFLIGHT
+        nbd_retries = NBD_DEFAULT_RETRIES
+        nbd_max_request = NBD_DEFAULT_MAX_REQUEST_SIZE
+        detect_zeros = False
+        jobs = 1
+        read_ahead = VHD_DEFAULT_READ_AHEAD
+        chain = False
+        index_file = ''
+        raw_range = None
+        summary = False
+        checkpoint_file = ''
+        resume = False
 
         for opt, arg in opts:
             if opt == '-h':
-                eprint('Usage:')
-                eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [-p] [-m] [-v] [-d]')
-                eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [--uuid <vhd_uuid>] [-p] [-m] [-v] [-d]')
-                eprint('\trbd2raw --rbd <rbd_file> --raw <vhd_file> [-p] [-m] [-v] [-d]')
-                eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [-p] [-m] [-v] [-d]')
+                print_usage()
                 sys.exit()
             elif opt == '-v':
                 global verbose
@@ -1366,21 +3620,57 @@ def main(argv):
                 INFO("[main]: NBD destination is \'%s\'" % nbd_dest)
             elif opt == '--uuid':
                 vhd_uuid = arg
+            elif opt == '--sparse':
+                sparse = True
+            elif opt == '--nbd-connections':
+                nbd_connections = int(arg)
+            elif opt == '--nbd-inflight':
+                nbd_inflight = int(arg)
+            elif opt == '--nbd-retries':
+                nbd_retries = int(arg)
+            elif opt == '--nbd-max-request':
+                nbd_max_request = int(arg)
+            elif opt == '--detect-zeros':
+                detect_zeros = True
+            elif opt == '--jobs':
+                jobs = int(arg)
+            elif opt == '--read-ahead':
+                read_ahead = int(arg)
+            elif opt == '--chain':
+                chain = True
+            elif opt == '--index':
+                index_file = arg
+            elif opt == '--range':
+                raw_range = parse_range(arg)
+            elif opt == '--summary':
+                summary = True
+            elif opt == '--checkpoint':
+                checkpoint_file = arg
+            elif opt == '--resume':
+                resume = True
 
         if (cmdname == 'vhd2rbd'):
-            vhd2rbd(vhd_file, rbd_file, progress, mrout)
+            vhd2rbd(vhd_file, rbd_file, progress, mrout, detect_zeros, jobs, read_ahead, chain)
         elif(cmdname == 'rbd2vhd'):
-            rbd2vhd(rbd_file, vhd_file, vhd_uuid, progress, mrout)
+            rbd2vhd(rbd_file, vhd_file, vhd_uuid, progress, mrout, detect_zeros, jobs)
         elif(cmdname == 'rbd2raw'):
-            rbd2raw(rbd_file, raw_file, progress, mrout)
+            rbd2raw(rbd_file, raw_file, progress, mrout, sparse, detect_zeros, index_file, raw_range, jobs, checkpoint_file, resume)
+        elif(cmdname == 'rbddiff-index'):
+            rbddiff_index(rbd_file, index_file, summary)
+        elif(cmdname == 'rbddiff-merge'):
+            rbddiff_merge(rbd_file, args, progress, mrout)
+        elif(cmdname == 'vhd2raw'):
+            vhd2raw(vhd_file, raw_file, progress, mrout, sparse, detect_zeros, jobs, read_ahead, chain)
+        elif(cmdname == 'vhd2nbd'):
+            vhd2nbd(vhd_file, nbd_dest, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros, jobs, read_ahead, chain)
         elif(cmdname == 'rbd2nbd'):
-            rbd2nbd(rbd_file, nbd_dest, progress, mrout)
+            rbd2nbd(rbd_file, nbd_dest, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros, index_file, raw_range, checkpoint_file, resume)
+        elif(cmdname == 'nbd2rbd'):
+            nbd2rbd(nbd_dest, rbd_file, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros)
+        elif(cmdname == 'nbd2vhd'):
+            nbd2vhd(nbd_dest, vhd_file, vhd_uuid, progress, mrout, nbd_connections, nbd_inflight, nbd_retries, nbd_max_request, detect_zeros)
     else:
-            eprint('Usage:')
-            eprint('\tvhd2rbd --vhd <vhd_file> --rbd <rbd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2vhd --rbd <rbd_file> --vhd <vhd_file> [-p] [-m] [--uuid <vdi_uuid>] [-v] [-d]')
-            eprint('\trbd2raw --rbd <rbd_file> --raw <vhd_file> [-p] [-m] [-v] [-d]')
-            eprint('\trbd2nbd --rbd <rbd_file> --nbd <nbd_server> [-p] [-m] [-v] [-d]')
+            print_usage()
 
 if __name__ == "__main__":
     main(sys.argv[1:])
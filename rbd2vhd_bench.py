@@ -0,0 +1,791 @@
+#!/usr/bin/python -u
+#
+# Copyright (C) Roman V. Posudnevskiy (ramzes_r@yahoo.com)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth math.floor, Boston, MA  02110-1301  USA
+
+from __future__ import print_function
+from struct import *
+import sys, getopt
+import os
+import time
+import random
+import socket
+import threading
+import itertools
+import SocketServer
+import Queue
+import uuid
+import shutil
+import tempfile
+
+import rbd2vhd
+from rbd2vhd import INFO, DEBUG, ERROR, eprint
+
+STANDIN_URI = "http://127.0.0.1:%d/services/SM/nbd/%s/%s/%s?session_id=OpaqueRef%%3a%s"
+STANDIN_HTTP_REQUEST_MAX_SIZE = 4096
+STANDIN_DEFAULT_FLAGS = rbd2vhd.NBD_FLAG_HAS_FLAGS | rbd2vhd.NBD_FLAG_SEND_WRITE_ZEROES | rbd2vhd.NBD_FLAG_CAN_MULTI_CONN
+STANDIN_ZERO_CHUNK_SIZE = rbd2vhd.ZERO_CHUNK_SIZE
+
+#-- STAND-IN STATISTICS FIELDs --#
+_standin_requests_      = 0
+_standin_write_bytes_   = 1
+_standin_zero_bytes_    = 2
+_standin_read_bytes_    = 3
+_standin_errors_        = 4
+#-- STAND-IN STATISTICS FIELDs --#
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def recv_exact(sock, length):
+    _buffer_ = bytearray(length)
+    view = memoryview(_buffer_)
+    received = 0
+    while received < length:
+        try:
+            read_bytes = sock.recv_into(view[received:], length - received)
+        except socket.error:
+            return None
+        if not read_bytes:
+            return None
+        received += read_bytes
+    return _buffer_
+
+class NBDStandInStore(object):
+    # Export contents, kept in memory or in a sparse file
+
+    def __init__(self, size, path=None):
+        self.size = size
+        self.lock = threading.Lock()
+        if path is None:
+            self.fd = None
+            self.memory = bytearray(size)
+        else:
+            self.memory = None
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            os.ftruncate(self.fd, size)
+
+    def write(self, offset, data):
+        if self.fd is None:
+            self.memory[offset:offset+len(data)] = data
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+
+    def zero(self, offset, length):
+        while length > 0:
+            chunk = min(length, STANDIN_ZERO_CHUNK_SIZE)
+            self.write(offset, rbd2vhd.get_buffer_view(rbd2vhd.ZERO_CHUNK, 0, chunk))
+            offset += chunk
+            length -= chunk
+
+    def read(self, offset, length):
+        if self.fd is None:
+            return str(self.memory[offset:offset+length])
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                return os.read(self.fd, length)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+class NBDStandInServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    # Local stand-in for the XAPI NBD service: HTTP PUT upgrade, oldstyle negotiation and
+    # transmission with configurable reply latency, bandwidth cap and error replies
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, store, flags=STANDIN_DEFAULT_FLAGS, latency=0, bandwidth=0, error_rate=0):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), NBDStandInHandler)
+        self.store = store
+        self.flags = flags
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.bandwidth_time = 0
+        self.stats = [0, 0, 0, 0, 0]
+
+    def throttle(self, length):
+        # All connections share one bandwidth budget
+        if self.bandwidth <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.bandwidth_time = max(self.bandwidth_time, now) + float(length)/self.bandwidth
+            delay = self.bandwidth_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def account(self, index, value):
+        with self.lock:
+            self.stats[index] += value
+
+    def uri(self):
+        return STANDIN_URI % (self.server_address[1], 'sr', 'vdi', 'dp', 'standin')
+
+class NBDStandInHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        request = ""
+        while "\r\n\r\n" not in request:
+            data = sock.recv(STANDIN_HTTP_REQUEST_MAX_SIZE)
+            if (not data) | (len(request) > STANDIN_HTTP_REQUEST_MAX_SIZE):
+                return
+            request += data
+        if not request.startswith("PUT /services/SM/nbd/"):
+            sock.sendall("HTTP/1.1 404 Not Found\r\n\r\n")
+            return
+        sock.sendall("HTTP/1.1 200 OK\r\nTransfer-encoding: nbd\r\n\r\n")
+        sock.sendall(pack(rbd2vhd.NBD_NEGOTIATION_FORMAT, rbd2vhd.NBD_INIT_PASSWD, rbd2vhd.NBD_CLISERVER_MAGIC, server.store.size, 0, server.flags, ''))
+
+        # Replies leave from a separate thread, so that the latency delays replies without stalling the requests behind them
+        replies = Queue.Queue()
+        sender = threading.Thread(target=self.send_replies, args=(replies,))
+        sender.daemon = True
+        sender.start()
+
+        while True:
+            header = recv_exact(sock, rbd2vhd.NBD_REQUEST_HEADER_SIZE)
+            if header is None:
+                break
+            (magic, flags, request_type, handle, offset, length) = rbd2vhd.NBD_REQUEST_HEADER_STRUCT.unpack(str(header))
+            if magic != rbd2vhd.NBD_REQUEST_MAGIC:
+                ERROR("STANDIN: Bad request magic 0x%08x" % magic)
+                break
+            if request_type == rbd2vhd.NBD_CMD_DISC:
+                break
+            server.account(_standin_requests_, 1)
+            data = None
+            if request_type == rbd2vhd.NBD_CMD_WRITE:
+                server.throttle(length)
+                data = recv_exact(sock, length)
+                if data is None:
+                    break
+
+            error = 0
+            if (server.error_rate > 0) and (random.random() < server.error_rate):
+                error = rbd2vhd.EIO
+                server.account(_standin_errors_, 1)
+            elif offset + length > server.store.size:
+                error = rbd2vhd.EINVAL
+                server.account(_standin_errors_, 1)
+
+            reply = rbd2vhd.NBD_REPLY_HEADER_STRUCT.pack(rbd2vhd.NBD_REPLY_MAGIC, error, handle)
+            if error == 0:
+                if request_type == rbd2vhd.NBD_CMD_WRITE:
+                    server.store.write(offset, data)
+                    server.account(_standin_write_bytes_, length)
+                elif request_type in (rbd2vhd.NBD_CMD_WRITE_ZEROES, rbd2vhd.NBD_CMD_TRIM):
+                    server.store.zero(offset, length)
+                    server.account(_standin_zero_bytes_, length)
+                elif request_type == rbd2vhd.NBD_CMD_READ:
+                    server.throttle(length)
+                    reply += server.store.read(offset, length)
+                    server.account(_standin_read_bytes_, length)
+            replies.put((time.time() + server.latency, reply))
+
+        replies.put(None)
+        sender.join()
+
+    def send_replies(self, replies):
+        while True:
+            item = replies.get()
+            if item is None:
+                break
+            (due, reply) = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.request.sendall(reply)
+            except socket.error:
+                break
+
+def standin_start(size, path=None, flags=STANDIN_DEFAULT_FLAGS, latency=0, bandwidth=0, error_rate=0, port=0):
+    server = NBDStandInServer(port, NBDStandInStore(size, path), flags, latency, bandwidth, error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    INFO("STANDIN: Listening on port %d, export size %d" % (server.server_address[1], size))
+    return server
+
+def standin_stop(server):
+    server.shutdown()
+    server.server_close()
+    server.store.close()
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def get_rbd_diff_summary(rbd):
+    # Returns (image size, data bytes, zero bytes) of a diff
+    RBDDIFF_FH = rbd2vhd.rbd_diff_open(rbd)
+    image_size = 0
+    data_bytes = 0
+    zero_bytes = 0
+    for record in rbd2vhd.rbd_diff_records(RBDDIFF_FH):
+        record_tag = record[rbd2vhd._rbd_record_tag_]
+        if record_tag == rbd2vhd.RBD_DIFF_RECORD_SIZE:
+            image_size = record[rbd2vhd._rbd_record_length_]
+        elif record_tag == rbd2vhd.RBD_DIFF_RECORD_DATA:
+            data_bytes += record[rbd2vhd._rbd_record_length_]
+        elif record_tag == rbd2vhd.RBD_DIFF_RECORD_ZERO:
+            zero_bytes += record[rbd2vhd._rbd_record_length_]
+    RBDDIFF_FH.close()
+    return (image_size, data_bytes, zero_bytes)
+
+def verify_rbd_diff(rbd, store):
+    # Checks that every record of the diff landed in the store
+    RBDDIFF_FH = rbd2vhd.rbd_diff_open(rbd)
+    mismatches = 0
+    for record in rbd2vhd.rbd_diff_records(RBDDIFF_FH):
+        record_tag = record[rbd2vhd._rbd_record_tag_]
+        offset = record[rbd2vhd._rbd_record_offset_]
+        length = record[rbd2vhd._rbd_record_length_]
+        if record_tag == rbd2vhd.RBD_DIFF_RECORD_DATA:
+            if store.read(offset, length) != record[rbd2vhd._rbd_record_data_].tobytes():
+                ERROR("BENCH: Data mismatch at offset 0x%08x length %d" % (offset, length))
+                mismatches += 1
+        elif record_tag == rbd2vhd.RBD_DIFF_RECORD_ZERO:
+            if not rbd2vhd.is_zero_data(store.read(offset, length), 0, length):
+                ERROR("BENCH: Zero data mismatch at offset 0x%08x length %d" % (offset, length))
+                mismatches += 1
+    RBDDIFF_FH.close()
+    return mismatches
+
+def bench_rbd2nbd(rbd, summary, store_path, server_settings, connections, inflight, retries, max_request, detect_zeros, verify):
+    # One rbd2nbd transfer against a fresh stand-in, returns its measurements
+    (image_size, data_bytes, zero_bytes) = summary
+    (flags, latency, bandwidth, error_rate) = server_settings
+    server = standin_start(image_size, store_path, flags, latency, bandwidth, error_rate)
+    result = {}
+    client = None
+    start = time.time()
+    try:
+        RBDDIFF_FH = rbd2vhd.rbd_diff_open(rbd)
+        client = rbd2vhd.NBDClient(server.uri(), connections, inflight, retries, max_request)
+        rbd2vhd.rbd_records2nbd(rbd2vhd.rbd_diff_records(RBDDIFF_FH), client, False, False, detect_zeros)
+        elapsed = time.time() - start
+        latencies = sorted(client.tracker.latencies)
+        client.close()
+        RBDDIFF_FH.close()
+        result['status'] = 'ok'
+        if verify:
+            if verify_rbd_diff(rbd, server.store) > 0:
+                result['status'] = 'mismatch'
+    except SystemExit as e:
+        # rbd2vhd gives up with sys.exit(), e.g. when errors outnumber the retries
+        elapsed = time.time() - start
+        latencies = []
+        result['status'] = 'exit %s' % e.code
+        if client is not None:
+            for sock in client.socks:
+                sock.close()
+    finally:
+        standin_stop(server)
+
+    result['seconds'] = elapsed
+    result['mbps'] = (data_bytes + zero_bytes) / elapsed / (1024*1024)
+    result['wire_mbps'] = server.stats[_standin_write_bytes_] / elapsed / (1024*1024)
+    result['requests'] = server.stats[_standin_requests_]
+    result['rps'] = server.stats[_standin_requests_] / elapsed
+    result['errors'] = server.stats[_standin_errors_]
+    for percent in (50, 90, 99):
+        result['p%d' % percent] = rbd2vhd.get_percentile(latencies, percent) * 1000
+    return result
+
+#-- (result key, column width, value format) --#
+BENCH_COLUMNS = [("connections", 11, "s"), ("inflight", 8, "s"), ("max_request", 11, "s"), ("zeros", 5, "s"), ("status", 8, "s"), ("seconds", 8, ".3f"),
+                 ("mbps", 8, ".1f"), ("wire_mbps", 9, ".1f"), ("requests", 8, "d"), ("rps", 9, ".1f"), ("errors", 6, "d"), ("p50", 8, ".3f"), ("p90", 8, ".3f"), ("p99", 8, ".3f")]
+
+def print_bench_header():
+    print(" ".join("%*s" % (width, name) for (name, width, spec) in BENCH_COLUMNS))
+
+def print_bench_result(result):
+    print(" ".join(("%" + str(width) + spec) % result[name] for (name, width, spec) in BENCH_COLUMNS))
+
+def bench(rbd, store_path, server_settings, connections_list, inflight_list, max_request_list, retries, detect_zeros, repeat, verify):
+    summary = get_rbd_diff_summary(rbd)
+    print("# %s: image size %d, data %d bytes, zero %d bytes" % (rbd, summary[0], summary[1], summary[2]))
+    print("# stand-in: flags 0x%04x, latency %.3f ms, bandwidth %s, error rate %g" % (server_settings[0], server_settings[1]*1000,
+          ("%.1f MB/s" % (server_settings[2]/(1024*1024))) if server_settings[2] > 0 else "unlimited", server_settings[3]))
+    print("# mbps - diff bytes applied per second, wire_mbps - write payload per second, p50/p90/p99 - reply latency in ms")
+    print_bench_header()
+    for (connections, inflight, max_request) in itertools.product(connections_list, inflight_list, max_request_list):
+        for index in range(repeat):
+            result = bench_rbd2nbd(rbd, summary, store_path, server_settings, connections, inflight, retries, max_request, detect_zeros, verify)
+            result['connections'] = connections
+            result['inflight'] = inflight
+            result['max_request'] = max_request
+            result['zeros'] = 'yes' if detect_zeros else 'no'
+            print_bench_result(result)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+CORPUS_DEFAULT_IMAGE_SIZE = 256*1024*1024
+CORPUS_DEFAULT_RECORD_SIZES = "4096:30,65536:30,1048576:25,4194304:15"
+CORPUS_DEFAULT_SPARSITY = 0.5
+CORPUS_DEFAULT_ZERO_RATIO = 0.2
+CORPUS_PAYLOAD_POOL_SIZE = 8*1024*1024
+CORPUS_COMPARE_CHUNK_SIZE = 4*1024*1024
+CORPUS_REWRITE_RATIO = 0.25
+
+#-- (case name, record sizes, sparsity, zero record ratio, differencing, unordered) --#
+CORPUS_CASES = [("dense-large", "1048576:50,4194304:50", 0.1, 0.05, False, False),
+                ("sparse-small", "4096:60,65536:40", 0.9, 0.1, False, False),
+                ("mixed", CORPUS_DEFAULT_RECORD_SIZES, CORPUS_DEFAULT_SPARSITY, CORPUS_DEFAULT_ZERO_RATIO, True, False),
+                ("zero-heavy", CORPUS_DEFAULT_RECORD_SIZES, 0.3, 0.6, True, False),
+                ("unordered", CORPUS_DEFAULT_RECORD_SIZES, CORPUS_DEFAULT_SPARSITY, CORPUS_DEFAULT_ZERO_RATIO, True, True)]
+
+SUITE_TOOLS = ["rbd2vhd", "vhd2rbd", "rbd2raw", "rbd2nbd", "vhd2raw", "vhd2nbd"]
+
+def parse_record_sizes(arg):
+    # "size:weight,size:weight,..." -> [(size, weight), ...], sizes are rounded up to sectors
+    record_sizes = []
+    for item in arg.split(','):
+        if ':' in item:
+            (size, weight) = item.split(':')
+        else:
+            (size, weight) = (item, 1)
+        record_sizes.append((rbd2vhd.get_size_aligned_to_sector_boundary(int(size)), float(weight)))
+    return record_sizes
+
+def choose_record_size(record_sizes, total_weight):
+    point = random.random() * total_weight
+    for (size, weight) in record_sizes:
+        point -= weight
+        if point < 0:
+            return size
+    return record_sizes[-1][0]
+
+def rbd_diff_write_snap(RBDDIFF_FH, record_tag, snap):
+    snap_name = "%s%s" % (rbd2vhd.SNAPSHOT_PREFIX, snap)
+    RBDDIFF_FH.write(pack("%s%s%s%ds" % (rbd2vhd.RBD_DIFF_META_ENDIAN_PREFIX, rbd2vhd.RBD_DIFF_META_RECORD_TAG, rbd2vhd.RBD_DIFF_META_SNAP, len(snap_name)),
+                          record_tag, len(snap_name), snap_name))
+
+def gen_unordered_records(records, pool):
+    # Splits (offset, length, chunks) records at VHD block boundaries, rewrites the last data record of
+    # about CORPUS_REWRITE_RATIO of the blocks over the same range and shuffles the blocks. The records
+    # then go back to lower blocks and overlap, which rbd export-diff never writes but the tools accept.
+    block_size = rbd2vhd.VHD_DEFAULT_BLOCK_SIZE
+    blocks = []
+    for (offset, length, chunks) in records:
+        end = offset + length
+        while offset < end:
+            block_number = offset // block_size
+            piece = min(end, (block_number + 1)*block_size) - offset
+            if (len(blocks) == 0) or (blocks[-1][0] != block_number):
+                blocks.append((block_number, []))
+            payload = None if chunks is None else [rbd2vhd.get_buffer_view(pool, random.randrange(0, CORPUS_PAYLOAD_POOL_SIZE - piece + 1), piece)]
+            blocks[-1][1].append((offset, piece, payload))
+            offset += piece
+    for (block_number, block_records) in blocks:
+        (offset, length, chunks) = block_records[-1]
+        if (chunks is not None) and (random.random() < CORPUS_REWRITE_RATIO):
+            block_records.append((offset, length, [rbd2vhd.get_buffer_view(pool, random.randrange(0, CORPUS_PAYLOAD_POOL_SIZE - length + 1), length)]))
+    random.shuffle(blocks)
+    return [record for (block_number, block_records) in blocks for record in block_records]
+
+def gen_rbd_diff(rbd, image_size, record_sizes, sparsity, zero_ratio, from_snap='', to_snap='', seed=0, unordered=False):
+    # Writes an `rbd diff v1` stream with records in offset order. Record sizes follow the weighted
+    # distribution, the gaps between records leave about `sparsity` of the image untouched and
+    # `zero_ratio` of the records are `z` records. With unordered the records are reordered and
+    # partly rewritten by gen_unordered_records(). Returns (data bytes, zero bytes).
+    random.seed(seed)
+    pool = os.urandom(CORPUS_PAYLOAD_POOL_SIZE)
+    total_weight = sum(weight for (size, weight) in record_sizes)
+    mean_size = sum(size*weight for (size, weight) in record_sizes) / total_weight
+    mean_gap = mean_size * sparsity / max(1 - sparsity, 0.001)
+
+    RBDDIFF_FH = rbd2vhd.rbd_diff_create(rbd)
+    RBDDIFF_FH.write(rbd2vhd.RBD_HEADER)
+    if from_snap:
+        rbd_diff_write_snap(RBDDIFF_FH, rbd2vhd.RBD_DIFF_RECORD_FROM_SNAP, from_snap)
+    if to_snap:
+        rbd_diff_write_snap(RBDDIFF_FH, rbd2vhd.RBD_DIFF_RECORD_TO_SNAP, to_snap)
+    RBDDIFF_FH.write(pack(rbd2vhd.RBD_DIFF_META_ENDIAN_PREFIX+rbd2vhd.RBD_DIFF_META_RECORD_TAG+rbd2vhd.RBD_DIFF_META_SIZE, 's', image_size))
+
+    # (offset, length, payload chunks or None for `z` records)
+    records = []
+    offset = 0
+    while True:
+        if mean_gap > 0:
+            offset += int(random.expovariate(1.0/mean_gap)) // rbd2vhd.SECTOR_SIZE * rbd2vhd.SECTOR_SIZE
+        length = min(choose_record_size(record_sizes, total_weight), image_size - offset)
+        if length <= 0:
+            break
+        if random.random() < zero_ratio:
+            records.append((offset, length, None))
+        else:
+            chunks = []
+            remaining = length
+            while remaining > 0:
+                chunk = min(remaining, CORPUS_PAYLOAD_POOL_SIZE)
+                start = random.randrange(0, CORPUS_PAYLOAD_POOL_SIZE - chunk + 1)
+                chunks.append(rbd2vhd.get_buffer_view(pool, start, chunk))
+                remaining -= chunk
+            records.append((offset, length, chunks))
+        offset += length
+    if unordered:
+        records = gen_unordered_records(records, pool)
+
+    data_bytes = 0
+    zero_bytes = 0
+    for (offset, length, chunks) in records:
+        if chunks is None:
+            rbd2vhd.rbd_diff_write_zero(RBDDIFF_FH, offset, length)
+            zero_bytes += length
+        else:
+            rbd2vhd.rbd_diff_write_data(RBDDIFF_FH, offset, length, chunks)
+            data_bytes += length
+    RBDDIFF_FH.write(rbd2vhd.RBD_DIFF_RECORD_END)
+    RBDDIFF_FH.close()
+    return (data_bytes, zero_bytes)
+
+def apply_rbd_diff(rbd, raw):
+    # Reference image of a diff applied to an empty image, independent of rbd2raw
+    (image_size, data_bytes, zero_bytes) = get_rbd_diff_summary(rbd)
+    RAW_FH = open(raw, "wb")
+    RAW_FH.truncate(image_size)
+    RBDDIFF_FH = rbd2vhd.rbd_diff_open(rbd)
+    # `z` records applied to an empty image leave the zeros the truncated file already reads as
+    for record in rbd2vhd.rbd_diff_records(RBDDIFF_FH):
+        if record[rbd2vhd._rbd_record_tag_] == rbd2vhd.RBD_DIFF_RECORD_DATA:
+            RAW_FH.seek(record[rbd2vhd._rbd_record_offset_])
+            RAW_FH.write(record[rbd2vhd._rbd_record_data_])
+    RBDDIFF_FH.close()
+    RAW_FH.close()
+
+def compare_images(path_a, path_b, size):
+    # Compares the first `size` bytes, a file shorter than that reads as zeros past its end
+    FH_A = open(path_a, "rb")
+    FH_B = open(path_b, "rb")
+    offset = 0
+    same = True
+    while same and (offset < size):
+        length = min(CORPUS_COMPARE_CHUNK_SIZE, size - offset)
+        data_a = FH_A.read(length)
+        data_b = FH_B.read(length)
+        data_a += '\x00' * (length - len(data_a))
+        data_b += '\x00' * (length - len(data_b))
+        if data_a != data_b:
+            ERROR("BENCH: %s and %s differ in range 0x%08x-0x%08x" % (path_a, path_b, offset, offset + length))
+            same = False
+        offset += length
+    FH_A.close()
+    FH_B.close()
+    return same
+
+def gen_corpus(work_dir, image_size, seed):
+    # Generates the diffs and VHDs of CORPUS_CASES, returns [(name, rbd, vhd, reference raw, summary), ...]
+    corpus = []
+    for (index, (name, record_sizes, sparsity, zero_ratio, differencing, unordered)) in enumerate(CORPUS_CASES):
+        rbd = os.path.join(work_dir, "%s.rbd" % name)
+        vhd = os.path.join(work_dir, "%s.vhd" % name)
+        raw = os.path.join(work_dir, "%s.raw" % name)
+        from_snap = str(uuid.uuid4()) if differencing else ''
+        to_snap = str(uuid.uuid4()) if differencing else ''
+        INFO("BENCH: Generating %s" % rbd)
+        gen_rbd_diff(rbd, image_size, parse_record_sizes(record_sizes), sparsity, zero_ratio, from_snap, to_snap, seed + index, unordered)
+        (status, rusage, elapsed) = run_tool("rbd2vhd", ["--rbd", rbd, "--vhd", vhd, "--uuid", str(uuid.uuid4())])
+        if status != 0:
+            ERROR("BENCH: Could not create %s, rbd2vhd exited with %d" % (vhd, status))
+            sys.exit(1)
+        apply_rbd_diff(rbd, raw)
+        corpus.append((name, rbd, vhd, raw, get_rbd_diff_summary(rbd)))
+    return corpus
+
+def run_tool(command, args):
+    # Runs an rbd2vhd command in a forked child, so that os.wait4() reports its own peak RSS and CPU time.
+    # Returns (exit status, rusage, wall clock seconds).
+    sys.stdout.flush()
+    sys.stderr.flush()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            sys.argv = [command] + args
+            rbd2vhd.main(args)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    (pid, status, rusage) = os.wait4(pid, 0)
+    elapsed = time.time() - start
+    if os.WIFEXITED(status):
+        status = os.WEXITSTATUS(status)
+    else:
+        status = -os.WTERMSIG(status)
+    return (status, rusage, elapsed)
+
+def get_forked_rss():
+    # Peak RSS in MB of a child that exits right after the fork, the share of run_tool() figures that is not the tool's
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    (pid, status, rusage) = os.wait4(pid, 0)
+    return rusage.ru_maxrss / 1024.0
+
+def bench_tool(tool, case, work_dir, server_settings):
+    # One timed run of `tool` on a corpus case with its round trip check
+    (name, rbd, vhd, raw, summary) = case
+    (image_size, data_bytes, zero_bytes) = summary
+    output = os.path.join(work_dir, "out")
+    check_raw = os.path.join(work_dir, "check.raw")
+    server = None
+    if tool == "rbd2vhd":
+        args = ["--rbd", rbd, "--vhd", output + ".vhd", "--uuid", str(uuid.uuid4())]
+    elif tool == "vhd2rbd":
+        args = ["--vhd", vhd, "--rbd", output + ".rbd"]
+    elif tool == "rbd2raw":
+        args = ["--rbd", rbd, "--raw", output + ".raw"]
+    elif tool == "vhd2raw":
+        args = ["--vhd", vhd, "--raw", output + ".raw"]
+    elif tool in ("rbd2nbd", "vhd2nbd"):
+        # A file store keeps the export out of the memory the child inherits
+        (flags, latency, bandwidth, error_rate) = server_settings
+        server = standin_start(image_size, output + ".store", flags, latency, bandwidth, error_rate)
+        if tool == "rbd2nbd":
+            args = ["--rbd", rbd, "--nbd", server.uri()]
+        else:
+            args = ["--vhd", vhd, "--nbd", server.uri()]
+
+    (status, rusage, elapsed) = run_tool(tool, args)
+    if server is not None:
+        standin_stop(server)
+
+    check = "-"
+    if status == 0:
+        if tool == "rbd2vhd":
+            run_tool("vhd2rbd", ["--vhd", output + ".vhd", "--rbd", output + ".rbd"])
+            run_tool("rbd2raw", ["--rbd", output + ".rbd", "--raw", check_raw])
+        elif tool == "vhd2rbd":
+            run_tool("rbd2raw", ["--rbd", output + ".rbd", "--raw", check_raw])
+        elif tool in ("rbd2raw", "vhd2raw"):
+            check_raw = output + ".raw"
+        elif tool in ("rbd2nbd", "vhd2nbd"):
+            check_raw = output + ".store"
+        check = "ok" if compare_images(raw, check_raw, image_size) else "FAIL"
+    for suffix in (".vhd", ".rbd", ".raw", ".store"):
+        if os.path.exists(output + suffix):
+            os.unlink(output + suffix)
+    if os.path.exists(check_raw):
+        os.unlink(check_raw)
+
+    cpu = rusage.ru_utime + rusage.ru_stime
+    processed = data_bytes + zero_bytes
+    result = {}
+    result['case'] = name
+    result['tool'] = tool
+    result['status'] = 'ok' if status == 0 else 'exit %d' % status
+    result['check'] = check
+    result['seconds'] = elapsed
+    result['mbps'] = processed / elapsed / (1024*1024)
+    result['rss_mb'] = rusage.ru_maxrss / 1024.0
+    result['cpu'] = cpu
+    result['cpu_ns'] = cpu / max(processed, 1) * 1e9
+    return result
+
+#-- (result key, column width, value format) --#
+SUITE_COLUMNS = [("case", 12, "s"), ("tool", 8, "s"), ("status", 8, "s"), ("check", 5, "s"), ("seconds", 8, ".3f"), ("mbps", 8, ".1f"),
+                 ("rss_mb", 8, ".1f"), ("cpu", 8, ".3f"), ("cpu_ns", 8, ".2f")]
+
+def suite(work_dir, image_size, seed, tools, server_settings, repeat, keep):
+    if work_dir:
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="rbd2vhd_bench.")
+    corpus = gen_corpus(work_dir, image_size, seed)
+
+    baseline_rss = get_forked_rss()
+    print("# corpus in %s, image size %d, seed %d" % (work_dir, image_size, seed))
+    for (name, rbd, vhd, raw, summary) in corpus:
+        print("# %s: data %d bytes, zero %d bytes, vhd %d bytes" % (name, summary[1], summary[2], os.path.getsize(vhd)))
+    print("# mbps - diff bytes (data + zero records) per second, rss_mb - peak RSS of the forked tool including %.1f MB inherited from the bench,"
+          % baseline_rss)
+    print("# cpu - user + system seconds, cpu_ns - CPU nanoseconds per diff byte, check - round trip compared with the diff applied to an empty image")
+    print(" ".join("%*s" % (width, name) for (name, width, spec) in SUITE_COLUMNS))
+    failures = 0
+    for case in corpus:
+        for tool in tools:
+            for index in range(repeat):
+                result = bench_tool(tool, case, work_dir, server_settings)
+                if (result['status'] != 'ok') or (result['check'] != 'ok'):
+                    failures += 1
+                print(" ".join(("%" + str(width) + spec) % result[name] for (name, width, spec) in SUITE_COLUMNS))
+
+    if not keep:
+        shutil.rmtree(work_dir)
+    return failures
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------#
+def print_usage():
+    eprint('Usage:')
+    eprint('\trbd2vhd_bench.py --rbd <rbd_file> [--store <file>] [--latency <ms>] [--bandwidth <MB/s>] [--error-rate <fraction>] [--server-flags <flags>]')
+    eprint('\t                 [--nbd-connections <list>] [--nbd-inflight <list>] [--nbd-max-request <list>] [--nbd-retries <count>] [--detect-zeros]')
+    eprint('\t                 [--repeat <count>] [--verify] [-v] [-d]')
+    eprint('\trbd2vhd_bench.py --serve --size <bytes> [--port <port>] [--store <file>] [--latency <ms>] [--bandwidth <MB/s>] [--error-rate <fraction>]')
+    eprint('\t                 [--server-flags <flags>] [-v] [-d]')
+    eprint('\trbd2vhd_bench.py --generate <rbd_file> [--vhd <vhd_file>] [--uuid <vdi_uuid>] [--image-size <bytes>] [--record-sizes <size:weight,...>]')
+    eprint('\t                 [--sparsity <fraction>] [--zero-ratio <fraction>] [--from-snap <uuid>] [--to-snap <uuid>] [--seed <number>] [-v] [-d]')
+    eprint('\trbd2vhd_bench.py --suite [--work-dir <dir>] [--keep] [--image-size <bytes>] [--seed <number>] [--tools <list>] [--repeat <count>]')
+    eprint('\t                 [--latency <ms>] [--bandwidth <MB/s>] [--server-flags <flags>] [-v] [-d]')
+    eprint('\t<list> is a comma separated list of values, every combination is measured')
+
+def parse_list(arg):
+    return [int(value) for value in arg.split(',')]
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv,"hvd",["rbd=","store=","latency=","bandwidth=","error-rate=","server-flags=","nbd-connections=","nbd-inflight=",
+                                               "nbd-max-request=","nbd-retries=","detect-zeros","repeat=","verify","serve","size=","port=",
+                                               "generate=","vhd=","uuid=","image-size=","record-sizes=","sparsity=","zero-ratio=","from-snap=",
+                                               "to-snap=","seed=","suite","work-dir=","keep","tools="])
+    except getopt.GetoptError:
+        print_usage()
+        sys.exit(2)
+
+    rbd_file = ''
+    store_path = None
+    latency = 0
+    bandwidth = 0
+    error_rate = 0
+    flags = STANDIN_DEFAULT_FLAGS
+    connections_list = [1]
+    inflight_list = [rbd2vhd.NBD_DEFAULT_INFLIGHT]
+    max_request_list = [rbd2vhd.NBD_DEFAULT_MAX_REQUEST_SIZE]
+    retries = rbd2vhd.NBD_DEFAULT_RETRIES
+    detect_zeros = False
+    repeat = 1
+    verify = False
+    serve = False
+    size = 0
+    port = 0
+    generate_file = ''
+    vhd_file = ''
+    vhd_uuid = ''
+    image_size = CORPUS_DEFAULT_IMAGE_SIZE
+    record_sizes = CORPUS_DEFAULT_RECORD_SIZES
+    sparsity = CORPUS_DEFAULT_SPARSITY
+    zero_ratio = CORPUS_DEFAULT_ZERO_RATIO
+    from_snap = ''
+    to_snap = ''
+    seed = 0
+    run_suite = False
+    work_dir = ''
+    keep = False
+    tools = SUITE_TOOLS
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print_usage()
+            sys.exit()
+        elif opt == '-v':
+            rbd2vhd.verbose = True
+        elif opt == '-d':
+            rbd2vhd.debug = True
+        elif opt == '--rbd':
+            rbd_file = arg
+        elif opt == '--store':
+            store_path = arg
+        elif opt == '--latency':
+            latency = float(arg)/1000
+        elif opt == '--bandwidth':
+            bandwidth = float(arg)*1024*1024
+        elif opt == '--error-rate':
+            error_rate = float(arg)
+        elif opt == '--server-flags':
+            flags = int(arg, 0)
+        elif opt == '--nbd-connections':
+            connections_list = parse_list(arg)
+        elif opt == '--nbd-inflight':
+            inflight_list = parse_list(arg)
+        elif opt == '--nbd-max-request':
+            max_request_list = parse_list(arg)
+        elif opt == '--nbd-retries':
+            retries = int(arg)
+        elif opt == '--detect-zeros':
+            detect_zeros = True
+        elif opt == '--repeat':
+            repeat = int(arg)
+        elif opt == '--verify':
+            verify = True
+        elif opt == '--serve':
+            serve = True
+        elif opt == '--size':
+            size = int(arg)
+        elif opt == '--port':
+            port = int(arg)
+        elif opt == '--generate':
+            generate_file = arg
+        elif opt == '--vhd':
+            vhd_file = arg
+        elif opt == '--uuid':
+            vhd_uuid = arg
+        elif opt == '--image-size':
+            image_size = int(arg)
+        elif opt == '--record-sizes':
+            record_sizes = arg
+        elif opt == '--sparsity':
+            sparsity = float(arg)
+        elif opt == '--zero-ratio':
+            zero_ratio = float(arg)
+        elif opt == '--from-snap':
+            from_snap = arg
+        elif opt == '--to-snap':
+            to_snap = arg
+        elif opt == '--seed':
+            seed = int(arg)
+        elif opt == '--suite':
+            run_suite = True
+        elif opt == '--work-dir':
+            work_dir = arg
+        elif opt == '--keep':
+            keep = True
+        elif opt == '--tools':
+            tools = arg.split(',')
+
+    if generate_file:
+        (data_bytes, zero_bytes) = gen_rbd_diff(generate_file, image_size, parse_record_sizes(record_sizes), sparsity, zero_ratio, from_snap, to_snap, seed)
+        eprint("%s: data %d bytes, zero %d bytes" % (generate_file, data_bytes, zero_bytes))
+        if vhd_file:
+            rbd2vhd.rbd2vhd(generate_file, vhd_file, vhd_uuid or str(uuid.uuid4()), False, False, False)
+    elif run_suite:
+        if suite(work_dir, image_size, seed, tools, (flags, latency, bandwidth, error_rate), repeat, keep) > 0:
+            sys.exit(1)
+    elif serve:
+        server = standin_start(size, store_path, flags, latency, bandwidth, error_rate, port)
+        eprint("Stand-in NBD server: %s" % server.uri())
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            standin_stop(server)
+    elif rbd_file:
+        bench(rbd_file, store_path, (flags, latency, bandwidth, error_rate), connections_list, inflight_list, max_request_list, retries, detect_zeros, repeat, verify)
+    else:
+        print_usage()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])